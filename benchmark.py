@@ -0,0 +1,363 @@
+from socket import *
+from threading import Thread
+import argparse
+import json
+import random
+import os
+import selectors
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+# Custom Modules
+from command import Command
+from chatroom import Chatroom
+from framing import FrameReader
+from compression import Deflater, Inflater, compress_shared
+from messagelog import MessageLog
+import wire
+from user import User
+
+def legacy_send(cmd: Command, sock: socket):
+    """
+    The original per recipient send, serializes the command and issues two sends every time.
+    """
+
+    data = cmd.stringify()
+    sock.sendall(struct.pack('!I', len(data)))
+    sock.sendall(data.encode(encoding='UTF-8'))
+
+class DirectConnection:
+    def __init__(self, sock: socket):
+        """
+        Writes straight to the socket, so the broadcast benchmark measures serialization and syscalls only.
+        """
+
+        self.sock = sock
+        self.encoding = 'json'
+        self.deflater = None
+        self.symbols = set()
+
+    def sendall(self, data: bytes, ephemeral=False):
+        self.sock.sendall(data)
+
+class Sink:
+    def __init__(self, socks: list):
+        """
+        Reads and discards everything arriving on the given sockets so senders never block.
+        """
+
+        self.selector = selectors.DefaultSelector()
+        self.running = True
+        self.received = 0
+        for sock in socks:
+            self.selector.register(sock, selectors.EVENT_READ)
+        self.thread = Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def drain(self):
+        while self.running:
+            for key, _ in self.selector.select(timeout=0.1):
+                self.received += len(key.fileobj.recv(1 << 16))
+
+    def wait_for(self, total: int):
+        """
+        Waits until the given number of bytes has arrived in total, so queued sends are timed too.
+        """
+
+        while self.received < total:
+            time.sleep(0.0005)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+def bench_broadcast(sizes: list, messages: int):
+    """
+    Compares the legacy per recipient broadcast with the serialize once broadcast for growing room sizes.
+    Both are timed until every byte has been received.
+    """
+
+    results = []
+    for size in sizes:
+        pairs = [socketpair() for _ in range(size)]
+        sink = Sink([pair[1] for pair in pairs])
+
+        chatroom = Chatroom("bench", None)
+        for idx, pair in enumerate(pairs):
+            chatroom.add_user(User("user{}".format(idx), DirectConnection(pair[0])))
+
+        cmd = Command()
+        cmd.init_send_message("x" * 120, chatroom.name)
+        cmd.creator = "user0"
+        expected = len(cmd.frame()) * size * messages
+
+        start = time.perf_counter()
+        for _ in range(messages):
+            for user in list(chatroom.users.values()):
+                legacy_send(cmd, user.socket.sock)
+        sink.wait_for(expected)
+        legacy = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(messages):
+            chatroom.send_all(cmd)
+        sink.wait_for(2 * expected)
+        once = time.perf_counter() - start
+
+        sink.stop()
+        for pair in pairs:
+            pair[0].close()
+            pair[1].close()
+
+        result = {'room_size': size, 'messages': messages,
+                  'legacy_msgs_per_sec': messages / legacy, 'once_msgs_per_sec': messages / once,
+                  'speedup': legacy / once}
+        results.append(result)
+        print("room {:>5}: legacy {:>9.1f} msg/s, serialize once {:>9.1f} msg/s, speedup {:.2f}x".format(
+            size, result['legacy_msgs_per_sec'], result['once_msgs_per_sec'], result['speedup']))
+
+    return results
+
+def bench_encoding(count: int):
+    """
+    Compares encoding and decoding a chat message in the JSON and binary wire formats.
+    """
+
+    cmd = Command()
+    cmd.init_send_message("hello everyone, how is it going?", "General")
+    cmd.creator = "some_user"
+
+    results = []
+    for encoding in ('json', 'binary'):
+        symbols = {}
+        data, refs = cmd.encode(encoding, wire.symbols)
+        for idx in refs:
+            Command(wire.symbols.definition(idx)[4:], symbols)
+
+        start = time.perf_counter()
+        for _ in range(count):
+            cmd.encode(encoding, wire.symbols)
+        encode = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(count):
+            Command(data[4:], symbols)
+        decode = time.perf_counter() - start
+
+        result = {'encoding': encoding, 'frame_bytes': len(data),
+                  'encodes_per_sec': count / encode, 'decodes_per_sec': count / decode}
+        results.append(result)
+        print("{:>6}: {:>3} bytes, {:>9.0f} encodes/s, {:>9.0f} decodes/s".format(
+            encoding, len(data), result['encodes_per_sec'], result['decodes_per_sec']))
+
+    return results
+
+def recv_exactly(sock: socket, length: int):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+def bench_framing(count: int):
+    """
+    Compares reading frames with a header recv and a body recv per frame against the buffered FrameReader.
+    """
+
+    cmd = Command()
+    cmd.init_send_message("hello everyone, how is it going?", "General")
+    cmd.creator = "some_user"
+    stream = cmd.frame() * count
+
+    results = []
+    for reader_name in ('recv_per_frame', 'frame_reader'):
+        sender, receiver = socketpair()
+        writer = Thread(target=sender.sendall, args=(stream,), daemon=True)
+
+        start = time.perf_counter()
+        writer.start()
+
+        frames = 0
+        if reader_name == 'frame_reader':
+            reader = FrameReader(receiver)
+            while frames < count:
+                frames += len(reader.read_frames())
+        else:
+            while frames < count:
+                length, = struct.unpack('!I', recv_exactly(receiver, 4))
+                recv_exactly(receiver, length)
+                frames += 1
+
+        elapsed = time.perf_counter() - start
+        writer.join()
+        sender.close()
+        receiver.close()
+
+        result = {'reader': reader_name, 'frames': count, 'frames_per_sec': count / elapsed}
+        results.append(result)
+        print("{:>14}: {:>10.0f} frames/s".format(reader_name, result['frames_per_sec']))
+
+    return results
+
+def bench_history(messages: int, fetches: int, limit: int):
+    """
+    Measures appending to a chatroom message log and fetching random ranges of history from it.
+    """
+
+    directory = tempfile.mkdtemp()
+    log = MessageLog(directory, segment_bytes=4 * 1024 * 1024, max_segments=1000, fsync='never')
+
+    cmd = Command()
+    cmd.init_send_message("hello everyone, how is it going?", "General")
+    cmd.creator = "some_user"
+    frame = cmd.frame()
+
+    start = time.perf_counter()
+    for _ in range(messages):
+        log.append(frame)
+    append = time.perf_counter() - start
+
+    starts = [random.randrange(messages - limit) for _ in range(fetches)]
+    start = time.perf_counter()
+    for seq in starts:
+        log.read(seq, limit)
+    fetch = time.perf_counter() - start
+
+    log.destroy()
+
+    result = {'messages': messages, 'segments': len(log.segments), 'limit': limit,
+              'appends_per_sec': messages / append, 'fetches_per_sec': fetches / fetch}
+    print("{} messages in {} segments: {:>9.0f} appends/s, {:>7.0f} fetches of {} messages/s".format(
+        messages, result['segments'], result['appends_per_sec'], result['fetches_per_sec'], limit))
+
+    return [result]
+
+def bench_compression(count: int, batch: int):
+    """
+    Compares the bytes sent and the cost of compressing chat messages on their own, on a connection's stream,
+    and on a stream where the writer sends them in batches.
+    """
+
+    frames = []
+    for idx in range(count):
+        cmd = Command()
+        cmd.init_send_message("message {} about the release, is everyone ready for it?".format(idx), "General")
+        cmd.creator = "user{}".format(idx % 50)
+        frames.append(cmd.frame())
+
+    raw = sum(len(frame) for frame in frames)
+    print("{:>7}: {:>9} bytes".format('none', raw))
+
+    results = [{'mode': 'none', 'bytes': raw}]
+    for mode in ('shared', 'stream', 'batched'):
+        deflater = Deflater(threshold=0)
+        inflater = Inflater()
+
+        if mode == 'batched':
+            buffers = [b''.join(frames[idx:idx + batch]) for idx in range(0, count, batch)]
+        else:
+            buffers = frames
+
+        start = time.perf_counter()
+        if mode == 'shared':
+            compressed = [compress_shared(data) for data in buffers]
+        else:
+            compressed = [deflater.compress(data) for data in buffers]
+        elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for data in compressed:
+            inflater.expand([data[4:]])
+        inflate = time.perf_counter() - start
+
+        size = sum(len(data) for data in compressed)
+        result = {'mode': mode, 'bytes': size, 'ratio': size / raw,
+                  'compress_per_sec': count / elapsed, 'inflate_per_sec': count / inflate}
+        results.append(result)
+        print("{:>7}: {:>9} bytes ({:>4.0%}), {:>9.0f} messages compressed/s, {:>9.0f} inflated/s".format(
+            mode, size, result['ratio'], result['compress_per_sec'], result['inflate_per_sec']))
+
+    return results
+
+def bench_federation(node_counts: list, clients: int, rooms: int, rate: float, duration: float, server_args: str, port: int):
+    """
+    Aggregate throughput as nodes are added. For every node count the load generator starts a fresh federation
+    of that many server processes on this machine and spreads its clients over them, one node is a plain server.
+    """
+
+    loadgen = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'loadgen.py')
+
+    results = []
+    for nodes in node_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'result.json')
+            subprocess.run([sys.executable, loadgen, '--host', '127.0.0.1', '--port', str(port), '--nodes', str(nodes),
+                            '--clients', str(clients), '--rooms', str(rooms), '--rate', str(rate), '--duration', str(duration),
+                            '--spawn=' + server_args, '--output', output], check=True, stdout=subprocess.DEVNULL)
+            with open(output) as f:
+                result = json.load(f)
+
+        result['nodes'] = nodes
+        results.append(result)
+        print("{:>3} nodes: {:>8.0f} msg/s sent, {:>9.0f} deliveries/s, p99 {:>7.2f} ms, {:>5.2f} server cores".format(
+            nodes, result['messages_per_sec'], result['deliveries_per_sec'], result['latency_ms']['p99'] or 0,
+            result['server']['cpu_cores']))
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Chappie micro-benchmarks")
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    broadcast = subparsers.add_parser('broadcast', help="broadcast cost as the room size grows")
+    broadcast.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 500, 2000])
+    broadcast.add_argument('--messages', type=int, default=50)
+
+    encoding = subparsers.add_parser('encoding', help="JSON against binary command encoding")
+    encoding.add_argument('--count', type=int, default=100000)
+
+    framing = subparsers.add_parser('framing', help="frame reading throughput")
+    framing.add_argument('--count', type=int, default=200000)
+
+    history = subparsers.add_parser('history', help="message log appends and history fetches")
+    history.add_argument('--messages', type=int, default=500000)
+    history.add_argument('--fetches', type=int, default=10000)
+    history.add_argument('--limit', type=int, default=50)
+
+    compression = subparsers.add_parser('compression', help="zlib compression of chat messages")
+    compression.add_argument('--count', type=int, default=100000)
+    compression.add_argument('--batch', type=int, default=16)
+
+    federation = subparsers.add_parser('federation', help="aggregate throughput of local federations of increasing size")
+    federation.add_argument('--nodes', type=int, nargs='+', default=[1, 2, 4])
+    federation.add_argument('--clients', type=int, default=400)
+    federation.add_argument('--rooms', type=int, default=20)
+    federation.add_argument('--rate', type=float, default=2.0, help="messages per second sent by each client")
+    federation.add_argument('--duration', type=float, default=10)
+    federation.add_argument('--server-args', default='', help="extra server.py arguments for every node")
+    federation.add_argument('--port', type=int, default=8600, help="first client port, the nodes use the ports after it")
+
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.bench == 'broadcast':
+        results = bench_broadcast(args.sizes, args.messages)
+    elif args.bench == 'encoding':
+        results = bench_encoding(args.count)
+    elif args.bench == 'framing':
+        results = bench_framing(args.count)
+    elif args.bench == 'history':
+        results = bench_history(args.messages, args.fetches, args.limit)
+    elif args.bench == 'compression':
+        results = bench_compression(args.count, args.batch)
+    elif args.bench == 'federation':
+        results = bench_federation(args.nodes, args.clients, args.rooms, args.rate, args.duration, args.server_args, args.port)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'bench': args.bench, 'results': results}, f, indent=2)
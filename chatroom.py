@@ -1,30 +1,225 @@
+from socket import socket
+from threading import Lock
+from collections import deque
+from concurrent.futures import Executor
+import struct
+
 from user import User
 from command import Command
+import wire
+from logger import log
 
 class Chatroom:
-    def __init__(self, name: str, owner: User, default=False):
+    # Mailbox items a room handles before giving other rooms a turn on a shared executor
+    turn_limit = 256
+
+    # Most missed messages sent to a user who resumed its session, the latest ones if it missed more
+    resume_limit = 500
+
+    def __init__(self, name: str, owner: User, default=False, executor: Executor=None):
+        """
+        A chatroom owns its members and blocklist. All work on them goes through the room's mailbox and
+        is handled one item at a time, so only one thread ever touches them while different rooms run in parallel.
+        Without an executor the mailbox is handled by the thread that posts to it, as on an event loop.
+        """
+
         self.name = name
         self.owner = owner
         self.default = default
         self.users = {}
         self.blocked = {}
 
+        # The room's MessageLog and scrollback Ring, None when they are not kept
+        self.log = None
+        self.recent = None
+
+        # The number the next chat message gets, the same numbering as the log and the ring
+        self.next_seq = 0
+
+        # The server's Metrics, broadcast sizes are recorded there
+        self.metrics = None
+
+        self.mailbox = deque()
+        self.mailbox_lock = Lock()
+        self.scheduled = False
+        self.executor = executor
+
+    def post(self, fn, *args):
+        """
+        Queues fn(*args) to run in the room, after everything queued before it.
+        """
+
+        with self.mailbox_lock:
+            self.mailbox.append((fn, args))
+            if self.scheduled:
+                return
+            self.scheduled = True
+
+        if self.executor is None:
+            self.process()
+        else:
+            self.executor.submit(self.process)
+
+    def process(self):
+        """
+        Handles queued work until the mailbox is empty or the room has had its turn.
+        """
+
+        handled = 0
+        while True:
+            with self.mailbox_lock:
+                if not self.mailbox:
+                    self.scheduled = False
+                    return
+
+                if self.executor is not None and handled >= self.turn_limit:
+                    self.executor.submit(self.process)
+                    return
+
+                fn, args = self.mailbox.popleft()
+
+            handled += 1
+            try:
+                fn(*args)
+            except Exception as e:
+                log.error('room', 'mailbox item failed', room=self.name, handler=fn.__name__, error=repr(e))
+
     def add_user(self, user: User):
-        self.users[user.alias] = user
+        self.post(self.on_add_user, user)
 
     def rem_user(self, user: User):
-        self.users.pop(user.alias, None)
+        self.post(self.on_rem_user, user)
 
     def block_user(self, user: User):
-        self.blocked[user.alias] = user
+        self.post(self.on_block_user, user)
 
     def unblock_user(self, user: User):
-        self.blocked.pop(user.alias, None)
+        self.post(self.on_unblock_user, user)
 
     def send_all(self, cmd: Command):
-        for user in list(self.users):
+        self.post(self.on_send_all, cmd)
+
+    def replay(self, sock: socket):
+        self.post(self.on_replay, sock)
+
+    def bootstrap(self, sock: socket, user: User, chatrooms: list):
+        self.post(self.on_bootstrap, sock, user, chatrooms)
+
+    def resume(self, sock: socket, user: User, last_seq: int):
+        self.post(self.on_resume, sock, user, last_seq)
+
+    def on_add_user(self, user: User):
+        self.users[user.alias] = user
+
+    def on_rem_user(self, user: User):
+        self.users.pop(user.alias, None)
+
+    def on_block_user(self, user: User):
+        self.blocked[user.alias] = user
+
+    def on_unblock_user(self, user: User):
+        self.blocked.pop(user.alias, None)
+
+    def on_send_all(self, cmd: Command):
+        # Serialize once per encoding, every member gets the same bytes
+        frames = {}
+
+        if cmd.type == 'message':
+            cmd.seq = self.next_seq
+            self.next_seq += 1
+
+        # Messages are logged and buffered as their JSON frame, which JSON members then get as is
+        if cmd.type == 'message' and (self.log is not None or self.recent is not None):
+            frames['json'] = cmd.encode()
+            if self.log is not None:
+                self.log.append(frames['json'][0])
+            if self.recent is not None:
+                self.recent.append(frames['json'][0])
+
+        if self.metrics is not None:
+            self.metrics.observe('chappie_fanout_recipients', len(self.users))
+
+        # Members whose connection failed are removed by the server once their reader stops
+        for user in self.users.values():
             try:
-                cmd.send(self.users[user].socket)
-            except:
-                print("{} lost connection".format(self.users[user].alias))
-                self.users.pop(user, None)
+                cmd.send(user.socket, frames)
+            except ConnectionError:
+                pass
+
+    def on_replay(self, sock: socket):
+        """
+        Sends the buffered recent messages to a user who just joined.
+        """
+
+        if self.recent is None:
+            return
+
+        start, end, data = self.recent.snapshot()
+        if data:
+            self.send_history(sock, start, end, data)
+
+    def on_bootstrap(self, sock: socket, user: User, chatrooms: list):
+        """
+        Sends a user whose alias was just accepted the chatrooms, the other members and the recent messages, in one frame.
+        Read in the room so the members agree with the joins and leaves the user is sent after it.
+        """
+
+        bootstrapCmd = Command()
+        bootstrapCmd.init_bootstrap(self.name, chatrooms, [alias for alias in self.users if alias != user.alias])
+        data = bootstrapCmd.frame()
+
+        if self.recent is not None:
+            start, end, recent = self.recent.snapshot()
+            if recent:
+                rangeCmd = Command()
+                rangeCmd.init_history_range(self.name, start, end)
+                data += rangeCmd.frame() + recent
+
+        self.send_frames(sock, data)
+
+    def on_resume(self, sock: socket, user: User, last_seq: int):
+        """
+        Moves a user who resumed its session over to its new connection and sends it the messages after last_seq,
+        all of them without a last_seq. Done in the room, so every message is either among the missed ones or
+        sent to the new connection. They come from the scrollback if it goes back far enough, otherwise from the log.
+        """
+
+        user.socket = sock
+
+        start = self.next_seq - self.resume_limit
+        if last_seq is not None:
+            start = max(start, last_seq + 1)
+        if start >= self.next_seq:
+            return
+
+        if self.recent is not None and (self.log is None or self.recent.first_seq <= start):
+            start, end, data = self.recent.since(start)
+        elif self.log is not None:
+            start, end, data = self.log.read(start, self.next_seq - start)
+        else:
+            return
+
+        if data:
+            self.send_history(sock, start, end, data)
+
+    def send_history(self, sock: socket, start: int, end: int, data: bytes):
+        """
+        Sends a range of message frames after a history command announcing it, in a single write.
+        """
+
+        rangeCmd = Command()
+        rangeCmd.init_history_range(self.name, start, end)
+        self.send_frames(sock, rangeCmd.frame() + data)
+
+    def send_frames(self, sock: socket, data: bytes):
+        """
+        Sends consecutive frames in one batch for clients that support batches and back to back otherwise.
+        """
+
+        if sock.batching:
+            data = struct.pack('!I', len(data) + 2) + wire.pack_batch([data])
+
+        try:
+            sock.sendall(data)
+        except ConnectionError:
+            pass
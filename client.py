@@ -1,16 +1,21 @@
 from socket import *
 from threading import Thread
 import sys
-import struct
+import time
 
 # Custom Modules
 from command import Command
+from framing import FrameReader
+from compression import Deflater
 import util
+import wire
 
 class Client:
-    def __init__(self):
+    def __init__(self, handler=None):
         """
         The class that contains client related functionality.
+        Received commands are passed to handler on the listening thread, or printed when there is none,
+        so the client can run on its own from the command line or inside another program such as the GUI.
         """
 
         # Needs to be changed if you want the client to connect to a different machine
@@ -19,24 +24,86 @@ class Client:
         self.tcp_backlog = 5
         self.host_sock = socket()
         self.username = None
+        self.handler = handler
+
+        # Wire encoding agreed with the server and the names it has interned for us
+        self.encoding = 'json'
+        self.symbols = {}
+
+        # Compresses what we send once the server accepts zlib, it inflates whatever it sends us on its own
+        self.deflater = None
+
+        # Resumes the session after a lost connection: the server's token and the last message number seen per chatroom
+        self.token = None
+        self.seqs = {}
+        self.resuming = False
 
     def listen(self):
         """
         Listens for new traffic from the server socket.
         """
 
-        while True:
-            lengthbuf = self.host_sock.recv(4)
-            length, = struct.unpack('!I', lengthbuf)
-            data = self.host_sock.recv(length)
+        reader = FrameReader(self.host_sock)
 
-            cmd = Command(data)
-            self.execute_command(cmd)
+        while True:
+            try:
+                frames = reader.read_frames()
+            except OSError:
+                if self.resume():
+                    reader = FrameReader(self.host_sock)
+                    continue
+
+                lostCmd = Command()
+                lostCmd.init_error("Lost connection to the server.")
+                self.execute_command(lostCmd)
+                return
+
+            for data in frames:
+                # Batches are unpacked here so the rest of the client only sees single commands
+                for cmd in Command(data, self.symbols).commands():
+                    # Interned name definitions are only needed to decode later frames
+                    if cmd.type == wire.INTERN_TYPE:
+                        continue
+
+                    # The server pings clients that have been quiet, answering keeps the connection open
+                    if cmd.type == 'ping':
+                        pongCmd = Command()
+                        pongCmd.init_pong()
+                        self.send(pongCmd)
+                        continue
+
+                    # Kept to resume the session with, the server accepted our alias
+                    if cmd.type == 'session':
+                        self.token = cmd.body
+                        continue
+
+                    if cmd.type == 'message' and cmd.seq is not None:
+                        self.seqs[cmd.specificChatroom] = max(cmd.seq, self.seqs.get(cmd.specificChatroom, -1))
+
+                    # Either the session carried over, or it expired and the error says so
+                    if self.resuming and cmd.type in ('resume', 'error'):
+                        self.resuming = False
+                        if cmd.type == 'error':
+                            self.token = None
+
+                    # The server replies to our offer with the features to use from now on
+                    if cmd.type == 'connect' and isinstance(cmd.body, list):
+                        if 'binary' in cmd.body:
+                            self.encoding = 'binary'
+                        if 'zlib' in cmd.body:
+                            self.deflater = Deflater()
+
+                    self.execute_command(cmd)
 
     def execute_command(self, cmd: Command):
         """
         Executes a given command and performs an action depending on the command type.
         """
+
+        if self.handler is not None:
+            self.handler(cmd)
+            return
+
         print(cmd.stringify())
         sys.stdout.flush()
 
@@ -52,27 +119,80 @@ class Client:
         # Initialize command object
         try:
             cmd = Command(raw_input)
-            cmd.send(self.host_sock)
+            self.send(cmd)
         except:
             print("\"{}\" is not a valid command.".format(raw_input.split()[0]))
             sys.stdout.flush()
 
+    def send(self, cmd: Command):
+        """
+        Sends a command to the server in the negotiated encoding, compressed if that was negotiated too.
+        """
+
+        # Leaving on purpose ends the session, losing the connection afterwards must not resume it
+        if cmd.type == 'disconnect':
+            self.token = None
+
+        data = cmd.frame(self.encoding)
+        if self.deflater is not None:
+            data = self.deflater.compress(data)
+
+        self.host_sock.sendall(data)
+
+    def resume(self, attempts=5):
+        """
+        Connects again after the connection was lost and resumes the session, so the alias, the chatrooms and
+        the messages sent in the meantime carry over. Returns False without a session or if the server cannot be reached.
+        """
+
+        if self.token is None:
+            return False
+
+        for attempt in range(attempts):
+            # Wait a little longer after every failed attempt
+            time.sleep(0.25 * 2 ** attempt)
+
+            self.host_sock = socket()
+            self.encoding = 'json'
+            self.symbols = {}
+            self.deflater = None
+
+            try:
+                self.host_sock.connect(self.host_address)
+
+                cmd = Command()
+                cmd.init_connect(list(wire.FEATURES))
+                self.send(cmd)
+
+                cmd = Command()
+                cmd.init_resume(self.token, dict(self.seqs))
+                self.send(cmd)
+            except OSError:
+                self.host_sock.close()
+                continue
+
+            self.resuming = True
+            return True
+
+        return False
+
     def start(self, cmdline=False):
         """
         Starts the client by connecting to the server then awaits commands.
+        Without cmdline it returns once connected, and the listening thread ends with the caller's program.
         """
 
         # Connects to the server and begin listening for traffic
         self.host_sock.connect(self.host_address)
-        Thread(target=self.listen).start()
+        Thread(target=self.listen, daemon=not cmdline).start()
 
         # Prompt the user to provide an alias. Seperate so that the first message gets sent as a full line which will be picked up by the client gui
         #print("Starting Connection ... ")
 
-        # Send a connection request to the server and sets the current user
+        # Send a connection request to the server, offering every wire feature we support
         cmd = Command()
-        cmd.init_connect()
-        cmd.send(self.host_sock)
+        cmd.init_connect(list(wire.FEATURES))
+        self.send(cmd)
 
         if cmdline:
             # Continually parse input from the user
@@ -1,25 +1,180 @@
 import tkinter as tk
 import tkinter.font as tkFont
-from threading import Thread
-from subprocess import Popen, PIPE
+from queue import Queue, Empty
+from collections import deque
+from bisect import bisect_left, insort
+import argparse
 
 from command import Command
+from client import Client
 import util
 
 alias_count = 0
 
+class UserList:
+    def __init__(self, listbox: tk.Listbox, scrollbar: tk.Scrollbar):
+        """
+        The members of the current chatroom, kept sorted so a user's row is found with a binary search.
+        Joins and leaves are collected and applied together once per frame, and the listbox only ever
+        holds the rows that are visible, so rooms with tens of thousands of users stay responsive.
+        """
+
+        self.listbox = listbox
+        self.scrollbar = scrollbar
+        self.aliases = []
+        self.members = set()
+
+        # Changes to members not yet applied to the sorted aliases
+        self.added = set()
+        self.removed = set()
+
+        # The first visible row, the aliases shown in the listbox and the one the user selected
+        self.top = 0
+        self.rows = []
+        self.selected = None
+        self.dirty = False
+
+        self.scrollbar.configure(command=self.scroll)
+        self.listbox.bind('<<ListboxSelect>>', self.select)
+        self.listbox.bind('<MouseWheel>', lambda event: self.scroll('scroll', -1 if event.delta > 0 else 1, 'units'))
+        self.listbox.bind('<Button-4>', lambda event: self.scroll('scroll', -1, 'units'))
+        self.listbox.bind('<Button-5>', lambda event: self.scroll('scroll', 1, 'units'))
+
+    @property
+    def height(self):
+        return int(self.listbox['height'])
+
+    def add(self, alias: str):
+        if alias in self.members:
+            return
+
+        self.members.add(alias)
+        if alias in self.removed:
+            self.removed.discard(alias)
+        else:
+            self.added.add(alias)
+
+    def add_many(self, aliases: list):
+        for alias in aliases:
+            self.add(alias)
+
+    def remove(self, alias: str):
+        if alias not in self.members:
+            return
+
+        self.members.discard(alias)
+        if alias in self.added:
+            self.added.discard(alias)
+        else:
+            self.removed.add(alias)
+
+    def clear(self):
+        self.aliases = []
+        self.members.clear()
+        self.added.clear()
+        self.removed.clear()
+        self.top = 0
+        self.selected = None
+        self.dirty = True
+
+    def apply(self):
+        """
+        Applies the collected changes to the sorted aliases, re-sorting everything when that is cheaper.
+        """
+
+        if not self.added and not self.removed:
+            return
+
+        if len(self.added) + len(self.removed) > len(self.aliases) // 8:
+            self.aliases = sorted(self.members)
+        else:
+            for alias in self.removed:
+                del self.aliases[bisect_left(self.aliases, alias)]
+            for alias in self.added:
+                insort(self.aliases, alias)
+
+        self.added.clear()
+        self.removed.clear()
+        self.dirty = True
+
+    def render(self):
+        """
+        Shows the visible window of the list, called once per frame.
+        """
+
+        self.apply()
+        if not self.dirty:
+            return
+
+        height = self.height
+        self.top = max(0, min(self.top, len(self.aliases) - height))
+        self.rows = self.aliases[self.top:self.top + height]
+
+        self.listbox.delete(0, 'end')
+        if self.rows:
+            self.listbox.insert('end', *self.rows)
+        if self.selected in self.rows:
+            self.listbox.selection_set(self.rows.index(self.selected))
+
+        if self.aliases:
+            self.scrollbar.set(self.top / len(self.aliases), (self.top + len(self.rows)) / len(self.aliases))
+        else:
+            self.scrollbar.set(0, 1)
+
+        self.dirty = False
+
+    def scroll(self, action: str, amount, unit: str=None):
+        """
+        Moves the visible window, takes the arguments a scrollbar passes to its command.
+        """
+
+        if action == 'moveto':
+            self.top = int(float(amount) * len(self.aliases))
+        elif unit == 'pages':
+            self.top += int(amount) * self.height
+        else:
+            self.top += int(amount)
+
+        self.dirty = True
+        self.render()
+
+    def select(self, event):
+        selection = self.listbox.curselection()
+        if selection and selection[0] < len(self.rows):
+            self.selected = self.rows[selection[0]]
+
+    def selected_alias(self):
+        return self.selected if self.selected in self.members else None
+
 class ClientGUI(tk.Frame):
-    def __init__(self, client: Popen):
+    # Milliseconds between frames, each frame handles the received commands and draws the new text
+    frame_interval = 33
+
+    # Received commands handled in one frame, the rest wait for the next so the window stays responsive
+    commands_per_frame = 2000
+
+    def __init__(self, client: Client, inbox: Queue, max_lines=1000):
         """
         Initialize the client GUI.
+        The client runs in this process and puts every command it receives in the inbox,
+        which is drained on the Tk thread since Tk must only be used from there.
+        The message box keeps the last max_lines lines.
         """
 
         # Client specific properties
         self.client = client
+        self.inbox = inbox
+        self.max_lines = max_lines
+
+        # Text waiting for the next frame, a flood never queues more than the message box would keep
+        self.pending_text = deque(maxlen=max_lines)
         self.chatroom = None
         self.alias = None
         self.lst_all_chatrooms = []
 
+        # Whether the server sends a bootstrap after our alias is accepted, otherwise we ask for rooms and members ourselves
+        self.bootstrap = False
+
         # Initialize Tkinter GUI
         self.master = tk.Tk()
         super().__init__(self.master)
@@ -37,6 +192,9 @@ class ClientGUI(tk.Frame):
         # Alias Popup
         self.alias_popup_wnd()
 
+        # Start handling received commands
+        self.master.after(self.frame_interval, self.poll_client)
+
     def initialize_window(self):
         """
         Initialize the window of the chat application.
@@ -106,13 +264,9 @@ class ClientGUI(tk.Frame):
             self.btn_general_chatroom
         ]
 
-        # Add it to the list of chatrooms
+        # Add it to the list of chatrooms, the others arrive once the server has answered our connect
         self.lst_all_chatrooms.append(self.btn_general_chatroom['text'])
 
-        # Get the list of chatrooms, create a button for each not currently a button
-        cmd_get_chatrooms = '/get_chatrooms'
-        self.send_to_client(cmd_get_chatrooms)
-
         self.update()
 
     def initialize_messages(self):
@@ -164,9 +318,10 @@ class ClientGUI(tk.Frame):
         self.lst_box_users = tk.Listbox(self.frm_users, bd=0)
         self.lst_box_users.grid(row=1, column=0)
 
-        scrollbar = tk.Scrollbar(self.frm_users, command=self.lst_box_users.yview)
+        # The listbox only holds the visible rows, the scrollbar moves through the whole list
+        scrollbar = tk.Scrollbar(self.frm_users)
         scrollbar.grid(row=1, column=0, sticky='nse', pady=2, padx=(0, 0))
-        self.lst_box_users['yscrollcommand'] = scrollbar.set
+        self.users = UserList(self.lst_box_users, scrollbar)
 
     def btn_chatroom_click(self, btn_chatroom):
         """
@@ -374,34 +529,55 @@ class ClientGUI(tk.Frame):
         self.update()
 
     def add_user(self, alias):
-        if not self.index_of_user(alias):
-            self.lst_box_users.insert('end', alias)
+        self.users.add(alias)
 
-    def remove_user(self, alias):
-        idx = self.index_of_user(alias)
-        self.lst_box_users.delete(idx, idx)
+    def add_users(self, aliases: list):
+        """
+        Adds many users to the user list, they are shown together on the next frame.
+        """
 
-    def index_of_user(self, alias):
-        for idx, listAlias in enumerate(self.lst_box_users.get(0, 'end')):
-            if listAlias == alias:
-                return idx
-        return None
+        self.users.add_many(aliases)
+
+    def remove_user(self, alias):
+        self.users.remove(alias)
 
     def get_current_selected_user(self):
-        idx = self.lst_box_users.curselection()
-        if idx:
-            return self.lst_box_users.get(idx, idx)[0]  # Returns a tuple so we take the first one
-        else:
-            return None
+        return self.users.selected_alias()
 
     def insert_text(self, text):
+        """
+        Queues text for the message box, it is drawn together with everything else queued on the next frame.
+        """
+
+        self.pending_text.append(text)
+
+    def render(self):
         """
         Allows only the code to update the text message box.
+        Draws the queued text with a single insert and trims the oldest lines beyond max_lines.
         """
 
+        if not self.pending_text:
+            return
+
+        # Only follow new messages if the user has not scrolled up to read older ones
+        follow = self.txt_messages.yview()[1] >= 1.0
+
+        text = ''.join(self.pending_text)
+        self.pending_text.clear()
+
         self.txt_messages.configure(state=tk.NORMAL)
         self.txt_messages.insert('end', text)
+
+        # The widget always ends in a newline of its own, so the last line number is one past our lines
+        lines = int(self.txt_messages.index('end-1c').split('.')[0]) - 1
+        if lines > self.max_lines:
+            self.txt_messages.delete('1.0', '{}.0'.format(lines - self.max_lines + 1))
+
         self.txt_messages.configure(state=tk.DISABLED)
+
+        if follow:
+            self.txt_messages.see('end')
         
     def txt_alias_return(self, alias, window):
         """
@@ -447,7 +623,7 @@ class ClientGUI(tk.Frame):
 
     def send_to_client(self, body: str):
         """
-        Sends data back to the client process.
+        Turns a line of input into a command and sends it to the server.
         """
         global alias_count
 
@@ -490,30 +666,38 @@ class ClientGUI(tk.Frame):
             cmd.init_block_user(cmd_body)
         elif cmd_name == '/unblock':
             cmd.init_unblock_user(cmd_body)
+        elif cmd_name == '/history':
+            cmd.init_history(self.chatroom, None, int(cmd_body) if cmd_body.isdigit() else 50)
+        elif cmd_name == '/stats':
+            cmd.init_stats()
         else:
             line = "\"{}\" is not a valid command.".format(cmd_name)
             print(line)
             self.insert_text("{}\n".format(line))
             return
 
-        self.client.stdin.write("{}\n".format(cmd.stringify()).encode())
-        self.client.stdin.flush()
-
-        print(cmd.stringify().encode())
+        try:
+            self.client.send(cmd)
+        except OSError:
+            self.insert_text("Error: Not connected to the server.\n")
 
-    def handle_data(self):
+    def poll_client(self):
         """
-        Handles data from the client process' stdout.
+        Handles the commands received since the last frame and draws the result, on the Tk thread.
         """
 
-        while True:
-            line = client.stdout.readline()
-            received = line.decode("utf-8").strip()
-            print('Receiving: ' + received)
+        for _ in range(self.commands_per_frame):
+            try:
+                cmd = self.inbox.get_nowait()
+            except Empty:
+                break
 
-            cmd = Command(received)
             self.handle_command(cmd)
 
+        self.render()
+        self.users.render()
+        self.master.after(self.frame_interval, self.poll_client)
+
     def handle_command(self, cmd: Command):
         global alias_count
         line = None
@@ -523,6 +707,12 @@ class ClientGUI(tk.Frame):
 
         elif cmd.type == 'connect':
             line = "Connection Successful!\n"
+            self.bootstrap = isinstance(cmd.body, list) and 'bootstrap' in cmd.body
+
+            # Get the list of chatrooms, create a button for each not currently a button
+            if not self.bootstrap:
+                cmd_get_chatrooms = '/get_chatrooms'
+                self.send_to_client(cmd_get_chatrooms)
 
         elif cmd.type == 'alias':
             if cmd.creator == self.alias:
@@ -530,9 +720,10 @@ class ClientGUI(tk.Frame):
                 line = "Alias '{}' confirmed! ".format(cmd.creator)
                 alias_count = 1
 
-                # Send list user command
-                ls_cmd = '/list_users {}'.format(util.defaultChatroom)
-                self.send_to_client(ls_cmd)
+                # Send list user command, unless the bootstrap that follows has the users
+                if not self.bootstrap:
+                    ls_cmd = '/list_users {}'.format(util.defaultChatroom)
+                    self.send_to_client(ls_cmd)
             else:
                 line = "'{}' joined Chat. ".format(cmd.creator)
 
@@ -550,7 +741,7 @@ class ClientGUI(tk.Frame):
                 self.btn_set_active(cmd.body)
 
                 # Remove list of current users
-                self.lst_box_users.delete(0, 'end')
+                self.users.clear()
 
                 # Add ourselves
                 self.add_user(self.alias)
@@ -580,6 +771,38 @@ class ClientGUI(tk.Frame):
         elif cmd.type == 'error':
             line = "Error: {}".format(cmd.body)
 
+            # Reconnecting did not bring our session back, so the alias is gone and /set_alias has to work again
+            if cmd.body == util.sessionExpired:
+                alias_count = 0
+
+        elif cmd.type == 'list_users':
+            # A page of the members of a chatroom, ignored if we have moved on since asking
+            if cmd.specificChatroom == self.chatroom:
+                self.add_users(cmd.body)
+
+        elif cmd.type == 'bootstrap':
+            # The chatrooms and the members of our room in one go, its recent messages follow as a history range
+            for chatroom in cmd.body['chatrooms']:
+                if chatroom not in self.lst_all_chatrooms:
+                    self.create_chatroom_btn(chatroom)
+
+            if cmd.specificChatroom == self.chatroom:
+                self.add_users(cmd.body['users'])
+
+        elif cmd.type == 'resume':
+            # The client reconnected on its own, the messages we missed follow as a history range
+            line = "Reconnected as {}.".format(cmd.creator)
+
+        elif cmd.type == 'history':
+            # The logged messages follow this range as ordinary message commands
+            if cmd.body['end'] > cmd.body['start']:
+                line = "Last {} messages in {}:".format(cmd.body['end'] - cmd.body['start'], cmd.specificChatroom)
+            else:
+                line = "No messages in {} yet.".format(cmd.specificChatroom)
+
+        elif cmd.type == 'stats':
+            line = cmd.body
+
         elif cmd.type == 'get_chatrooms':
             for chatroom in cmd.body:
                 if chatroom not in self.lst_all_chatrooms:
@@ -604,15 +827,17 @@ class ClientGUI(tk.Frame):
             self.insert_text("{}\n".format(line))
         
 if __name__ == '__main__':
-    # Start the client
-    client = Popen(['python', 'client.py'], stdout=PIPE, stdin=PIPE, stderr=PIPE, shell=False)
+    parser = argparse.ArgumentParser(description="Chappie chat client")
+    parser.add_argument('--scrollback', type=int, default=1000, help="number of lines the message box keeps")
+    args = parser.parse_args()
 
-    # Initilize the GUI
-    application = ClientGUI(client)
+    # Start the client, it hands received commands to the GUI through the inbox
+    inbox = Queue()
+    client = Client(inbox.put)
+    client.start()
 
-    # Start the thread which handles new data from the client
-    clientHandler = Thread(target=application.handle_data)
-    clientHandler.start()
+    # Initilize the GUI
+    application = ClientGUI(client, inbox, args.scrollback)
 
     # Start the GUI mainloop
     application.mainloop()
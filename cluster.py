@@ -0,0 +1,281 @@
+from socket import *
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import struct
+import tempfile
+
+# Custom Modules
+from command import Command
+from messagelog import LogStore
+from scrollback import Scrollback
+from ratelimit import FloodControl
+from heartbeat import Heartbeat
+from metrics import serve_metrics
+from logger import log
+from server import Server
+
+def pack_frame(envelope: dict):
+    """
+    Frames an envelope the same way commands are framed on the wire.
+    """
+
+    data = json.dumps(envelope).encode(encoding='UTF-8')
+    return struct.pack('!I', len(data)) + data
+
+async def read_frame(reader: asyncio.StreamReader):
+    """
+    Reads one length prefixed frame, header included.
+    """
+
+    header = await reader.readexactly(4)
+    length, = struct.unpack('!I', header)
+    return header + await reader.readexactly(length)
+
+class RemotePeer:
+    def __init__(self, worker: int, conn: int):
+        """
+        Stands in for a client socket owned by another worker. That worker does the real sending.
+        """
+
+        self.worker = worker
+        self.conn = conn
+        self.encoding = 'json'
+        self.batching = False
+        self.deflater = None
+        self.symbols = set()
+        self.bootstrap = False
+        self.resumable = False
+
+    def sendall(self, data: bytes, ephemeral=False):
+        pass
+
+    def close(self):
+        pass
+
+class Bus:
+    def __init__(self, listener: socket, workers: int):
+        """
+        The local IPC bus. Every frame published by a worker is relayed to all workers, the sender included,
+        in a single order so that each worker applies the same state changes in the same sequence.
+        """
+
+        self.listener = listener
+        self.workers = workers
+        self.writers = {}
+
+    async def serve(self):
+        """
+        Relays frames between workers until stopped.
+        """
+
+        server = await asyncio.start_unix_server(self.handle_worker, sock=self.listener)
+        async with server:
+            await server.serve_forever()
+
+    def publish(self, frame: bytes):
+        for writer in list(self.writers.values()):
+            writer.write(frame)
+
+    async def handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Handles one worker connection, the first frame it sends is its hello.
+        """
+
+        hello = json.loads((await read_frame(reader))[4:])
+        worker = hello['worker']
+        self.writers[worker] = writer
+
+        # Workers only start accepting clients once every worker is on the bus, so no one misses a state change
+        if len(self.writers) == self.workers:
+            self.publish(pack_frame({'kind': 'ready'}))
+
+        try:
+            while True:
+                self.publish(await read_frame(reader))
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # Cancelled when the bus shuts down
+            pass
+        finally:
+            self.writers.pop(worker, None)
+            writer.close()
+
+            # Let the remaining workers forget about the clients of the lost worker
+            self.publish(pack_frame({'kind': 'worker_lost', 'worker': worker}))
+
+class ShardedServer(Server):
+    def __init__(self, worker: int, bus_path: str, log_store: LogStore=None, scrollback: Scrollback=None, flood: FloodControl=None,
+                 heartbeat: Heartbeat=None, **connection_options):
+        """
+        A server worker that shares the listening port with its siblings and keeps a replica of the
+        room and alias registries, kept in sync through the bus.
+        """
+
+        super().__init__('async', log_store, scrollback, flood, heartbeat, **connection_options)
+        self.listener.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        self.worker = worker
+        self.bus_path = bus_path
+        self.bus_writer = None
+        self.conn_ids = itertools.count()
+        self.local_ids = {}
+        self.local_conns = {}
+        self.peers = {}
+
+    async def listen_async(self):
+        """
+        Joins the bus, waits for the other workers and then starts accepting clients.
+        """
+
+        reader, self.bus_writer = await asyncio.open_unix_connection(self.bus_path)
+        self.bus_writer.write(pack_frame({'kind': 'hello', 'worker': self.worker}))
+
+        # Wait until every worker is on the bus
+        while json.loads((await read_frame(reader))[4:])['kind'] != 'ready':
+            pass
+
+        asyncio.get_running_loop().create_task(self.read_bus(reader))
+        await super().listen_async()
+
+    async def read_bus(self, reader: asyncio.StreamReader):
+        """
+        Applies every frame relayed by the bus.
+        """
+
+        try:
+            while True:
+                self.apply(json.loads((await read_frame(reader))[4:]))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # Without the bus the replica can no longer be kept in sync, so the worker stops
+            log.error('server', 'lost the bus, exiting', worker=self.worker)
+            log.flush()
+            os._exit(1)
+
+    def apply(self, envelope: dict):
+        """
+        Applies a state change published by any worker, including this one.
+        """
+
+        if envelope['kind'] == 'worker_lost':
+            keys = [key for key in self.peers if key[0] == envelope['worker']]
+            Server.drop_clients(self, [self.peers.pop(key) for key in keys])
+            return
+
+        if envelope['kind'] == 'drop':
+            socks = []
+            for conn in envelope['conns']:
+                sock = self.resolve(envelope['worker'], conn)
+                self.forget(envelope['worker'], conn)
+                if sock is not None:
+                    socks.append(sock)
+            Server.drop_clients(self, socks)
+            return
+
+        sock = self.resolve(envelope['worker'], envelope['conn'])
+        if sock is not None:
+            Server.execute_command(self, Command(envelope['cmd']), tuple(envelope['address']), sock)
+
+    def resolve(self, worker: int, conn: int):
+        """
+        Returns the socket that stands for a connection, a real one if it belongs to this worker.
+        """
+
+        if worker == self.worker:
+            return self.local_conns.get(conn, None)
+
+        peer = self.peers.get((worker, conn), None)
+        if peer is None:
+            peer = RemotePeer(worker, conn)
+            self.peers[(worker, conn)] = peer
+
+        return peer
+
+    def forget(self, worker: int, conn: int):
+        if worker == self.worker:
+            sock = self.local_conns.pop(conn, None)
+            self.local_ids.pop(sock, None)
+        else:
+            self.peers.pop((worker, conn), None)
+
+    def local_id(self, sock):
+        conn = self.local_ids.get(sock, None)
+        if conn is None:
+            conn = next(self.conn_ids)
+            self.local_ids[sock] = conn
+            self.local_conns[conn] = sock
+
+        return conn
+
+    def execute_command(self, cmd: Command, origin_address: (str, int), sock):
+        """
+        Runs read only commands locally and publishes everything else on the bus.
+        """
+
+        # Handlers marked local only read state or only concern the sender, these never go over the bus
+        handler = self.handlers.get(cmd.type, None)
+        if handler is None or handler.local:
+            super().execute_command(cmd, origin_address, sock)
+            return
+
+        self.bus_writer.write(pack_frame({'kind': 'command', 'worker': self.worker, 'conn': self.local_id(sock),
+                                          'address': list(origin_address), 'cmd': cmd.stringify()}))
+
+    def drop_clients(self, client_socks: list):
+        """
+        Closes the connections now and lets every worker remove the users in bus order, in one envelope.
+        """
+
+        conns = []
+        for client_sock in client_socks:
+            client_sock.close()
+            if self.heartbeat is not None:
+                self.heartbeat.forget(client_sock)
+
+            conn = self.local_ids.get(client_sock, None)
+            if conn is not None:
+                conns.append(conn)
+
+        if conns:
+            self.bus_writer.write(pack_frame({'kind': 'drop', 'worker': self.worker, 'conns': conns}))
+
+def run_worker(worker: int, bus_path: str, address: (str, int), log_dir: str, log_options: dict, scrollback_options: dict,
+               flood_options: dict, heartbeat_options: dict, metrics_port: int, connection_options: dict):
+    # Every worker applies every message, so each keeps its own copy of the logs
+    log_store = LogStore(os.path.join(log_dir, "worker{}".format(worker)), **log_options) if log_dir else None
+    scrollback = Scrollback(**scrollback_options) if scrollback_options else None
+    flood = FloodControl(**flood_options) if flood_options else None
+    heartbeat = Heartbeat(**heartbeat_options) if heartbeat_options else None
+
+    server = ShardedServer(worker, bus_path, log_store, scrollback, flood, heartbeat, **connection_options)
+    server.address = address
+    if metrics_port:
+        serve_metrics(server.metrics, ('127.0.0.1', metrics_port + worker))
+    log.info('server', 'worker started', worker=worker, pid=os.getpid())
+    server.listen()
+
+def serve(workers: int, address: (str, int)=None, log_dir: str=None, log_options: dict=None, scrollback_options: dict=None,
+          flood_options: dict=None, heartbeat_options: dict=None, metrics_port: int=None, **connection_options):
+    """
+    Starts the bus and forks the workers which all share the listening port.
+    """
+
+    bus_path = os.path.join(tempfile.gettempdir(), "chappie-bus-{}.sock".format(os.getpid()))
+    listener = socket(AF_UNIX, SOCK_STREAM)
+    listener.bind(bus_path)
+    listener.listen(workers)
+
+    if address is None:
+        address = (gethostname(), 8585)
+
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=run_worker, args=(worker, bus_path, address, log_dir, log_options or {}, scrollback_options, flood_options, heartbeat_options, metrics_port, connection_options), daemon=True) for worker in range(workers)]
+    for process in processes:
+        process.start()
+
+    try:
+        asyncio.run(Bus(listener, workers).serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.unlink(bus_path)
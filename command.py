@@ -2,20 +2,42 @@ import json
 from socket import socket
 import struct
 
+# Custom Modules
+from compression import compress_shared
+import wire
+
 class Command:
-    def __init__(self, data=None):
+    def __init__(self, data=None, symbols: dict=None):
         """
         The class that contains command related functionality.
+        Data can be in either the JSON or the binary encoding, symbols resolves interned names in binary frames.
+        Raises wire.DecodeError if data is not a valid command.
         """
 
         # Initialize the command based on data provided
-        if data is not None:
-            data = json.loads(data)
+        if data is not None and wire.is_json(data):
+            try:
+                data = json.loads(bytes(data) if isinstance(data, memoryview) else data)
+            except ValueError:
+                raise wire.DecodeError("Frame is not valid JSON")
+            if not isinstance(data, dict) or not isinstance(data.get('type', None), str):
+                raise wire.DecodeError("Frame has no command type")
+
             self.type = data['type']
-            self.body = data['body']
-            self.creator = data['creator']
-            self.specificChatroom = data['specificChatroom']
-            self.suppress = data['suppress']
+            self.body = data.get('body', None)
+            self.creator = data.get('creator', None)
+            self.specificChatroom = data.get('specificChatroom', None)
+            self.suppress = bool(data.get('suppress', False))
+            self.seq = data.get('seq', None)
+        elif data is not None:
+            if symbols is None:
+                symbols = {}
+
+            self.type, self.creator, self.specificChatroom, self.body, self.suppress, self.seq = wire.decode(data, symbols)
+
+            # Batches carry complete frames, decoded in order so interned names are defined before they are used
+            if self.type == 'batch':
+                self.body = [Command(frame, symbols) for frame in self.body]
         else:
             self.type = None
             self.body = None
@@ -23,6 +45,9 @@ class Command:
             self.specificChatroom = None
             self.suppress = False
 
+            # A chat message's number in its chatroom, given by the chatroom when it relays the message
+            self.seq = None
+
     def init_send_message(self, message: str, specificChatroom: str):
         """
         Initializes the message command.
@@ -40,13 +65,13 @@ class Command:
         self.type = 'alias'
         self.body = alias
 
-    def init_connect(self):
+    def init_connect(self, encodings: list=None):
         """
-        Initializes the connect command.
+        Initializes the connect command, optionally offering wire encodings other than JSON.
         """
 
         self.type = 'connect'
-        self.body = None
+        self.body = encodings
 
     def init_disconnect(self):
         """
@@ -112,6 +137,24 @@ class Command:
         self.type = 'error'
         self.body = message
 
+    def init_batch(self, commands: list):
+        """
+        Initializes a batch carrying several commands in one frame.
+        """
+
+        self.type = 'batch'
+        self.body = commands
+
+    def commands(self):
+        """
+        Returns the commands carried by this one, the batched commands for a batch, otherwise just itself.
+        """
+
+        if self.type == 'batch':
+            return [cmd for batched in self.body for cmd in batched.commands()]
+
+        return [self]
+
     def init_list_users(self, chatroom):
         """
         Initializes the delete chatroom command.
@@ -120,19 +163,186 @@ class Command:
         self.type = 'list_users'
         self.body = chatroom
 
-    def send(self, sock: socket):
+    def init_user_list(self, chatroom: str, users: list):
         """
-        Sends the command using the provided socket.
+        Initializes the response to list users, one page of the aliases in a chatroom.
         """
 
-        data = json.dumps({'type': self.type, 'creator': self.creator, 'specificChatroom': self.specificChatroom, 'body': self.body, 'suppress': self.suppress})
-        length = len(data)
-        sock.sendall(struct.pack('!I', length))
-        sock.sendall(data.encode(encoding='UTF-8'))
+        self.type = 'list_users'
+        self.specificChatroom = chatroom
+        self.body = users
+
+    def init_history(self, chatroom: str, start: int=None, limit: int=50):
+        """
+        Initializes the history command, asking for up to limit messages of a chatroom from message number start,
+        or the latest ones without a start.
+        """
+
+        self.type = 'history'
+        self.specificChatroom = chatroom
+        self.body = {'start': start, 'limit': limit}
+
+    def init_history_range(self, chatroom: str, start: int, end: int):
+        """
+        Initializes the response to history, the range of message numbers whose frames follow it.
+        """
+
+        self.type = 'history'
+        self.specificChatroom = chatroom
+        self.body = {'start': start, 'end': end}
+
+    def init_bootstrap(self, chatroom: str, chatrooms: list, users: list):
+        """
+        Initializes the bootstrap command, sent once an alias is accepted in place of get_chatrooms and list_users.
+        It has every chatroom and the other members of the room the user was put in, its recent messages follow it.
+        """
+
+        self.type = 'bootstrap'
+        self.specificChatroom = chatroom
+        self.body = {'chatrooms': chatrooms, 'users': users}
+
+    def init_ping(self):
+        """
+        Initializes the ping command, either side answers it with a pong to show the connection is alive.
+        """
+
+        self.type = 'ping'
+        self.body = None
+
+    def init_pong(self):
+        """
+        Initializes the pong command, the answer to a ping.
+        """
+
+        self.type = 'pong'
+        self.body = None
+
+    def init_session(self, token: str):
+        """
+        Initializes the session command, sent once an alias is accepted with the token that resumes the session.
+        """
+
+        self.type = 'session'
+        self.body = token
+
+    def init_resume(self, token: str, seqs: dict):
+        """
+        Initializes the resume command, sent in place of an alias after reconnecting. seqs maps chatroom names
+        to the number of the last message seen in them, the server sends the messages after those.
+        """
+
+        self.type = 'resume'
+        self.body = {'token': token, 'seqs': seqs}
+
+    def init_resumed(self, alias: str, chatrooms: list):
+        """
+        Initializes the response to resume, the alias taken back and the chatrooms it is still in.
+        The missed messages of each chatroom follow it as a history range.
+        """
+
+        self.type = 'resume'
+        self.creator = alias
+        self.body = chatrooms
+
+    def init_stats(self):
+        """
+        Initializes the stats command, the server answers with its metrics as text.
+        """
+
+        self.type = 'stats'
+
+    def is_ephemeral(self):
+        """
+        Returns whether the command can be dropped for a client that is falling behind.
+        Chat messages can, anything that changes rooms or users cannot.
+        """
+
+        return self.type == 'message'
+
+    def encode(self, encoding='json', interner: wire.Interner=None):
+        """
+        Returns the length prefixed wire representation of the command and the interned ids it refers to.
+        Names are only interned when an interner is given. Commands without a binary opcode are always sent as JSON.
+        """
+
+        if self.type == 'batch':
+            encoded = [cmd.encode(encoding, interner) for cmd in self.body]
+            data = wire.pack_batch([frame for frame, _ in encoded])
+            return struct.pack('!I', len(data)) + data, [idx for _, refs in encoded for idx in refs]
+
+        if encoding == 'binary':
+            encoded = wire.encode(self.type, self.creator, self.specificChatroom, self.body, self.suppress, interner, self.seq)
+            if encoded is not None:
+                data, refs = encoded
+                return struct.pack('!I', len(data)) + data, refs
+
+        data = self.stringify().encode(encoding='UTF-8')
+        return struct.pack('!I', len(data)) + data, ()
+
+    def encode_separately(self, encoding='json', interner: wire.Interner=None):
+        """
+        Returns the commands of a batch as consecutive frames in one buffer, for clients that dont support batches.
+        """
+
+        encoded = [cmd.encode(encoding, interner) for cmd in self.body]
+        return b''.join(frame for frame, _ in encoded), [idx for _, refs in encoded for idx in refs]
+
+    def frame(self, encoding='json'):
+        """
+        Returns the length prefixed wire representation of the command.
+        """
+
+        return self.encode(encoding)[0]
+
+    def send(self, sock: socket, frames: dict=None):
+        """
+        Sends the command using the provided connection, in the encoding negotiated for it.
+        Broadcasts pass the same frames dict for every recipient so each encoding is only serialized once,
+        and large frames are compressed once for all the recipients that negotiated compression.
+        """
+
+        shared = frames is not None
+        if frames is None:
+            frames = {}
+
+        key = sock.encoding
+        if self.type == 'batch' and not sock.batching:
+            key = 'separate ' + sock.encoding
+
+        encoded = frames.get(key, None)
+        if encoded is None:
+            if key == sock.encoding:
+                encoded = self.encode(sock.encoding, wire.symbols)
+            else:
+                encoded = self.encode_separately(sock.encoding, wire.symbols)
+            frames[key] = encoded
+
+        data, refs = encoded
+
+        # The writer would compress the frame again for every recipient, a broadcast does it here once instead
+        if shared and sock.deflater is not None and len(data) >= sock.deflater.threshold:
+            compressed = frames.get('zlib ' + key, None)
+            if compressed is None:
+                compressed = frames['zlib ' + key] = compress_shared(data)
+            data = compressed
+
+        # Define any interned names the connection hasnt seen yet before the frame that uses them
+        for idx in refs:
+            if idx not in sock.symbols:
+                sock.define(refs)
+                break
+
+        sock.sendall(data, ephemeral=self.is_ephemeral())
 
     def stringify(self):
         """
         returns the json representation of the command.
         """
 
-        return json.dumps({'type': self.type, 'creator': self.creator, 'specificChatroom': self.specificChatroom, 'body': self.body, 'suppress': self.suppress})
+        fields = {'type': self.type, 'creator': self.creator, 'specificChatroom': self.specificChatroom, 'body': self.body, 'suppress': self.suppress}
+
+        # Only numbered messages carry a seq, every other frame stays as it always was
+        if self.seq is not None:
+            fields['seq'] = self.seq
+
+        return json.dumps(fields)
@@ -0,0 +1,148 @@
+import struct
+import zlib
+
+# Custom Modules
+import wire
+
+# Optional zlib compression, negotiated in the connect handshake as the 'zlib' feature.
+#
+# A compressed frame body is the compressed opcode, a flags byte and raw deflate data that inflates to
+# complete length prefixed frames, which are handled in order as if they had arrived separately.
+# Stream frames continue the connection's compression context in that direction, so repeated names and
+# field keys cost almost nothing after the first time. Their deflate data ends with a sync flush whose
+# 00 00 FF FF marker is left off and restored by the reader.
+# Shared frames are compressed on their own, so one can be sent as is to every member of a broadcast.
+# Both kinds start from the same preset dictionary of JSON keys and command types.
+
+FLAG_SHARED = 0x01
+
+SYNC_MARKER = b'\x00\x00\xff\xff'
+
+# The most common strings go last, deflate reaches the end of the dictionary with the shortest distances
+DICTIONARY = (b'"type": "get_chatrooms""type": "list_users""type": "create_chatroom""type": "delete_chatroom"'
+              b'"type": "block_user""type": "unblock_user""type": "history""type": "error""type": "connect"'
+              b'"type": "disconnect""type": "join_chatroom""type": "alias", "creator": null, "specificChatroom": null, '
+              b'"body": null, "suppress": true}{"type": "message", "creator": "", "specificChatroom": "General", "body": "'
+              b'", "suppress": false}')
+
+def compressor(mem_level=9):
+    return zlib.compressobj(6, zlib.DEFLATED, -15, mem_level, zlib.Z_DEFAULT_STRATEGY, DICTIONARY)
+
+def decompressor():
+    return zlib.decompressobj(-15, DICTIONARY)
+
+def pack(flags: int, data: bytes):
+    body = bytes((wire.COMPRESSED, flags)) + data
+    return struct.pack('!I', len(body)) + body
+
+def compress_shared(data: bytes):
+    """
+    Compresses frames into a compressed frame that does not depend on any connection's context.
+    """
+
+    # A context used for one frame gains nothing from a large hash table, and setting one up costs more than compressing
+    deflate = compressor(4)
+    return pack(FLAG_SHARED, deflate.compress(data) + deflate.flush())
+
+def is_compressed(data: bytes):
+    """
+    Returns whether a buffer is exactly one compressed frame.
+    """
+
+    return len(data) > 5 and data[4] == wire.COMPRESSED and struct.unpack_from('!I', data)[0] == len(data) - 4
+
+class Deflater:
+    def __init__(self, threshold=128):
+        """
+        The sending side of a compressed connection. Buffers shorter than threshold bytes go out as they are,
+        the deflate overhead would eat most of what is saved. Not thread safe, only the writer uses it.
+        """
+
+        self.threshold = threshold
+        self.context = compressor()
+
+    def compress(self, data: bytes):
+        """
+        Returns the frames in data as one stream compressed frame, or data itself if it is short or already compressed.
+        """
+
+        if len(data) < self.threshold or is_compressed(data):
+            return data
+
+        deflated = self.context.compress(data) + self.context.flush(zlib.Z_SYNC_FLUSH)
+        return pack(0, deflated[:-len(SYNC_MARKER)])
+
+class Inflater:
+    def __init__(self, max_output=16 * 1024 * 1024, conn=None):
+        """
+        The receiving side of a compressed connection. max_output caps what all the compressed frames passed
+        to one expand may inflate to together. With conn, the server's connection to the peer, compressed frames
+        are a protocol error until zlib was negotiated with it, that is until it has a Deflater.
+        """
+
+        self.max_output = max_output
+        self.conn = conn
+        self.context = None
+
+    def expand(self, frames: list):
+        """
+        Returns the frame bodies with every compressed frame replaced by the frames it contains.
+        Compressed frames do not nest, one inside another is a protocol error like any other bad compressed frame.
+        """
+
+        if not any(frame[0] == wire.COMPRESSED for frame in frames if len(frame)):
+            return frames
+
+        if self.conn is not None and self.conn.deflater is None:
+            raise ConnectionError("Compressed frame on a connection that did not negotiate zlib")
+
+        expanded = []
+        budget = self.max_output
+        for frame in frames:
+            if len(frame) and frame[0] == wire.COMPRESSED:
+                data = self.inflate(frame, budget)
+                budget -= len(data)
+
+                # The stream context cannot be trusted after a bad frame, so the connection is dropped rather than answered
+                try:
+                    inner = wire.unpack_batch(data, 0)
+                except wire.DecodeError as e:
+                    raise ConnectionError("Corrupt compressed frame: {}".format(e))
+
+                if any(body[0] == wire.COMPRESSED for body in inner if len(body)):
+                    raise ConnectionError("Compressed frame inside a compressed frame")
+                expanded.extend(inner)
+            else:
+                expanded.append(frame)
+
+        return expanded
+
+    def inflate(self, frame, limit: int):
+        """
+        Decompresses one compressed frame body and returns the frames inside it, at most limit bytes of them.
+        """
+
+        if len(frame) < 2:
+            raise ConnectionError("Truncated compressed frame")
+
+        # A limit of 0 means none to zlib
+        if limit <= 0:
+            raise ConnectionError("Compressed frames inflate past {} bytes".format(self.max_output))
+
+        try:
+            if frame[1] & FLAG_SHARED:
+                context = decompressor()
+                data = context.decompress(frame[2:], limit)
+            else:
+                # The stream context lives as long as the connection, it is only created once the peer starts using it
+                if self.context is None:
+                    self.context = decompressor()
+                context = self.context
+                data = context.decompress(bytes(frame[2:]) + SYNC_MARKER, limit)
+        except zlib.error as e:
+            raise ConnectionError("Corrupt compressed frame: {}".format(e))
+
+        if context.unconsumed_tail:
+            raise ConnectionError("Compressed frames inflate past {} bytes".format(self.max_output))
+
+        return data
@@ -0,0 +1,340 @@
+from socket import *
+from threading import Thread, Lock, Condition
+from collections import deque
+import asyncio
+import struct
+import time
+
+# Custom Modules
+from compression import is_compressed
+import wire
+
+# What to do when a connection's outbound queue is full
+QUEUE_POLICIES = ('drop_oldest', 'drop_ephemeral', 'disconnect')
+
+class Connection:
+    # Totals across every connection, for reporting
+    totals = {'dropped': 0, 'evictions': 0, 'opened': 0, 'closed': 0, 'bytes_in': 0, 'bytes_out': 0}
+    totals_lock = Lock()
+
+    def __init__(self, queue_limit=1024, queue_policy='drop_ephemeral', coalesce_window=0.0, coalesce_limit=64,
+                 compress_threshold=128):
+        """
+        A client connection with a bounded outbound queue drained by its own writer.
+        Senders only ever append to the queue, so a slow client never stalls delivery to anyone else.
+        With a coalesce window the writer waits up to that many seconds, or until coalesce_limit frames
+        are queued, and sends everything queued as one batch to clients that support batches.
+        Clients that negotiate compression get every send of at least compress_threshold bytes compressed.
+        """
+
+        self.queue = deque()
+        self.queue_limit = queue_limit
+        self.queue_policy = queue_policy
+        self.coalesce_window = coalesce_window
+        self.coalesce_limit = coalesce_limit
+        self.compress_threshold = compress_threshold
+        self.lock = Lock()
+        self.closed = False
+        self.high_water = 0
+        self.dropped = 0
+
+        # Wire features negotiated in the connect handshake and the interned ids already defined for the client
+        self.encoding = 'json'
+        self.batching = False
+        self.deflater = None
+        self.symbols = set()
+        self.bootstrap = False
+        self.resumable = False
+
+        # Flood control, the connection's TokenBucket if it has a limit and the scopes it is over the limit in
+        self.bucket = None
+        self.throttled = set()
+
+        # Heartbeat, when the client last sent a frame and when it was pinged if it has not answered yet
+        self.last_received = time.monotonic()
+        self.pinged = None
+
+        with Connection.totals_lock:
+            Connection.totals['opened'] += 1
+
+    @property
+    def depth(self):
+        return len(self.queue)
+
+    def sendall(self, data: bytes, ephemeral=False):
+        """
+        Queues a frame for the writer. Ephemeral frames (chat messages) may be dropped when the queue is full.
+        """
+
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Connection is closed")
+
+            if len(self.queue) >= self.queue_limit:
+                if self.queue_policy == 'drop_oldest' and self.drop_oldest():
+                    pass
+                elif self.queue_policy == 'drop_ephemeral' and self.drop_ephemeral():
+                    pass
+                elif self.queue_policy == 'drop_ephemeral' and ephemeral:
+                    # Nothing older is expendable, drop the new frame instead
+                    self.count_drop()
+                    return
+                else:
+                    self.evict()
+                    raise ConnectionError("Outbound queue full, slow consumer evicted")
+
+            self.queue.append((data, ephemeral))
+            self.high_water = max(self.high_water, len(self.queue))
+            self.wake()
+
+    def define(self, refs: list):
+        """
+        Queues definitions of the interned ids the client hasnt seen yet. Later frames depend on them, so they are never dropped.
+        Checking and queueing under the lock keeps a frame sent from another thread from overtaking a definition it needs.
+        """
+
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Connection is closed")
+
+            unknown = [idx for idx in refs if idx not in self.symbols]
+            if not unknown:
+                return
+
+            self.symbols.update(unknown)
+            self.queue.append((b''.join(wire.symbols.definition(idx) for idx in unknown), None))
+            self.wake()
+
+    def drop_oldest(self):
+        """
+        Drops the oldest queued frame that is not a definition, returns whether one was found.
+        """
+
+        for idx, (_, ephemeral) in enumerate(self.queue):
+            if ephemeral is not None:
+                del self.queue[idx]
+                self.count_drop()
+                return True
+
+        return False
+
+    def drop_ephemeral(self):
+        """
+        Drops the oldest queued ephemeral frame, returns whether one was found.
+        """
+
+        for idx, (_, ephemeral) in enumerate(self.queue):
+            if ephemeral:
+                del self.queue[idx]
+                self.count_drop()
+                return True
+
+        return False
+
+    def count_drop(self):
+        self.dropped += 1
+        with Connection.totals_lock:
+            Connection.totals['dropped'] += 1
+
+    def count_received(self, length: int):
+        self.last_received = time.monotonic()
+        with Connection.totals_lock:
+            Connection.totals['bytes_in'] += length
+
+    def count_sent(self, length: int):
+        with Connection.totals_lock:
+            Connection.totals['bytes_out'] += length
+
+    def evict(self):
+        """
+        Disconnects a client that cannot keep up, called with the lock held.
+        """
+
+        with Connection.totals_lock:
+            Connection.totals['evictions'] += 1
+            Connection.totals['closed'] += 1
+
+        self.closed = True
+        self.queue.clear()
+        self.abort()
+
+    def take_all(self):
+        """
+        Removes and returns every queued frame, called with the lock held.
+        """
+
+        frames = [frame for frame, _ in self.queue]
+        self.queue.clear()
+        return frames
+
+    def prepare(self, frames: list):
+        """
+        Turns the frames taken from the queue into one buffer so the writer needs a single send.
+        On a compressed connection they become one compressed frame, otherwise several frames
+        become a single batch frame for clients that support batches.
+        Runs in the writer outside the lock, the compression context is only ever used from there.
+        """
+
+        data = b''.join(frames)
+
+        if self.deflater is not None and len(data) >= self.deflater.threshold:
+            if not any(is_compressed(frame) for frame in frames):
+                return self.deflater.compress(data)
+
+            # Compressed frames do not nest, broadcasts compressed once for everyone go out between the runs of other frames
+            parts = []
+            plain = []
+            for frame in frames:
+                if is_compressed(frame):
+                    if plain:
+                        parts.append(self.deflater.compress(b''.join(plain)))
+                        plain = []
+                    parts.append(frame)
+                else:
+                    plain.append(frame)
+            if plain:
+                parts.append(self.deflater.compress(b''.join(plain)))
+
+            return b''.join(parts)
+
+        if self.batching and len(frames) > 1:
+            data = struct.pack('!I', len(data) + 2) + wire.pack_batch([data])
+
+        return data
+
+    def coalescing(self, deadline: float):
+        """
+        Returns whether the writer should keep waiting for more frames before sending.
+        """
+
+        return not self.closed and len(self.queue) < self.coalesce_limit and time.monotonic() < deadline
+
+    def wake(self):
+        """
+        Lets the writer know there is queued data, called with the lock held.
+        """
+
+        raise NotImplementedError
+
+    def abort(self):
+        """
+        Closes the transport without flushing, called with the lock held.
+        """
+
+        raise NotImplementedError
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                with Connection.totals_lock:
+                    Connection.totals['closed'] += 1
+
+            self.closed = True
+            self.queue.clear()
+            self.abort()
+
+class ThreadedConnection(Connection):
+    def __init__(self, sock: socket, **options):
+        """
+        A connection for the threaded engine, drained by a dedicated writer thread.
+        """
+
+        super().__init__(**options)
+        self.sock = sock
+        self.ready = Condition(self.lock)
+        Thread(target=self.write_loop, daemon=True).start()
+
+    def recv_into(self, buffer):
+        length = self.sock.recv_into(buffer)
+        self.count_received(length)
+        return length
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def write_loop(self):
+        while True:
+            with self.lock:
+                while not self.queue and not self.closed:
+                    self.ready.wait()
+
+                if self.coalesce_window:
+                    deadline = time.monotonic() + self.coalesce_window
+                    while self.coalescing(deadline):
+                        self.ready.wait(deadline - time.monotonic())
+
+                if self.closed:
+                    return
+
+                frames = self.take_all()
+
+            try:
+                data = self.prepare(frames)
+                self.sock.sendall(data)
+                self.count_sent(len(data))
+            except OSError:
+                self.close()
+                return
+
+    def wake(self):
+        self.ready.notify()
+
+    def abort(self):
+        self.ready.notify()
+
+        # Shutting down also wakes the reader thread if it is blocked in recv
+        try:
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+class StreamConnection(Connection):
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, **options):
+        """
+        A connection for the async engine, drained by a writer task on the event loop.
+        """
+
+        super().__init__(**options)
+        self.reader = reader
+        self.writer = writer
+        self.ready = asyncio.Event()
+        self.writer_task = asyncio.get_running_loop().create_task(self.write_loop())
+
+    def getpeername(self):
+        return self.writer.get_extra_info('peername')
+
+    async def write_loop(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+
+                if self.coalesce_window:
+                    deadline = time.monotonic() + self.coalesce_window
+                    while self.coalescing(deadline):
+                        try:
+                            await asyncio.wait_for(self.ready.wait(), deadline - time.monotonic())
+                        except asyncio.TimeoutError:
+                            break
+                        self.ready.clear()
+
+                with self.lock:
+                    if self.closed:
+                        return
+
+                    frames = self.take_all()
+
+                data = self.prepare(frames)
+                self.writer.write(data)
+                self.count_sent(len(data))
+                await self.writer.drain()
+        except ConnectionError:
+            self.close()
+
+    def wake(self):
+        self.ready.set()
+
+    def abort(self):
+        self.ready.set()
+        self.writer.transport.abort()
@@ -0,0 +1,572 @@
+import asyncio
+import bisect
+import hashlib
+import itertools
+import json
+import os
+import struct
+
+# Custom Modules
+from command import Command
+from user import User
+from chatroom import Chatroom
+from messagelog import LogStore
+from scrollback import Scrollback
+from ratelimit import FloodControl
+from heartbeat import Heartbeat
+from metrics import serve_metrics
+from cluster import pack_frame, read_frame
+from logger import log
+from server import Server
+import handlers
+import util
+
+# First byte of a relay frame that hands a command to clients of the receiving node, every other relay frame is a JSON envelope
+DELIVER = 0x01
+
+NODE_UNREACHABLE = handlers.ErrorResponse('node_unreachable', "The server hosting that chatroom cannot be reached, try again shortly.")
+
+def hash_key(key: str):
+    return int.from_bytes(hashlib.md5(key.encode(encoding='UTF-8')).digest()[:8], 'big')
+
+def parse_nodes(text: str):
+    """
+    Parses 'name=host:port,name=host:port' into a dict of relay addresses by node name.
+    """
+
+    nodes = {}
+    for entry in text.split(','):
+        name, _, address = entry.strip().partition('=')
+        host, _, port = address.rpartition(':')
+        nodes[name] = (host, int(port))
+
+    return nodes
+
+def pack_delivery(conns: list, data: bytes):
+    body = struct.pack('!BI{}I'.format(len(conns)), DELIVER, len(conns), *conns) + data
+    return struct.pack('!I', len(body)) + body
+
+def unpack_delivery(frame: bytes):
+    """
+    Returns the connections and the length prefixed command frame of a delivery, header included.
+    """
+
+    count, = struct.unpack_from('!I', frame, 5)
+    conns = struct.unpack_from('!{}I'.format(count), frame, 9)
+    return conns, frame[9 + 4 * count:]
+
+class HashRing:
+    def __init__(self, nodes: list, replicas=64):
+        """
+        Consistent hashing of chatroom names onto nodes. Every node has replicas points on the ring and a name
+        belongs to the node of the first point at or after the name's hash, so adding or removing a node only
+        moves the rooms next to its points.
+        """
+
+        self.nodes = sorted(nodes)
+        self.points = sorted((hash_key("{}#{}".format(node, idx)), node) for node in self.nodes for idx in range(replicas))
+        self.hashes = [point for point, _ in self.points]
+
+    def owner(self, name: str):
+        idx = bisect.bisect_left(self.hashes, hash_key(name)) % len(self.points)
+        return self.points[idx][1]
+
+class RelayPeer:
+    def __init__(self, link, node: str, conn: int):
+        """
+        Stands in for a client connected to another node. What is sent to it goes over the link to that node,
+        which sends it on to the client in the client's own encoding.
+        """
+
+        self.link = link
+        self.node = node
+        self.conn = conn
+        self.encoding = 'json'
+        # Replays go over as one frame, the client's node splits them up again for clients without batches
+        self.batching = True
+        self.deflater = None
+        self.symbols = set()
+        self.bootstrap = False
+        self.resumable = False
+        self.closed = False
+
+    def sendall(self, data: bytes, ephemeral=False):
+        self.link.deliver(self.conn, data)
+
+    def close(self):
+        pass
+
+class RelayLink:
+    def __init__(self, server, node: str, address: (str, int)):
+        """
+        The persistent link to another node. It only carries what this node sends, the other node sends over its own link.
+        Nothing is queued while the link is down. A frame handed to several clients on the other node, as every
+        broadcast is, goes over once with the list of connections it is for.
+        """
+
+        self.server = server
+        self.node = node
+        self.address = address
+        self.writer = None
+        self.connected = asyncio.Event()
+        self.retry_interval = 0.5
+
+        # The delivery being built, sent when a different frame comes along or the event loop is done with its callbacks
+        self.pending_data = None
+        self.pending_conns = []
+
+    async def run(self):
+        """
+        Keeps the link connected until the node stops.
+        """
+
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(*self.address)
+            except OSError:
+                await asyncio.sleep(self.retry_interval)
+                continue
+
+            writer.write(pack_frame({'kind': 'hello', 'node': self.server.node}))
+            writer.write(pack_frame({'kind': 'rooms', 'names': list(self.server.chatrooms), 'exists': True}))
+            self.writer = writer
+            self.connected.set()
+            log.info('relay', 'link up', node=self.node)
+
+            # Nothing is read from the link, the read only ends when the other node goes away
+            try:
+                await reader.read()
+            except ConnectionError:
+                pass
+
+            self.pending_data = None
+            self.pending_conns = []
+            self.writer = None
+            self.connected.clear()
+            writer.close()
+            log.warning('relay', 'link down', node=self.node)
+
+    def send(self, envelope: dict):
+        if self.writer is None:
+            return
+
+        self.flush()
+        self.writer.write(pack_frame(envelope))
+
+    def deliver(self, conn: int, data: bytes):
+        if self.writer is None:
+            return
+
+        if data is not self.pending_data:
+            self.flush()
+            self.pending_data = data
+            asyncio.get_running_loop().call_soon(self.flush)
+
+        self.pending_conns.append(conn)
+
+    def flush(self):
+        if self.pending_data is None:
+            return
+
+        if self.writer is not None:
+            self.writer.write(pack_delivery(self.pending_conns, self.pending_data))
+        self.pending_data = None
+        self.pending_conns = []
+
+class FederatedServer(Server):
+    def __init__(self, node: str, nodes: dict, log_store: LogStore=None, scrollback: Scrollback=None, flood: FloodControl=None,
+                 heartbeat: Heartbeat=None, **connection_options):
+        """
+        A server node in a federation of nodes, each with its own clients. Every chatroom is hosted by the node
+        the hash ring assigns its name to, which keeps its members, blocklist, log and scrollback. Commands about
+        a room are relayed to its node and run there, with clients of other nodes standing in as RelayPeers, and
+        what the room sends them is relayed back to their own node. Aliases are registered by the node hosting
+        the default chatroom, so they are unique across the federation. Every node knows the names of all rooms.
+        nodes maps every node name, this one included, to the address its relay links are accepted on.
+        """
+
+        super().__init__('async', log_store, scrollback, flood, heartbeat, **connection_options)
+        self.node = node
+        self.nodes = nodes
+        self.ring = HashRing(list(nodes))
+        self.links = {name: RelayLink(self, name, address) for name, address in nodes.items() if name != node}
+
+        # Ids for local connections in relayed frames, and the stand-ins for other nodes' clients by (node, conn)
+        self.conn_ids = itertools.count()
+        self.local_ids = {}
+        self.local_conns = {}
+        self.peers = {}
+
+        # The room each local client's user is in, as reported by the node hosting it
+        self.locations = {}
+
+        # Names of the chatrooms on every node
+        self.directory = dict.fromkeys(self.chatrooms)
+
+        if self.ring.owner(util.defaultChatroom) != node:
+            general = self.chatrooms.pop(util.defaultChatroom)
+            if general.log is not None:
+                general.log.close()
+            if general.recent is not None:
+                self.scrollback.discard(general.recent)
+
+    def describe_metrics(self):
+        super().describe_metrics()
+        self.metrics.describe('chappie_relayed_commands_total', 'counter', "Commands relayed to the node hosting their chatroom, by node.")
+        self.metrics.describe('chappie_relay_links_up', 'gauge', "Relay links to other nodes that are connected.")
+
+    def collect_metrics(self):
+        samples = super().collect_metrics()
+        samples.append(('chappie_relay_links_up', (), sum(1 for link in self.links.values() if link.writer is not None)))
+        return samples
+
+    async def listen_async(self):
+        """
+        Accepts relay links, connects to every other node and then starts accepting clients.
+        """
+
+        relay = await asyncio.start_server(self.handle_link, *self.nodes[self.node], reuse_address=True)
+
+        loop = asyncio.get_running_loop()
+        for link in self.links.values():
+            loop.create_task(link.run())
+
+        # Clients are only accepted once every room is within reach
+        await asyncio.gather(*(link.connected.wait() for link in self.links.values()))
+        log.info('server', 'joined federation', node=self.node, nodes=len(self.nodes))
+
+        async with relay:
+            await super().listen_async()
+
+    async def handle_link(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Applies everything another node sends over its link, the first frame is its hello.
+        """
+
+        node = json.loads((await read_frame(reader))[4:])['node']
+
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame[4] == DELIVER:
+                    self.deliver(*unpack_delivery(frame))
+                else:
+                    self.apply(node, json.loads(frame[4:]))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+            # The clients of a node that went away are gone as far as this node can tell
+            keys = [key for key in self.peers if key[0] == node]
+            Server.drop_clients(self, [self.peers.pop(key) for key in keys])
+
+    def apply(self, node: str, envelope: dict):
+        """
+        Applies an envelope sent by another node.
+        """
+
+        kind = envelope['kind']
+        if kind == 'command':
+            sock = self.resolve(envelope['node'], envelope['conn'], envelope['alias'])
+            if isinstance(sock, RelayPeer) and 'bootstrap' in envelope:
+                sock.bootstrap = envelope['bootstrap']
+            if sock is not None:
+                Server.execute_command(self, Command(envelope['cmd']), tuple(envelope['address']), sock)
+        elif kind == 'placed':
+            sock = self.local_conns.get(envelope['conn'], None)
+            if sock is not None:
+                self.placed(sock, envelope['alias'], envelope['room'])
+        elif kind == 'leave':
+            sock = self.peers.get((node, envelope['conn']), None)
+            if sock is not None:
+                self.leave(sock, envelope['room'], envelope['joined'])
+        elif kind == 'drop':
+            socks = [self.peers.pop((node, conn), None) for conn in envelope['conns']]
+            Server.drop_clients(self, [sock for sock in socks if sock is not None])
+        elif kind == 'rooms':
+            self.update_directory(envelope['names'], envelope['exists'])
+        elif kind == 'announce':
+            self.send_local(Command(envelope['cmd']))
+
+    def deliver(self, conns: list, data: bytes):
+        """
+        Sends a frame relayed by a room on another node to the local clients it is for.
+        """
+
+        cmd = Command(data[4:])
+        frames = {}
+        for conn in conns:
+            sock = self.local_conns.get(conn, None)
+            if sock is None:
+                continue
+
+            try:
+                cmd.send(sock, frames)
+            except ConnectionError:
+                pass
+
+    def resolve(self, node: str, conn: int, alias: str):
+        """
+        Returns the socket that stands for a client, a real one if it is connected to this node.
+        Users of other nodes are registered here the first time one of their commands comes in.
+        """
+
+        if node == self.node:
+            return self.local_conns.get(conn, None)
+
+        link = self.links.get(node, None)
+        if link is None:
+            return None
+
+        peer = self.peers.get((node, conn), None)
+        if peer is None:
+            peer = self.peers[(node, conn)] = RelayPeer(link, node, conn)
+
+        if alias is not None and peer not in self.users:
+            self.register(User(alias, peer))
+
+        return peer
+
+    def register(self, user: User):
+        """
+        Registers a user outside of any chatroom, unless its alias is taken.
+        """
+
+        with self.registry_lock:
+            if user.alias in self.aliases:
+                return
+
+            self.users[user.socket] = user
+            self.aliases[user.alias] = user
+            self.memberships[user] = set()
+
+    def local_id(self, sock):
+        conn = self.local_ids.get(sock, None)
+        if conn is None:
+            conn = next(self.conn_ids)
+            self.local_ids[sock] = conn
+            self.local_conns[conn] = sock
+
+        return conn
+
+    def authority(self, cmd: Command, sock):
+        """
+        Returns the node that runs a command from a local client: the node hosting the chatroom it is about,
+        the node hosting the default chatroom for aliases, and this node for everything else.
+        """
+
+        if cmd.type == 'alias':
+            name = util.defaultChatroom
+        elif cmd.type in ('message', 'history'):
+            name = cmd.specificChatroom
+        elif cmd.type in ('join_chatroom', 'create_chatroom', 'delete_chatroom', 'list_users'):
+            name = cmd.body
+        elif cmd.type in ('block_user', 'unblock_user'):
+            # Blocks apply to the room the sender is in
+            name = self.locations.get(sock, None)
+        else:
+            return self.node
+
+        if not isinstance(name, str):
+            return self.node
+
+        return self.ring.owner(name)
+
+    def execute_command(self, cmd: Command, origin_address: (str, int), sock):
+        """
+        Runs a command here if this node is its authority and relays it to the node that is otherwise.
+        """
+
+        node = self.authority(cmd, sock)
+        if node == self.node:
+            super().execute_command(cmd, origin_address, sock)
+            return
+
+        link = self.links[node]
+        if link.writer is None:
+            self.send_error(sock, NODE_UNREACHABLE)
+            return
+
+        user = self.users.get(sock, None)
+        link.send({'kind': 'command', 'node': self.node, 'conn': self.local_id(sock), 'alias': user.alias if user is not None else None,
+                   'address': list(origin_address), 'bootstrap': sock.bootstrap, 'cmd': cmd.stringify()})
+        self.metrics.count('chappie_relayed_commands_total', (('node', node),))
+
+    def drop_clients(self, client_socks: list):
+        """
+        Removes lost clients here and lets the other nodes remove them from the rooms they host, in one envelope.
+        """
+
+        super().drop_clients(client_socks)
+
+        conns = []
+        for client_sock in client_socks:
+            self.locations.pop(client_sock, None)
+            conn = self.local_ids.pop(client_sock, None)
+            if conn is not None:
+                self.local_conns.pop(conn, None)
+                conns.append(conn)
+
+        if not conns:
+            return
+
+        for link in self.links.values():
+            link.send({'kind': 'drop', 'conns': conns})
+
+    def join_room(self, user: User, chatroom: Chatroom):
+        """
+        Adds a user to a hosted room and tells the user's own node where it is now.
+        """
+
+        super().join_room(user, chatroom)
+
+        sock = user.socket
+        if isinstance(sock, RelayPeer):
+            sock.link.send({'kind': 'placed', 'conn': sock.conn, 'alias': user.alias, 'room': chatroom.name})
+        else:
+            self.placed(sock, user.alias, chatroom.name)
+
+    def placed(self, sock, alias: str, name: str):
+        """
+        Records the room a local client's user was put in, and takes it out of its previous room when another node hosts that.
+        The first placement is in the default chatroom, when the alias is accepted, so the user is registered here then.
+        """
+
+        if sock.closed:
+            return
+
+        if sock not in self.users:
+            self.register(User(alias, sock))
+
+        previous = self.locations.get(sock, None)
+        self.locations[sock] = name
+        if previous is None or previous == name:
+            return
+
+        # The node hosting both rooms has moved the user already
+        node = self.ring.owner(previous)
+        if node == self.ring.owner(name):
+            return
+
+        if node == self.node:
+            self.leave(sock, previous, name)
+        else:
+            self.links[node].send({'kind': 'leave', 'conn': self.local_id(sock), 'room': previous, 'joined': name})
+
+    def leave(self, sock, name: str, joined: str):
+        """
+        Takes a user out of a hosted room after it joined a room on another node, and lets the room know.
+        """
+
+        user = self.users.get(sock, None)
+        chatroom = self.chatrooms.get(name, None)
+        if user is None or chatroom is None or chatroom not in self.memberships.get(user, ()):
+            return
+
+        self.leave_room(user, chatroom)
+
+        joinCmd = Command()
+        joinCmd.init_join_chatroom(joined)
+        joinCmd.creator = user.alias
+        chatroom.send_all(joinCmd)
+
+    def move_to_default(self, users: list):
+        """
+        Moves users into the default chatroom. When another node hosts it they leave their rooms here and
+        their joins are sent to that node, which lets the default chatroom know, so none are moved here.
+        """
+
+        if util.defaultChatroom in self.chatrooms:
+            return super().move_to_default(users)
+
+        joinCmd = Command()
+        joinCmd.init_join_chatroom(util.defaultChatroom)
+        link = self.links[self.ring.owner(util.defaultChatroom)]
+
+        for user in users:
+            with self.registry_lock:
+                if user not in self.memberships:
+                    continue
+                for chatroom in list(self.memberships[user]):
+                    self.leave_room(user, chatroom)
+
+            sock = user.socket
+            if isinstance(sock, RelayPeer):
+                node, conn = sock.node, sock.conn
+            else:
+                node, conn = self.node, self.local_id(sock)
+            link.send({'kind': 'command', 'node': node, 'conn': conn, 'alias': user.alias, 'address': ['', 0], 'cmd': joinCmd.stringify()})
+
+        return []
+
+    def add_chatroom(self, chatroom: Chatroom):
+        if not super().add_chatroom(chatroom):
+            return False
+
+        self.publish_room(chatroom.name, True)
+        return True
+
+    def remove_chatroom(self, name: str):
+        chatroom = super().remove_chatroom(name)
+        if chatroom is not None:
+            self.publish_room(name, False)
+
+        return chatroom
+
+    def publish_room(self, name: str, exists: bool):
+        self.update_directory([name], exists)
+        for link in self.links.values():
+            link.send({'kind': 'rooms', 'names': [name], 'exists': exists})
+
+    def update_directory(self, names: list, exists: bool):
+        with self.registry_lock:
+            for name in names:
+                if exists:
+                    self.directory[name] = None
+                else:
+                    self.directory.pop(name, None)
+
+    def has_chatroom(self, name: str):
+        return name in self.directory
+
+    def chatroom_names(self):
+        with self.registry_lock:
+            return list(self.directory)
+
+    def send_all(self, cmd: Command):
+        """
+        Sends a command to every user in the federation, each node sends it to its own clients.
+        """
+
+        for link in self.links.values():
+            link.send({'kind': 'announce', 'cmd': cmd.stringify()})
+
+        self.send_local(cmd)
+
+    def send_local(self, cmd: Command):
+        frames = {}
+
+        with self.registry_lock:
+            sockets = [sock for sock in self.users if not isinstance(sock, RelayPeer)]
+
+        for sock in sockets:
+            try:
+                cmd.send(sock, frames)
+            except ConnectionError:
+                pass
+
+def run_node(node: str, nodes: dict, address: (str, int), log_dir: str=None, log_options: dict=None, scrollback_options: dict=None,
+             flood_options: dict=None, heartbeat_options: dict=None, metrics_port: int=None, **connection_options):
+    # Each node logs the rooms it hosts, in its own directory so nodes can share a machine
+    log_store = LogStore(os.path.join(log_dir, node), **(log_options or {})) if log_dir else None
+    scrollback = Scrollback(**scrollback_options) if scrollback_options else None
+    flood = FloodControl(**flood_options) if flood_options else None
+    heartbeat = Heartbeat(**heartbeat_options) if heartbeat_options else None
+
+    server = FederatedServer(node, nodes, log_store, scrollback, flood, heartbeat, **connection_options)
+    server.address = address
+    if metrics_port:
+        serve_metrics(server.metrics, ('127.0.0.1', metrics_port))
+    log.info('server', 'starting node', node=node, relay="{}:{}".format(*nodes[node]))
+    server.listen()
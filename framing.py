@@ -0,0 +1,112 @@
+from socket import socket
+import asyncio
+import struct
+
+# Custom Modules
+from compression import Inflater
+
+# Largest frame body a client may send
+MAX_FRAME = 16 * 1024 * 1024
+
+class FrameReader:
+    def __init__(self, sock: socket, size=65536, max_frame=MAX_FRAME, inflater: Inflater=None):
+        """
+        Reads length prefixed frames from a socket into one preallocated buffer.
+        Each recv_into can deliver many frames, and frames split across reads are completed by later ones.
+        Compressed frames are expanded into the frames they carry, so callers never see them.
+        inflater replaces the default one, which accepts compressed frames at any time.
+        """
+
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.max_frame = max_frame
+        self.inflater = inflater if inflater is not None else Inflater(max_frame)
+
+    def read_frames(self):
+        """
+        Waits for data and returns the bodies of every complete frame received so far.
+        The bodies are memoryviews into the buffer, only valid until the next call.
+        """
+
+        while True:
+            self.make_room()
+
+            frames = self.received(self.sock.recv_into(self.view[self.end:]))
+            if frames:
+                return frames
+
+    async def read_frames_async(self, loop: asyncio.AbstractEventLoop):
+        """
+        Same as read_frames for a non-blocking socket, waits for data on the event loop.
+        """
+
+        while True:
+            self.make_room()
+
+            frames = self.received(await loop.sock_recv_into(self.sock, self.view[self.end:]))
+            if frames:
+                return frames
+
+    def received(self, length: int):
+        """
+        Accounts for newly received data and returns the frames it completed.
+        """
+
+        if length == 0:
+            raise ConnectionError("Connection closed by peer")
+        self.end += length
+
+        return self.inflater.expand(self.split_frames())
+
+    def split_frames(self):
+        """
+        Slices every complete frame out of the buffered data without copying.
+        """
+
+        frames = []
+        buffer = self.buffer
+        pos = self.start
+        end = self.end
+
+        while end - pos >= 4:
+            length, = struct.unpack_from('!I', buffer, pos)
+            if length > self.max_frame:
+                raise ConnectionError("Frame of {} bytes exceeds the limit".format(length))
+            if end - pos - 4 < length:
+                break
+
+            frames.append(self.view[pos + 4:pos + 4 + length])
+            pos += 4 + length
+
+        self.start = pos
+        return frames
+
+    def make_room(self):
+        """
+        Moves a partial frame to the front of the buffer, and grows the buffer if the frame does not fit.
+        """
+
+        if self.start == self.end:
+            self.start = self.end = 0
+            return
+
+        pending = self.end - self.start
+        needed = pending
+        if pending >= 4:
+            needed = max(needed, 4 + struct.unpack_from('!I', self.buffer, self.start)[0])
+
+        if self.start > 0 and self.end == len(self.buffer) or needed > len(self.buffer) - self.start:
+            if needed > len(self.buffer):
+                buffer = bytearray(needed)
+                buffer[:pending] = self.view[self.start:self.end]
+                self.buffer = buffer
+                self.view = memoryview(buffer)
+            else:
+                # Memoryview assignment handles the overlapping move
+                self.view[:pending] = self.view[self.start:self.end]
+
+            self.start = 0
+            self.end = pending
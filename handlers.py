@@ -0,0 +1,628 @@
+from socket import socket
+import ipaddress
+
+# Custom Modules
+from command import Command
+from chatroom import Chatroom
+from user import User
+from compression import Deflater
+from logger import log
+import util
+import wire
+
+# Handlers by command type, the server copies this table when it starts. Other modules add to it with register().
+HANDLERS = {}
+
+class ErrorResponse:
+    def __init__(self, reason: str, message: str):
+        """
+        An error whose message never changes, encoded once per encoding and reused for every client.
+        reason is a fixed key that labels the error in the metrics.
+        """
+
+        self.reason = reason
+        self.cmd = Command()
+        self.cmd.init_error(message)
+        self.frames = {}
+
+    def send(self, sock: socket):
+        self.cmd.send(sock, self.frames)
+
+MALFORMED_FRAME = ErrorResponse('malformed_frame', "That was not a valid command.")
+ALIAS_REQUIRED = ErrorResponse('alias_required', "Choose an alias first.")
+MESSAGE_TOO_LONG = ErrorResponse('message_too_long', "Your message exceeds the 200 character limit.")
+MESSAGE_INVALID = ErrorResponse('message_invalid', "A message needs a chatroom name and a text body.")
+NAME_INVALID = ErrorResponse('name_invalid', "Chatroom names and aliases must be text.")
+BLOCK_SELF = ErrorResponse('block_self', "Why are you trying to block yourself? Stop that.")
+HISTORY_DISABLED = ErrorResponse('history_disabled', "This server does not keep message history.")
+HISTORY_INVALID = ErrorResponse('history_invalid', "A history request needs a start message number or none, and a positive limit.")
+STATS_LOCAL_ONLY = ErrorResponse('stats_local_only', "Server stats are only available from the server's own machine.")
+RESUME_DISABLED = ErrorResponse('resume_disabled', "This server does not resume sessions, choose an alias again.")
+RESUME_INVALID = ErrorResponse('resume_invalid', "A resume needs a session token and the last message number seen in each chatroom.")
+RESUME_EXPIRED = ErrorResponse('resume_expired', util.sessionExpired)
+RESUME_ALIASED = ErrorResponse('resume_aliased', "This connection already has an alias.")
+
+# Sent once when a client goes over a flood control limit, by the limit's scope
+FLOOD_ERRORS = {
+    'connection': ErrorResponse('flood_connection', "You are sending too fast, slow down."),
+    'user': ErrorResponse('flood_user', "You are sending messages too fast, slow down."),
+    'room': ErrorResponse('flood_room', "This chatroom is receiving too many messages, try again shortly."),
+}
+
+class Handler:
+    # The command type handled
+    type = None
+
+    # Whether the sender must have an alias, commands from clients without one are rejected before validate runs
+    requires_user = True
+
+    # Whether the command only reads state or only concerns the sender, sharded servers run these without the bus
+    local = False
+
+    def validate(self, server, cmd: Command, user: User):
+        """
+        Checks the command before it is handled. Returns None, or an ErrorResponse or a (reason, message) pair for the sender.
+        """
+
+        return None
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        """
+        Performs the command. Can also return an error for the sender, for checks that have to be atomic with the change.
+        The reason of an error is a fixed key for the metrics, never built from the command.
+        """
+
+        raise NotImplementedError
+
+def register(handler: Handler):
+    """
+    Registers a handler for its command type, replacing any earlier one. Can be used as a class decorator.
+    """
+
+    if isinstance(handler, type):
+        HANDLERS[handler.type] = handler()
+    else:
+        HANDLERS[handler.type] = handler
+
+    return handler
+
+@register
+class MessageHandler(Handler):
+    type = 'message'
+
+    def validate(self, server, cmd: Command, user: User):
+        # Other decoders can hand over any JSON value
+        if not isinstance(cmd.specificChatroom, str) or not isinstance(cmd.body, str):
+            return MESSAGE_INVALID
+
+        # Notifies user if chatroom doesnt exist
+        if cmd.specificChatroom not in server.chatrooms:
+            return 'no_such_room', "Chatroom '{}' doesn't exist.".format(cmd.specificChatroom)
+
+        # Notifies user if their message is too long
+        if len(cmd.body) > 200:
+            return MESSAGE_TOO_LONG
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        # Adds a tag that says who authored the command
+        cmd.creator = user.alias
+
+        log.info('message', 'relayed', type=cmd.type, alias=cmd.creator, room=cmd.specificChatroom, body=cmd.body)
+
+        # Relays the message to all the other clients in the same chatroom that the message was sent from
+        server.chatrooms[cmd.specificChatroom].send_all(cmd)
+
+@register
+class AliasHandler(Handler):
+    type = 'alias'
+    requires_user = False
+
+    def validate(self, server, cmd: Command, user: User):
+        if not isinstance(cmd.body, str):
+            return NAME_INVALID
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        # Get the chosen alias
+        alias = cmd.body
+
+        # Register the user, unless the alias is already in use
+        newUser = User(alias, sock)
+        if not server.add_user(newUser):
+            return 'alias_taken', "Alias '{}' already exist.".format(alias)
+
+        # Update the command
+        cmd.creator = newUser.alias
+        cmd.specificChatroom = util.defaultChatroom
+
+        log.info('user', 'alias accepted', type=cmd.type, alias=alias)
+
+        # let all users in default chatroom know about the connection, then catch the new user up
+        defaultChatroom = server.chatrooms[cmd.specificChatroom]
+        defaultChatroom.send_all(cmd)
+        if sock.bootstrap:
+            defaultChatroom.bootstrap(sock, newUser, server.chatroom_names())
+        else:
+            defaultChatroom.replay(sock)
+
+        # Clients that can resume get the token for it
+        if sock.resumable:
+            sessionCmd = Command()
+            sessionCmd.init_session(server.sessions.issue(newUser))
+            sessionCmd.send(sock)
+
+@register
+class ConnectHandler(Handler):
+    type = 'connect'
+    requires_user = False
+    local = True
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        address = "{}:{}".format(origin_address[0], origin_address[1])
+
+        log.info('connection', 'connected', type=cmd.type, address=address)
+
+        # Accept the wire features the client offers, old clients send no offer and stay on plain JSON
+        features = []
+        if isinstance(cmd.body, list):
+            features = [feature for feature in cmd.body if feature in wire.FEATURES]
+            if sock.compress_threshold <= 0 and 'zlib' in features:
+                features.remove('zlib')
+            if server.sessions is None and 'resume' in features:
+                features.remove('resume')
+            cmd.body = features
+
+        # let users know about connection, the features are only used after this reply
+        cmd.send(sock)
+        sock.encoding = 'binary' if 'binary' in features else 'json'
+        sock.batching = 'batch' in features
+        sock.bootstrap = 'bootstrap' in features
+        sock.resumable = 'resume' in features
+        if 'zlib' in features:
+            sock.deflater = Deflater(sock.compress_threshold)
+
+@register
+class DisconnectHandler(Handler):
+    type = 'disconnect'
+    requires_user = False
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        # Close the socket
+        sock.close()
+
+        # Remove the user
+        user, connectedChatrooms = server.remove_user(sock)
+        if user is None:
+            return
+
+        # Adds a tag that says who authored the command
+        cmd.creator = user.alias
+
+        log.info('connection', 'disconnected', type=cmd.type, alias=user.alias)
+
+        # Relays the message to all the other clients in the same chatrooms as the user who disconnected
+        for chatroom in connectedChatrooms:
+            chatroom.send_all(cmd)
+
+@register
+class ResumeHandler(Handler):
+    type = 'resume'
+    requires_user = False
+    local = True
+
+    def validate(self, server, cmd: Command, user: User):
+        # Sessions are only kept by single process servers, sharded and federated ones never offer the feature
+        if server.sessions is None:
+            return RESUME_DISABLED
+
+        if user is not None:
+            return RESUME_ALIASED
+
+        if not isinstance(cmd.body, dict) or not isinstance(cmd.body.get('token', None), str):
+            return RESUME_INVALID
+
+        seqs = cmd.body.get('seqs', None) or {}
+        if not isinstance(seqs, dict) or not all(isinstance(seq, int) and seq >= -1 for seq in seqs.values()):
+            return RESUME_INVALID
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        user = server.resume_session(cmd.body['token'], sock)
+        if user is None:
+            return RESUME_EXPIRED
+
+        # Nobody else hears about it, to the other members the user never left
+        log.info('user', 'session resumed', type=cmd.type, alias=user.alias)
+
+        chatrooms = server.get_all_chatrooms(user)
+        seqs = cmd.body.get('seqs', None) or {}
+
+        resumedCmd = Command()
+        resumedCmd.init_resumed(user.alias, [chatroom.name for chatroom in chatrooms])
+        resumedCmd.send(sock)
+
+        # Each chatroom sends what was missed in it and then delivers to the new connection
+        for chatroom in chatrooms:
+            chatroom.resume(sock, user, seqs.get(chatroom.name, None))
+
+@register
+class JoinChatroomHandler(Handler):
+    type = 'join_chatroom'
+
+    def validate(self, server, cmd: Command, user: User):
+        if not isinstance(cmd.body, str):
+            return NAME_INVALID
+
+        newChatroom = server.chatrooms.get(cmd.body, None)
+
+        if newChatroom is not None and newChatroom in server.memberships.get(user, ()):
+            return 'already_in_room', "You are already in chatroom '{}'.".format(cmd.body)
+
+        if newChatroom is None:
+            return 'no_such_room', "Chatroom '{}' doesn't exist.".format(cmd.body)
+
+        # Check if user is blocked from the room they are trying to join
+        if user.alias in newChatroom.blocked:
+            return 'blocked', "You are blocked from joining chatroom '{}'.".format(cmd.body)
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        userOccupies = server.get_all_chatrooms(user)
+        newChatroom = server.chatrooms.get(cmd.body, None)
+        if newChatroom is None:
+            return 'no_such_room', "Chatroom '{}' doesn't exist.".format(cmd.body)
+
+        # Move user from previous chatrooms to the new one
+        if not server.move_user(user, newChatroom):
+            return 'no_such_room', "Chatroom '{}' doesn't exist.".format(cmd.body)
+
+        log.info('room', 'joined', type=cmd.type, alias=user.alias, room=newChatroom.name)
+
+        # Adds a tag that says who authored the command
+        cmd.creator = user.alias
+
+        # Notify users in chatroom that user has joined, then catch the user up on the recent messages
+        newChatroom.send_all(cmd)
+        newChatroom.replay(sock)
+
+        # Notify users in old chatrooms that user joined a different one
+        for chatroom in userOccupies:
+            chatroom.send_all(cmd)
+
+@register
+class CreateChatroomHandler(Handler):
+    type = 'create_chatroom'
+
+    def validate(self, server, cmd: Command, user: User):
+        if not isinstance(cmd.body, str):
+            return NAME_INVALID
+
+        # Create chatroom if it doesnt already exist, if it does then let user know
+        if cmd.body in server.chatrooms:
+            return 'room_exists', "Chatroom \"{}\" already exists.".format(cmd.body)
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        if not server.add_chatroom(server.new_chatroom(cmd.body, user)):
+            return 'room_exists', "Chatroom \"{}\" already exists.".format(cmd.body)
+
+        log.info('room', 'created', type=cmd.type, alias=user.alias, room=cmd.body)
+
+        # Adds a tag that says who authored the command
+        cmd.creator = user.alias
+
+        # Let all users know about the new chatroom
+        server.send_all(cmd)
+
+@register
+class DeleteChatroomHandler(Handler):
+    type = 'delete_chatroom'
+
+    def validate(self, server, cmd: Command, user: User):
+        if not isinstance(cmd.body, str):
+            return NAME_INVALID
+
+        chatroom = server.chatrooms.get(cmd.body, None)
+
+        # Send error if chatroom doesnt exist
+        if chatroom is None:
+            return 'no_such_room', "Chatroom \"{}\" doesn't exist.".format(cmd.body)
+
+        # Send error if user doesnt own the chatroom
+        if chatroom.owner is not user:
+            return 'not_owner', "Chatroom \"{}\" is not owned by you so you cannot delete it.".format(chatroom.name)
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        chatroom = server.remove_chatroom(cmd.body)
+        if chatroom is None:
+            return 'no_such_room', "Chatroom \"{}\" doesn't exist.".format(cmd.body)
+
+        # The name is free again, a room created with it before evacuate runs must not reuse this log's directory
+        if chatroom.log is not None:
+            server.log_store.retire(chatroom.log)
+
+        # Adds a tag that says who authored the command
+        cmd.creator = user.alias
+
+        # The room moves its members out itself, after any work already queued for it
+        chatroom.post(self.evacuate, server, chatroom, cmd)
+
+    def evacuate(self, server, chatroom: Chatroom, cmd: Command):
+        # Move all current users in chatroom to default room
+        userList = server.move_to_default(list(chatroom.users.values()))
+
+        # Let all users know about the deleted chatroom
+        server.send_all(cmd)
+
+        # Nobody can fetch the history of a deleted room, and a new room with the same name starts empty
+        if chatroom.log is not None:
+            chatroom.log.destroy()
+            chatroom.log = None
+        if chatroom.recent is not None:
+            server.scrollback.discard(chatroom.recent)
+            chatroom.recent = None
+
+        # Let all users know about the joins to default chatroom, in one batch
+        joinCmds = []
+        for movedUser in userList:
+            joinCmd = Command()
+            joinCmd.init_join_chatroom(util.defaultChatroom)
+            joinCmd.creator = movedUser.alias
+            joinCmds.append(joinCmd)
+
+        if joinCmds:
+            joinBatch = Command()
+            joinBatch.init_batch(joinCmds)
+            server.chatrooms[util.defaultChatroom].send_all(joinBatch)
+
+        log.info('room', 'deleted', type=cmd.type, alias=cmd.creator, room=chatroom.name)
+
+@register
+class BlockUserHandler(Handler):
+    type = 'block_user'
+
+    def validate(self, server, cmd: Command, user: User):
+        if not isinstance(cmd.body, str):
+            return NAME_INVALID
+
+        # Find location of blocker and of the user being blocked
+        blocker_rooms = server.get_all_chatrooms(user)
+        blocked_user = server.aliases.get(cmd.body, None)
+
+        # Check if they are the owner of the room they're in
+        if blocker_rooms and blocker_rooms[0].owner is not user:
+            return 'not_owner', "You don't own chatroom {}, so you can't block users from joining it.".format(blocker_rooms[0].name)
+
+        # If the user can't be found
+        if not blocker_rooms or blocked_user is None:
+            return 'no_such_user', "User \"{}\" does not exist.".format(cmd.body)
+
+        # Check if the user is trying to block themselves (it should have been a feature, but sterlinglaird is lame)
+        if user == blocked_user:
+            return BLOCK_SELF
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        # Either user can have left since validate, other threads handle their commands
+        user_rooms = server.get_all_chatrooms(user)
+        blocked_user = server.aliases.get(cmd.body, None)
+        if not user_rooms or blocked_user is None:
+            return 'no_such_user', "User \"{}\" does not exist.".format(cmd.body)
+        user_location = user_rooms[0]
+
+        # In a federation the user can be in a room hosted by another node, which is not told
+        blocked_rooms = server.get_all_chatrooms(blocked_user)
+        blocked_user_location = blocked_rooms[0] if blocked_rooms else None
+
+        # In a federation the default chatroom can be hosted by another node, which tells its own members about the join
+        defaultChatroom = server.chatrooms.get(util.defaultChatroom, None)
+
+        # Block the user
+        user_location.block_user(blocked_user)
+
+        # Add a tag that says who authored the command
+        cmd.creator = user.alias
+
+        # Add a tag that says which room the user is blocked from
+        cmd.specificChatroom = user_location.name
+
+        # Let all users in the blocker's room know about the block
+        user_location.send_all(cmd)
+
+        # If the blocker and the user being blocked are in the same room
+        if user_location == blocked_user_location:
+            # Remove the blocked user from the room, and return them to Default
+            server.move_to_default([blocked_user])
+        elif blocked_user_location is not None:
+            # Let the blocked user's room know about the block (console logging only)
+            blocked_user_location.send_all(cmd)
+
+        # Let user know they've been forced into default chatroom
+        join_cmd = Command()
+        join_cmd.init_join_chatroom(util.defaultChatroom)
+        join_cmd.creator = blocked_user.alias
+
+        # Let all users in new chatroom know that user has joined
+        if defaultChatroom is not None:
+            defaultChatroom.send_all(join_cmd)
+
+        # Let all users in old chatroom know that user has left, as long as we havent already sent the message in the line above
+        if blocked_user_location is not None and blocked_user_location is not defaultChatroom:
+            blocked_user_location.send_all(join_cmd)
+
+        log.info('room', 'blocked', type=cmd.type, alias=user.alias, target=cmd.body, room=user_location.name)
+
+@register
+class UnblockUserHandler(Handler):
+    type = 'unblock_user'
+
+    def validate(self, server, cmd: Command, user: User):
+        if not isinstance(cmd.body, str):
+            return NAME_INVALID
+
+        # Find location of unblocker and of the user being unblocked
+        unblocker_rooms = server.get_all_chatrooms(user)
+        blocked_user = server.aliases.get(cmd.body, None)
+
+        # Check if they are the owner of the room they're in
+        if unblocker_rooms and unblocker_rooms[0].owner is not user:
+            return 'not_owner', "You are not the owner of chatroom {}, so you cannot unblock blocked users.".format(unblocker_rooms[0].name)
+
+        # If the user can't be found
+        if not unblocker_rooms or blocked_user is None:
+            return 'no_such_user', "User \"{}\" does not exist.".format(cmd.body)
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        # Either user can have left since validate, other threads handle their commands
+        user_rooms = server.get_all_chatrooms(user)
+        blocked_user = server.aliases.get(cmd.body, None)
+        if not user_rooms or blocked_user is None:
+            return 'no_such_user', "User \"{}\" does not exist.".format(cmd.body)
+        user_location = user_rooms[0]
+
+        # In a federation the user can be in a room hosted by another node, which is not told
+        blocked_rooms = server.get_all_chatrooms(blocked_user)
+        blocked_user_location = blocked_rooms[0] if blocked_rooms else None
+
+        # unlock the user
+        user_location.unblock_user(blocked_user)
+
+        log.info('room', 'unblocked', type=cmd.type, alias=user.alias, target=cmd.body, room=user_location.name)
+
+        # Add a tag that says who authored the command
+        cmd.creator = user.alias
+
+        # Add a tag that says which room the user is unblocked from
+        cmd.specificChatroom = user_location.name
+
+        # Let all users in the room know about the unblock
+        user_location.send_all(cmd)
+
+        if blocked_user_location is not None and user_location != blocked_user_location:
+            # Let the blocked user's room know about the block
+            blocked_user_location.send_all(cmd)
+
+@register
+class GetChatroomsHandler(Handler):
+    type = 'get_chatrooms'
+    requires_user = False
+    local = True
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        get_chatrooms_cmd = Command()
+        get_chatrooms_cmd.init_get_chatrooms(server.chatroom_names())
+        get_chatrooms_cmd.send(sock)
+
+@register
+class ListUsersHandler(Handler):
+    type = 'list_users'
+    local = True
+
+    def validate(self, server, cmd: Command, user: User):
+        if not isinstance(cmd.body, str):
+            return NAME_INVALID
+
+        if cmd.body not in server.chatrooms:
+            return 'no_such_room', "Chatroom '{}' doesn't exist.".format(cmd.body)
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        chatroom = server.chatrooms.get(cmd.body, None)
+        if chatroom is None:
+            return 'no_such_room', "Chatroom '{}' doesn't exist.".format(cmd.body)
+
+        # The members are read in the room, in order with the joins and leaves queued before
+        chatroom.post(self.send_user_list, server, chatroom, sock, user)
+
+    def send_user_list(self, server, chatroom: Chatroom, sock: socket, user: User):
+        # send every user in the chatroom except the current user, a page at a time for very large rooms
+        aliases = [alias for alias in chatroom.users if alias != user.alias]
+        for start in range(0, len(aliases), server.list_users_page):
+            responseCmd = Command()
+            responseCmd.init_user_list(chatroom.name, aliases[start:start + server.list_users_page])
+            try:
+                responseCmd.send(sock)
+            except ConnectionError:
+                return
+
+        log.info('query', 'listed users', type='list_users', alias=user.alias, room=chatroom.name, count=len(aliases))
+
+@register
+class HistoryHandler(Handler):
+    type = 'history'
+    local = True
+
+    def validate(self, server, cmd: Command, user: User):
+        if server.log_store is None:
+            return HISTORY_DISABLED
+
+        if not isinstance(cmd.specificChatroom, str):
+            return NAME_INVALID
+
+        chatroom = server.chatrooms.get(cmd.specificChatroom, None)
+        if chatroom is None:
+            return 'no_such_room', "Chatroom '{}' doesn't exist.".format(cmd.specificChatroom)
+
+        if user.alias in chatroom.blocked:
+            return 'blocked', "You are blocked from chatroom '{}'.".format(chatroom.name)
+
+        if not isinstance(cmd.body, dict):
+            return HISTORY_INVALID
+
+        start = cmd.body.get('start', None)
+        limit = cmd.body.get('limit', None)
+        if start is not None and (not isinstance(start, int) or start < 0) or not isinstance(limit, int) or limit < 1:
+            return HISTORY_INVALID
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        chatroom = server.chatrooms.get(cmd.specificChatroom, None)
+        if chatroom is None:
+            return 'no_such_room', "Chatroom '{}' doesn't exist.".format(cmd.specificChatroom)
+
+        # Read in the room so the range is consistent with the messages it is relaying
+        chatroom.post(self.send_history, chatroom, sock, user, cmd.body.get('start', None), min(cmd.body['limit'], server.history_limit))
+
+    def send_history(self, chatroom: Chatroom, sock: socket, user: User, start: int, limit: int):
+        messageLog = chatroom.log
+        if messageLog is None:
+            return
+
+        if start is None:
+            start = messageLog.next_seq - limit
+        start, end, data = messageLog.read(start, limit)
+
+        # The logged messages are complete frames already
+        chatroom.send_history(sock, start, end, data)
+
+        log.info('query', 'sent history', type='history', alias=user.alias, room=chatroom.name, start=start, end=end)
+
+@register
+class StatsHandler(Handler):
+    type = 'stats'
+    requires_user = False
+    local = True
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        # There are no admin accounts, the metrics are for whoever runs the server
+        if not ipaddress.ip_address(origin_address[0]).is_loopback:
+            return STATS_LOCAL_ONLY
+
+        # In sharded mode these are the metrics of the worker the client is connected to
+        cmd.body = server.metrics.exposition()
+        cmd.send(sock)
+
+@register
+class PingHandler(Handler):
+    type = 'ping'
+    requires_user = False
+    local = True
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        # Clients ping to check the server is still there, the frame itself already counted as activity
+        pongCmd = Command()
+        pongCmd.init_pong()
+        pongCmd.send(sock)
+
+@register
+class PongHandler(Handler):
+    type = 'pong'
+    requires_user = False
+    local = True
+
+    def handle(self, server, cmd: Command, origin_address: (str, int), sock: socket, user: User):
+        # The answer to the server's ping, reading it was all the heartbeat needed
+        pass
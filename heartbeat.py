@@ -0,0 +1,139 @@
+from threading import Lock
+import math
+import time
+
+class TimerWheel:
+    def __init__(self, tick=1.0, slots=64, levels=4):
+        """
+        Hierarchical timing wheels holding one timer per key. The first wheel has a slot per tick, each wheel
+        above it a slot per turn of the one below, so 64 slots on 4 levels cover 16 million ticks. Scheduling
+        and cancelling are a dict update, and advancing by a tick empties one slot of the first wheel and,
+        once every turn, moves the timers of one slot above down a level, whatever the number of timers.
+        Not thread safe, the owner holds a lock around it.
+        """
+
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.start = time.monotonic()
+        self.current = 0
+
+        # key -> the slot its timer is in
+        self.timers = {}
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, key, delay: float):
+        """
+        Sets the timer of key to expire in delay seconds, rounded up to whole ticks, replacing any earlier one.
+        """
+
+        self.cancel(key)
+        self.place(key, self.current + max(1, math.ceil(delay / self.tick)))
+
+    def place(self, key, expiry: int):
+        remaining = expiry - self.current
+        level = 0
+        while level < self.levels - 1 and remaining >= self.slots ** (level + 1):
+            level += 1
+
+        slot = self.wheels[level][(expiry // self.slots ** level) % self.slots]
+        slot[key] = expiry
+        self.timers[key] = slot
+
+    def cancel(self, key):
+        slot = self.timers.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def advance(self, now: float=None):
+        """
+        Moves the wheels up to the time now, time.monotonic() by default, and returns the keys whose timers expired.
+        """
+
+        if now is None:
+            now = time.monotonic()
+
+        target = int((now - self.start) / self.tick)
+        expired = []
+        while self.current < target:
+            self.current += 1
+
+            # Timers of the slot above that comes up next are due within its span, they go down to finer slots
+            for level in range(1, self.levels):
+                span = self.slots ** level
+                if self.current % span:
+                    break
+
+                wheel = self.wheels[level]
+                idx = (self.current // span) % self.slots
+                slot, wheel[idx] = wheel[idx], {}
+                for key, expiry in slot.items():
+                    self.place(key, expiry)
+
+            wheel = self.wheels[0]
+            idx = self.current % self.slots
+            slot, wheel[idx] = wheel[idx], {}
+            for key in slot:
+                del self.timers[key]
+            expired.extend(slot)
+
+        return expired
+
+class Heartbeat:
+    def __init__(self, idle_timeout=60.0, ping_timeout=15.0, tick=1.0):
+        """
+        Finds clients that went quiet. A connection that has sent nothing for idle_timeout seconds is pinged,
+        and reaped if still nothing arrives within ping_timeout seconds of the ping. Reading a frame only stamps
+        the connection, the stamp is checked when the connection's timer in the wheel expires, so busy clients
+        cost nothing and a tick only touches the connections that are due. tick is the wheel's resolution in seconds.
+        """
+
+        self.idle_timeout = idle_timeout
+        self.ping_timeout = ping_timeout
+        self.tick = tick
+        self.wheel = TimerWheel(tick)
+
+        # The wheel is shared by the readers that watch and forget connections and the loop that ticks it
+        self.lock = Lock()
+
+    def watch(self, sock):
+        with self.lock:
+            self.wheel.schedule(sock, self.idle_timeout)
+
+    def forget(self, sock):
+        with self.lock:
+            self.wheel.cancel(sock)
+
+    def expire(self):
+        """
+        Advances the wheel and returns the connections to ping and the connections to reap.
+        Connections that sent something since their timer was set are scheduled again from their last frame.
+        """
+
+        now = time.monotonic()
+        ping = []
+        reap = []
+
+        with self.lock:
+            for sock in self.wheel.advance(now):
+                if sock.closed:
+                    continue
+
+                if sock.pinged is not None:
+                    if sock.last_received < sock.pinged:
+                        reap.append(sock)
+                        continue
+                    sock.pinged = None
+
+                idle = now - sock.last_received
+                if idle < self.idle_timeout:
+                    self.wheel.schedule(sock, self.idle_timeout - idle)
+                else:
+                    sock.pinged = now
+                    ping.append(sock)
+                    self.wheel.schedule(sock, self.ping_timeout)
+
+        return ping, reap
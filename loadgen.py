@@ -0,0 +1,505 @@
+from socket import *
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import signal
+import subprocess
+import sys
+import time
+
+# Custom Modules
+from command import Command
+from framing import FrameReader
+import util
+import wire
+
+# Prefix of message bodies sent by the load generator, followed by the send time in nanoseconds
+STAMP = 'lg'
+
+class Stats:
+    def __init__(self):
+        """
+        Counters shared by all simulated clients.
+        """
+
+        self.sent = 0
+        self.delivered = 0
+        self.errors = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.resumes = 0
+        self.joins = 0
+        self.latencies = []
+
+    def record_latency(self, sent_ns: int):
+        self.latencies.append((time.perf_counter_ns() - sent_ns) / 1e6)
+
+def percentile(values: list, fraction: float):
+    if not values:
+        return None
+
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class ServerProbe:
+    def __init__(self, pids: list):
+        """
+        Samples CPU time and resident memory of server processes and their children from /proc.
+        """
+
+        self.server_pids = pids
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.start_cpu = self.cpu_seconds()
+        self.max_rss = 0
+
+    def pids(self):
+        pids = list(self.server_pids)
+        for pid in pids:
+            try:
+                with open('/proc/{}/task/{}/children'.format(pid, pid)) as f:
+                    pids.extend(int(child) for child in f.read().split())
+            except OSError:
+                pass
+
+        return pids
+
+    def cpu_seconds(self):
+        total = 0
+        for pid in self.pids():
+            try:
+                with open('/proc/{}/stat'.format(pid)) as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                total += int(fields[11]) + int(fields[12])
+            except OSError:
+                pass
+
+        return total / self.ticks
+
+    def rss_bytes(self):
+        total = 0
+        for pid in self.pids():
+            try:
+                with open('/proc/{}/statm'.format(pid)) as f:
+                    total += int(f.read().split()[1]) * self.page_size
+            except OSError:
+                pass
+
+        return total
+
+    def sample(self):
+        self.max_rss = max(self.max_rss, self.rss_bytes())
+
+class SimClient:
+    def __init__(self, generator, idx: int):
+        """
+        A simulated chat client that talks to the server the same way the real client does.
+        """
+
+        self.generator = generator
+        self.idx = idx
+        self.generation = 0
+        self.sock = None
+        self.alias = None
+        self.chatroom = None
+        self.symbols = {}
+        self.encoding = 'json'
+        self.replayed = 0
+        self.accepted = asyncio.Event()
+        self.sending = asyncio.Lock()
+
+        # The session token and the last message number seen per room, for resuming after a dropped connection
+        self.token = None
+        self.seqs = {}
+        self.resuming = False
+
+    async def send(self, cmd: Command):
+        async with self.sending:
+            await self.generator.loop.sock_sendall(self.sock, cmd.frame(self.encoding))
+
+    async def connect(self):
+        """
+        Connects, sets an alias and waits until the server accepts it.
+        """
+
+        self.generation += 1
+        self.alias = "lg{}_{}".format(self.idx, self.generation)
+        self.chatroom = None
+        self.token = None
+        self.seqs = {}
+        await self.open()
+
+        cmd = Command()
+        cmd.init_set_alias(self.alias)
+        await self.send(cmd)
+
+        await self.accepted.wait()
+        self.generator.stats.connects += 1
+
+    async def open(self):
+        """
+        Opens a new connection and offers the wire features.
+        """
+
+        self.symbols = {}
+        self.encoding = 'json'
+        self.replayed = 0
+        self.accepted.clear()
+
+        # Clients are spread evenly over the servers
+        addresses = self.generator.addresses
+        self.sock = socket()
+        self.sock.setblocking(False)
+        await self.generator.loop.sock_connect(self.sock, addresses[self.idx % len(addresses)])
+        self.reader_task = self.generator.loop.create_task(self.read_loop(self.sock))
+
+        cmd = Command()
+        cmd.init_connect(self.generator.features)
+        await self.send(cmd)
+
+    async def close(self):
+        # The socket has to leave the event loop before it is closed, its descriptor is reused by the next connect
+        self.reader_task.cancel()
+        try:
+            await self.reader_task
+        except asyncio.CancelledError:
+            pass
+        async with self.sending:
+            self.sock.close()
+
+    async def disconnect(self):
+        self.accepted.clear()
+
+        cmd = Command()
+        cmd.init_disconnect()
+        try:
+            await self.send(cmd)
+        except OSError:
+            pass
+
+        await self.close()
+        self.generator.stats.disconnects += 1
+
+    async def reconnect(self):
+        """
+        Drops the connection without a word, as on a flaky network, and resumes the session on a new one.
+        Starts over with a new alias if the session could not be resumed.
+        """
+
+        await self.close()
+        await self.open()
+
+        self.resuming = True
+        cmd = Command()
+        cmd.init_resume(self.token, dict(self.seqs))
+        await self.send(cmd)
+
+        await self.accepted.wait()
+        if self.token is None:
+            await self.close()
+            await self.connect()
+            return
+
+        self.generator.stats.resumes += 1
+
+    async def join(self, chatroom: str):
+        cmd = Command()
+        cmd.init_join_chatroom(chatroom)
+        await self.send(cmd)
+
+    async def read_loop(self, sock: socket):
+        reader = FrameReader(sock)
+        stats = self.generator.stats
+
+        try:
+            while True:
+                for data in await reader.read_frames_async(self.generator.loop):
+                    for cmd in Command(data, self.symbols).commands():
+                        self.handle(cmd, stats)
+        except (OSError, ConnectionError):
+            pass
+
+    def handle(self, cmd: Command, stats: Stats):
+        if cmd.type == 'message':
+            if cmd.seq is not None:
+                self.seqs[cmd.specificChatroom] = max(cmd.seq, self.seqs.get(cmd.specificChatroom, -1))
+
+            # Scrollback and history are old messages, they say nothing about fan-out latency
+            if self.replayed:
+                self.replayed -= 1
+                return
+
+            stats.delivered += 1
+            if cmd.creator == self.alias and cmd.body.startswith(STAMP):
+                stats.record_latency(int(cmd.body.split(' ', 2)[1]))
+
+        elif cmd.type == 'connect':
+            if isinstance(cmd.body, list) and 'binary' in cmd.body:
+                self.encoding = 'binary'
+
+        elif cmd.type == 'alias' and cmd.creator == self.alias:
+            self.chatroom = util.defaultChatroom
+            self.accepted.set()
+
+        elif cmd.type == 'create_chatroom':
+            self.generator.created.add(cmd.body)
+
+        elif cmd.type == 'join_chatroom' and cmd.creator == self.alias:
+            self.chatroom = cmd.body
+            stats.joins += 1
+
+        elif cmd.type == 'history':
+            self.replayed = cmd.body['end'] - cmd.body['start']
+
+        elif cmd.type == 'session':
+            self.token = cmd.body
+
+        elif cmd.type == 'resume':
+            self.resuming = False
+            self.chatroom = cmd.body[0] if cmd.body else util.defaultChatroom
+            self.accepted.set()
+
+        elif cmd.type == 'error':
+            stats.errors += 1
+
+            # The session is gone, reconnect starts over
+            if self.resuming:
+                self.resuming = False
+                self.token = None
+                self.accepted.set()
+
+        elif cmd.type == 'ping':
+            # Quiet clients are pinged, the ones that dont answer are dropped
+            pongCmd = Command()
+            pongCmd.init_pong()
+            self.generator.loop.create_task(self.send(pongCmd))
+
+    async def chat(self, deadline: float):
+        """
+        Sends messages at the configured rate until the deadline, with jitter so clients dont send in lockstep.
+        """
+
+        generator = self.generator
+        padding = 'x' * generator.message_size
+
+        while time.monotonic() < deadline:
+            await asyncio.sleep(random.expovariate(generator.rate))
+            if not self.accepted.is_set() or self.chatroom is None:
+                continue
+
+            cmd = Command()
+            cmd.init_send_message("{} {} {}".format(STAMP, time.perf_counter_ns(), padding), self.chatroom)
+            try:
+                await self.send(cmd)
+                generator.stats.sent += 1
+            except OSError:
+                pass
+
+class LoadGenerator:
+    def __init__(self, args):
+        """
+        Runs many simulated clients against a server and reports throughput, latency and server cost.
+        With several nodes the clients are spread over the servers on consecutive ports from the given one.
+        """
+
+        self.addresses = [(args.host, args.port + node) for node in range(args.nodes)]
+        self.clients = args.clients
+        self.rooms = ["lgroom{}".format(idx) for idx in range(args.rooms)]
+        self.rate = args.rate
+        self.message_size = args.message_size
+        self.duration = args.duration
+        self.connect_rate = args.connect_rate
+        self.churn = args.churn
+        self.resume = args.resume
+        self.features = list(wire.FEATURES) if args.features == 'all' else [feature for feature in args.features.split(',') if feature]
+        self.stats = Stats()
+        self.created = set()
+        self.probe = ServerProbe(args.server_pids) if args.server_pids else None
+        self.loop = None
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+
+        # One client creates the rooms, every other client joins one of them
+        clients = [SimClient(self, idx) for idx in range(self.clients)]
+        await clients[0].connect()
+        for chatroom in self.rooms:
+            cmd = Command()
+            cmd.init_create_chatroom(chatroom)
+            await clients[0].send(cmd)
+
+        # Rooms can be created on another node than the one a client joins them through
+        for _ in range(500):
+            if self.created.issuperset(self.rooms):
+                break
+            await asyncio.sleep(0.01)
+
+        # Ramp up at the configured connect rate
+        start = time.monotonic()
+        for idx, client in enumerate(clients[1:], 1):
+            await client.connect()
+            await client.join(self.rooms[idx % len(self.rooms)])
+
+            delay = start + idx / self.connect_rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        ramp = time.monotonic() - start
+        print("{} clients connected in {:.1f}s".format(self.clients, ramp))
+
+        # Measure only the steady state
+        self.stats.sent = self.stats.delivered = 0
+        self.stats.latencies = []
+        if self.probe:
+            self.probe.start_cpu = self.probe.cpu_seconds()
+
+        start = time.monotonic()
+        deadline = start + self.duration
+        tasks = [self.loop.create_task(client.chat(deadline)) for client in clients]
+        tasks.append(self.loop.create_task(self.churn_loop(clients, deadline)))
+        tasks.append(self.loop.create_task(self.probe_loop(deadline)))
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - start
+
+        # Give in flight messages a moment to arrive
+        await asyncio.sleep(0.5)
+
+        for client in clients:
+            client.reader_task.cancel()
+            client.sock.close()
+
+        return self.report(elapsed, ramp)
+
+    async def churn_loop(self, clients: list, deadline: float):
+        """
+        Every second, moves some clients to another room and reconnects others, resuming their sessions with resume.
+        """
+
+        while time.monotonic() < deadline:
+            await asyncio.sleep(1)
+
+            for client in random.sample(clients[1:], int(self.churn * (len(clients) - 1))):
+                if not client.accepted.is_set():
+                    continue
+
+                if random.random() < 0.5:
+                    await client.join(random.choice(self.rooms))
+                elif self.resume and client.token is not None:
+                    await client.reconnect()
+                else:
+                    await client.disconnect()
+                    await client.connect()
+                    await client.join(random.choice(self.rooms))
+
+    async def probe_loop(self, deadline: float):
+        while self.probe and time.monotonic() < deadline:
+            self.probe.sample()
+            await asyncio.sleep(1)
+
+    def report(self, elapsed: float, ramp: float):
+        stats = self.stats
+        latencies = sorted(stats.latencies)
+
+        result = {
+            'config': {'clients': self.clients, 'nodes': len(self.addresses), 'rooms': len(self.rooms), 'rate': self.rate, 'duration': self.duration,
+                       'message_size': self.message_size, 'churn': self.churn, 'resume': self.resume, 'features': self.features},
+            'ramp_seconds': ramp,
+            'messages_sent': stats.sent,
+            'messages_per_sec': stats.sent / elapsed,
+            'deliveries_per_sec': stats.delivered / elapsed,
+            'latency_ms': {'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99),
+                           'p999': percentile(latencies, 0.999), 'max': latencies[-1] if latencies else None},
+            'errors': stats.errors,
+            'connects': stats.connects,
+            'disconnects': stats.disconnects,
+            'resumes': stats.resumes,
+            'joins': stats.joins,
+        }
+
+        if self.probe:
+            self.probe.sample()
+            result['server'] = {'cpu_cores': (self.probe.cpu_seconds() - self.probe.start_cpu) / elapsed,
+                                'max_rss_mb': self.probe.max_rss / (1024 * 1024)}
+
+        print("sent {:.0f} msg/s, delivered {:.0f} msg/s".format(result['messages_per_sec'], result['deliveries_per_sec']))
+        if latencies:
+            print("fan-out latency p50 {p50:.2f} ms, p99 {p99:.2f} ms, p999 {p999:.2f} ms".format(**result['latency_ms']))
+        if 'server' in result:
+            print("server cpu {cpu_cores:.2f} cores, max rss {max_rss_mb:.1f} MB".format(**result['server']))
+
+        return result
+
+def spawn_servers(server_args: str, host: str, port: int, nodes: int=1):
+    """
+    Starts server.py with the given arguments and waits until it accepts connections. With several nodes
+    they are started as a federation on consecutive ports, relaying to each other on the ports after those.
+    """
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    federation = []
+    if nodes > 1:
+        spec = ','.join("node{}={}:{}".format(node, host, port + nodes + node) for node in range(nodes))
+        federation = [['--node', "node{}".format(node), '--nodes', spec] for node in range(nodes)]
+
+    # Nodes only accept clients once they are linked to each other, so all of them are started before waiting on any
+    processes = []
+    for node in range(nodes):
+        command = [sys.executable, script, '--host', host, '--port', str(port + node)] + shlex.split(server_args)
+        processes.append(subprocess.Popen(command + (federation[node] if federation else []),
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+    for node in range(nodes):
+        for _ in range(100):
+            try:
+                create_connection((host, port + node)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            for process in processes:
+                process.kill()
+            raise RuntimeError("Server did not start")
+
+    return processes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Chappie load generator")
+    parser.add_argument('--host', default=gethostname())
+    parser.add_argument('--port', type=int, default=8585)
+    parser.add_argument('--nodes', type=int, default=1,
+                        help="number of servers on consecutive ports to spread the clients over, spawned as a federation")
+    parser.add_argument('--clients', type=int, default=1000, help="number of simulated clients")
+    parser.add_argument('--rooms', type=int, default=10, help="number of chatrooms the clients are spread over")
+    parser.add_argument('--rate', type=float, default=0.2, help="messages per second sent by each client")
+    parser.add_argument('--message-size', type=int, default=60, help="padding added to each message")
+    parser.add_argument('--duration', type=float, default=30, help="seconds of steady state to measure")
+    parser.add_argument('--connect-rate', type=float, default=500, help="new connections per second during ramp up")
+    parser.add_argument('--churn', type=float, default=0.01, help="fraction of clients switching rooms or reconnecting each second")
+    parser.add_argument('--resume', action='store_true',
+                        help="reconnecting clients drop their connection and resume their session instead of disconnecting")
+    parser.add_argument('--features', default='all', help="comma separated wire features to offer, 'all' or '' for plain JSON")
+    parser.add_argument('--server-pid', type=int, action='append', dest='server_pids',
+                        help="pid of a running server to sample CPU and memory from, can be repeated")
+    parser.add_argument('--spawn', metavar='SERVER_ARGS', help="start server.py with these arguments for the run, e.g. '--engine threaded'")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    servers = []
+    if args.spawn is not None:
+        servers = spawn_servers(args.spawn, args.host, args.port, args.nodes)
+        args.server_pids = [server.pid for server in servers]
+
+    try:
+        result = asyncio.run(LoadGenerator(args).run())
+    finally:
+        for server in servers:
+            # An interrupt lets a sharded server stop its workers too
+            server.send_signal(signal.SIGINT)
+        for server in servers:
+            server.wait()
+
+    result['server_args'] = args.spawn
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
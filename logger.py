@@ -0,0 +1,139 @@
+from threading import Thread, Condition
+from collections import deque
+import atexit
+import json
+import os
+import sys
+import time
+
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+LOG_FORMATS = ('text', 'json')
+
+class Logger:
+    def __init__(self, level='info', sampling: dict=None, queue_limit=65536, format='text', stream=None):
+        """
+        Structured logging that never blocks the caller on I/O. A record is a level, a category, an event and
+        named fields, queued as is and only formatted and written by a background writer thread.
+        Records below the level are skipped, sampling logs only one in every n records of a category,
+        and when more than queue_limit records are waiting new ones are dropped and counted.
+        """
+
+        self.level = LEVELS[level]
+        self.sampling = dict(sampling or {})
+        self.queue_limit = queue_limit
+        self.format = format
+        self.stream = stream
+        self.seen = {}
+        self.dropped = 0
+        self.reset()
+
+        atexit.register(self.flush)
+        os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        """
+        Starts over with an empty queue and no writer, also used in forked children where the writer thread is gone.
+        """
+
+        self.queue = deque()
+        self.ready = Condition()
+        self.writer = None
+        self.writing = False
+
+    def configure(self, level: str=None, sampling: dict=None, queue_limit: int=None, format: str=None):
+        if level is not None:
+            self.level = LEVELS[level]
+        if sampling is not None:
+            self.sampling = dict(sampling)
+        if queue_limit is not None:
+            self.queue_limit = queue_limit
+        if format is not None:
+            self.format = format
+
+    def log(self, level: str, category: str, event: str, **fields):
+        if LEVELS[level] < self.level:
+            return
+
+        # Unsynchronized on purpose, a sample that is off by one now and then costs nothing
+        every = self.sampling.get(category, 1)
+        if every > 1:
+            seen = self.seen.get(category, 0) + 1
+            self.seen[category] = seen
+            if seen % every:
+                return
+
+        record = (time.time(), level, category, event, fields)
+        with self.ready:
+            if len(self.queue) >= self.queue_limit:
+                self.dropped += 1
+                return
+
+            self.queue.append(record)
+            if self.writer is None:
+                self.writer = Thread(target=self.write_loop, name='logger', daemon=True)
+                self.writer.start()
+            elif len(self.queue) == 1:
+                # The writer only waits when the queue is empty
+                self.ready.notify_all()
+
+    def debug(self, category: str, event: str, **fields):
+        self.log('debug', category, event, **fields)
+
+    def info(self, category: str, event: str, **fields):
+        self.log('info', category, event, **fields)
+
+    def warning(self, category: str, event: str, **fields):
+        self.log('warning', category, event, **fields)
+
+    def error(self, category: str, event: str, **fields):
+        self.log('error', category, event, **fields)
+
+    def write_loop(self):
+        while True:
+            with self.ready:
+                while not self.queue:
+                    self.ready.wait()
+
+                records = self.queue
+                self.queue = deque()
+                self.writing = True
+
+            stream = self.stream or sys.stdout
+            try:
+                stream.write(''.join(self.format_record(*record) for record in records))
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+
+            with self.ready:
+                self.writing = False
+                self.ready.notify_all()
+
+    def format_record(self, timestamp: float, level: str, category: str, event: str, fields: dict):
+        if self.format == 'json':
+            return json.dumps(dict({'ts': timestamp, 'level': level, 'category': category, 'event': event}, **fields)) + '\n'
+
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(timestamp)) + '.{:03d}'.format(int(timestamp % 1 * 1000))
+        pairs = ''.join(' {}={}'.format(key, format_value(value)) for key, value in fields.items())
+        return "{} {:<7} {:<10} {}{}\n".format(stamp, level.upper(), category, event, pairs)
+
+    def flush(self, timeout=1.0):
+        """
+        Waits up to timeout seconds for the queued records to be written.
+        """
+
+        deadline = time.monotonic() + timeout
+        with self.ready:
+            while (self.queue or self.writing) and self.writer is not None and time.monotonic() < deadline:
+                self.ready.wait(deadline - time.monotonic())
+
+def format_value(value):
+    # Quote anything a reader could not split on spaces
+    text = str(value)
+    if not text or any(c in text for c in ' ="\n'):
+        return json.dumps(text)
+    return text
+
+# Process wide logger, the server configures it from its command line
+log = Logger()
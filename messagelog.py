@@ -0,0 +1,294 @@
+from bisect import bisect_right
+from threading import Lock
+import mmap
+import os
+import secrets
+import shutil
+import struct
+import time
+
+# What the log does to make appended messages durable
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+class Segment:
+    def __init__(self, path: str, base: int, size: int=0):
+        """
+        One file of a message log, holding the records numbered from base onwards.
+        A record is a complete length prefixed message frame, so a range of records can be sent as is.
+        The active segment is preallocated to its full size and written through a shared mapping,
+        the unused tail is zeros and a zero length marks the end of the records.
+        """
+
+        self.path = path
+        self.base = base
+        self.end = 0
+        self.count = 0
+
+        # Sparse index, (record number, position) for every index_interval-th record
+        self.index_seqs = []
+        self.index_positions = []
+        self.indexed = False
+
+        if size:
+            with open(path, 'wb') as f:
+                f.truncate(size)
+
+        with open(path, 'r+b') as f:
+            self.mm = mmap.mmap(f.fileno(), 0)
+
+    def scan(self, index_interval: int):
+        """
+        Finds the end of the records and builds the sparse index, only reading the length headers.
+        """
+
+        mm = self.mm
+        size = len(mm)
+        pos = 0
+        count = 0
+        self.index_seqs = []
+        self.index_positions = []
+
+        while pos + 4 <= size:
+            length, = struct.unpack_from('!I', mm, pos)
+            if length == 0 or pos + 4 + length > size:
+                break
+
+            if count % index_interval == 0:
+                self.index_seqs.append(self.base + count)
+                self.index_positions.append(pos)
+            pos += 4 + length
+            count += 1
+
+        self.end = pos
+        self.count = count
+        self.indexed = True
+
+    def append(self, frame: bytes, index_interval: int):
+        """
+        Writes a record, returns False if it does not fit.
+        """
+
+        if self.end + len(frame) > len(self.mm):
+            return False
+
+        if self.count % index_interval == 0:
+            self.index_seqs.append(self.base + self.count)
+            self.index_positions.append(self.end)
+
+        # The header goes in last, until then the zeros there still mark the end
+        self.mm[self.end + 4:self.end + len(frame)] = frame[4:]
+        self.mm[self.end:self.end + 4] = frame[:4]
+        self.end += len(frame)
+        self.count += 1
+        return True
+
+    def position(self, seq: int):
+        """
+        Returns where a record starts, walking forward from the closest indexed record before it.
+        """
+
+        idx = bisect_right(self.index_seqs, seq) - 1
+        pos = self.index_positions[idx]
+        mm = self.mm
+
+        for _ in range(seq - self.index_seqs[idx]):
+            pos += 4 + struct.unpack_from('!I', mm, pos)[0]
+
+        return pos
+
+    def seal(self):
+        """
+        Trims the preallocated tail once the segment is full and maps it read only.
+        """
+
+        self.mm.flush()
+        self.mm.close()
+        os.truncate(self.path, self.end)
+
+        with open(self.path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+class MessageLog:
+    def __init__(self, directory: str, segment_bytes=16 * 1024 * 1024, max_segments=8, fsync='interval',
+                 fsync_interval=1.0, index_interval=64):
+        """
+        An append-only log of the messages relayed in one chatroom, split over segment files named after
+        the number of their first record. Full segments are sealed, and beyond max_segments the oldest is deleted.
+        Reads map the segments, so fetching history never reads whole files or allocates per record.
+        Not thread safe, a chatroom only uses its log from its own mailbox. Only retire is called from elsewhere.
+        """
+
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.index_interval = index_interval
+        self.last_sync = time.monotonic()
+        self.segments = []
+
+        # Held while file paths are in use, so retire can move the files from another thread
+        self.lock = Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+        # Reopen existing segments, only the active one is scanned now, sealed ones when they are first read
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.log'))
+        for base in bases:
+            path = self.segment_path(base)
+            self.segments.append(Segment(path, base, 0 if os.path.getsize(path) else segment_bytes))
+
+        if self.segments:
+            for segment, following in zip(self.segments, self.segments[1:]):
+                segment.end = len(segment.mm)
+                segment.count = following.base - segment.base
+            self.segments[-1].scan(index_interval)
+        else:
+            self.segments.append(Segment(self.segment_path(0), 0, segment_bytes))
+
+    @property
+    def first_seq(self):
+        return self.segments[0].base
+
+    @property
+    def next_seq(self):
+        active = self.segments[-1]
+        return active.base + active.count
+
+    def segment_path(self, base: int):
+        return os.path.join(self.directory, "{:020d}.log".format(base))
+
+    def append(self, frame: bytes):
+        """
+        Appends a message frame and returns its sequence number.
+        """
+
+        seq = self.next_seq
+        if not self.segments[-1].append(frame, self.index_interval):
+            self.rotate(len(frame))
+            self.segments[-1].append(frame, self.index_interval)
+
+        if self.fsync == 'always' or self.fsync == 'interval' and time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+        return seq
+
+    def sync(self):
+        self.segments[-1].mm.flush()
+        self.last_sync = time.monotonic()
+
+    def rotate(self, needed: int):
+        """
+        Seals the active segment, starts a new one and applies retention.
+        """
+
+        with self.lock:
+            active = self.segments[-1]
+            if active.count == 0:
+                # Only a record larger than a whole segment gets here, give it a segment of its own size
+                active.close()
+                self.segments[-1] = Segment(active.path, active.base, needed)
+                return
+
+            active.seal()
+            self.segments.append(Segment(self.segment_path(self.next_seq), self.next_seq, max(self.segment_bytes, needed)))
+
+            while len(self.segments) > self.max_segments:
+                oldest = self.segments.pop(0)
+                oldest.close()
+                os.remove(oldest.path)
+
+    def read(self, start: int, limit: int):
+        """
+        Returns the records from start on, at most limit of them, as (first, end, data).
+        Start is clamped to the records still retained, and data is the records as consecutive frames.
+        """
+
+        start = max(start, self.first_seq)
+        end = min(start + limit, self.next_seq)
+        if start >= end:
+            return start, start, b''
+
+        views = []
+        idx = bisect_right([segment.base for segment in self.segments], start) - 1
+        seq = start
+
+        while seq < end:
+            segment = self.segments[idx]
+            if not segment.indexed:
+                segment.scan(self.index_interval)
+
+            last = min(end, segment.base + segment.count)
+            stop = segment.end if last == segment.base + segment.count else segment.position(last)
+            views.append(memoryview(segment.mm)[segment.position(seq):stop])
+
+            seq = last
+            idx += 1
+
+        data = b''.join(views)
+        for view in views:
+            view.release()
+
+        return start, end, data
+
+    def close(self):
+        self.sync()
+        for segment in self.segments:
+            segment.close()
+
+    def retire(self, directory: str):
+        """
+        Moves the log's files to directory, where destroy deletes them later. The log keeps working meanwhile.
+        """
+
+        with self.lock:
+            os.rename(self.directory, directory)
+            self.directory = directory
+            for segment in self.segments:
+                segment.path = os.path.join(directory, os.path.basename(segment.path))
+
+    def destroy(self):
+        """
+        Closes the log and deletes its files.
+        """
+
+        for segment in self.segments:
+            segment.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+class LogStore:
+    def __init__(self, directory: str, **log_options):
+        """
+        Keeps one MessageLog per chatroom in a directory named after the room.
+        The options are passed to every MessageLog.
+        """
+
+        self.directory = directory
+        self.log_options = log_options
+
+        # Logs of deleted rooms that were not destroyed before a restart
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if name.endswith('.deleted'):
+                    shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    def room_directory(self, name: str):
+        # Room names are arbitrary text, hex keeps them safe as directory names
+        return os.path.join(self.directory, name.encode(encoding='UTF-8').hex())
+
+    def open(self, name: str):
+        return MessageLog(self.room_directory(name), **self.log_options)
+
+    def retire(self, log: MessageLog):
+        """
+        Moves the log of a deleted room out of the way, so a new room with the same name starts a fresh log
+        even while the old one is still waiting to be destroyed.
+        """
+
+        # Hex names never contain a dot, so retired directories cannot clash with a room's
+        log.retire("{}.{}.deleted".format(log.directory, secrets.token_hex(8)))
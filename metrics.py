@@ -0,0 +1,133 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+from bisect import bisect_left
+
+# Custom Modules
+from logger import log
+
+# Seconds, for timing how long the server takes to handle a command
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 1.0)
+
+# Recipients of a single broadcast
+FANOUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+class Histogram:
+    def __init__(self, bounds: tuple):
+        """
+        Counts observations in buckets with the given upper bounds, plus one for everything above the last.
+        """
+
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    def __init__(self):
+        """
+        Counters and histograms updated as the server works, and collectors that read gauges only when scraped.
+        Recording is a dict update under a lock, everything else happens when someone asks for the exposition.
+        Labels are tuples of (name, value) pairs.
+        """
+
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.descriptions = {}
+        self.bounds = {}
+        self.collectors = []
+
+    def describe(self, name: str, kind: str, text: str, bounds: tuple=None):
+        """
+        Declares a metric, kind is counter, gauge or histogram. Histograms need their bucket bounds.
+        """
+
+        self.descriptions[name] = (kind, text)
+        if bounds is not None:
+            self.bounds[name] = bounds
+
+    def count(self, name: str, labels: tuple=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value, labels: tuple=()):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key, None)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.bounds[name])
+            histogram.observe(value)
+
+    def collector(self, fn):
+        """
+        Registers a function returning (name, labels, value) samples, called on every scrape.
+        """
+
+        self.collectors.append(fn)
+
+    def exposition(self):
+        """
+        Returns every metric in the Prometheus text format.
+        """
+
+        samples = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                samples.setdefault(name, []).append((name, labels, value))
+
+            for (name, labels), histogram in self.histograms.items():
+                cumulative = 0
+                for bound, count in zip(self.bounds[name] + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    samples.setdefault(name, []).append((name + '_bucket', labels + (('le', bound),), cumulative))
+                samples[name].append((name + '_sum', labels, histogram.sum))
+                samples[name].append((name + '_count', labels, histogram.count))
+
+        for fn in self.collectors:
+            for name, labels, value in fn():
+                samples.setdefault(name, []).append((name, labels, value))
+
+        lines = []
+        for name in sorted(samples):
+            kind, text = self.descriptions.get(name, ('untyped', ''))
+            lines.append("# HELP {} {}".format(name, text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for sample, labels, value in samples[name]:
+                lines.append("{}{} {}".format(sample, format_labels(labels), value))
+
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels: tuple):
+    if not labels:
+        return ''
+
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join('{}="{}"'.format(key, value) for (key, _), value in zip(labels, escaped)) + '}'
+
+def serve_metrics(metrics: Metrics, address: (str, int)):
+    """
+    Serves the exposition over HTTP on a background thread, for scrapers. Any GET returns it.
+    """
+
+    class ExpositionHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            data = metrics.exposition().encode(encoding='UTF-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = HTTPServer(address, ExpositionHandler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    log.info('server', 'serving metrics', url="http://{}:{}/metrics".format(*address))
+    return httpd
@@ -0,0 +1,113 @@
+from threading import Lock
+import time
+
+# What happens to a connection that sends faster than its limit
+FLOOD_POLICIES = ('throttle', 'pause', 'disconnect')
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        """
+        Allows rate operations per second on average and bursts of up to burst at once.
+        """
+
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self, cost=1):
+        """
+        Takes cost tokens if there are enough, returns whether it did.
+        """
+
+        self.refill()
+        if self.tokens < cost:
+            return False
+
+        self.tokens -= cost
+        return True
+
+    def reserve(self, cost=1):
+        """
+        Takes cost tokens even if that leaves the bucket in debt, returns how many seconds until the debt is paid.
+        """
+
+        self.refill()
+        self.tokens -= cost
+        return max(0.0, -self.tokens / self.rate)
+
+class FloodControl:
+    def __init__(self, policy='throttle', connection_rate=0.0, connection_burst=0.0, user_rate=0.0, user_burst=0.0,
+                 room_rate=0.0, room_burst=0.0):
+        """
+        Token bucket limits on what clients send. Every connection is limited in frames per second, checked before
+        a frame is parsed, and chat messages are also limited per alias and per room. A rate of 0 turns a limit off.
+        Over the connection limit the policy applies: throttle rejects the frame, pause stops reading the connection
+        until it is within its limit again, and disconnect closes it. Over the alias or room limit the message is
+        rejected, or the sender disconnected with the disconnect policy.
+        """
+
+        self.policy = policy
+        self.connection_rate = connection_rate
+        self.connection_burst = max(connection_burst, 1)
+        self.user_rate = user_rate
+        self.user_burst = max(user_burst, 1)
+        self.room_rate = room_rate
+        self.room_burst = max(room_burst, 1)
+
+        # Buckets by alias and by room name, a user's messages can be read on different threads in turn
+        # and a room's on many at once
+        self.users = {}
+        self.rooms = {}
+        self.lock = Lock()
+
+    def connection_bucket(self):
+        """
+        Returns a bucket for a new connection, or None without a connection limit.
+        """
+
+        if not self.connection_rate:
+            return None
+
+        return TokenBucket(self.connection_rate, self.connection_burst)
+
+    def check_message(self, alias: str, room: str):
+        """
+        Takes a token for a chat message from its sender's and its room's buckets.
+        Returns None if both allow it, otherwise 'user' or 'room', and then no token is taken from either.
+        """
+
+        with self.lock:
+            user = None
+            if self.user_rate and alias is not None:
+                user = self.users.get(alias, None)
+                if user is None:
+                    user = self.users[alias] = TokenBucket(self.user_rate, self.user_burst)
+                user.refill()
+                if user.tokens < 1:
+                    return 'user'
+
+            if self.room_rate and room is not None:
+                bucket = self.rooms.get(room, None)
+                if bucket is None:
+                    bucket = self.rooms[room] = TokenBucket(self.room_rate, self.room_burst)
+                if not bucket.take():
+                    return 'room'
+
+            if user is not None:
+                user.tokens -= 1
+
+        return None
+
+    def forget_user(self, alias: str):
+        with self.lock:
+            self.users.pop(alias, None)
+
+    def forget_room(self, name: str):
+        with self.lock:
+            self.rooms.pop(name, None)
@@ -0,0 +1,106 @@
+from threading import Lock
+from collections import deque
+import itertools
+
+class Ring:
+    def __init__(self, scrollback, next_seq: int=0):
+        """
+        The latest message frames of one chatroom, oldest first. next_seq is the number the next message gets,
+        the same numbering as the room's message log.
+        """
+
+        self.scrollback = scrollback
+        self.frames = deque()
+        self.size = 0
+        self.next_seq = next_seq
+
+    @property
+    def first_seq(self):
+        return self.next_seq - len(self.frames)
+
+    def append(self, frame: bytes):
+        self.scrollback.append(self, frame)
+
+    def snapshot(self):
+        """
+        Returns (start, end, data) with the buffered frames joined back to back.
+        """
+
+        with self.scrollback.lock:
+            return self.next_seq - len(self.frames), self.next_seq, b''.join(self.frames)
+
+    def since(self, seq: int):
+        """
+        Returns (start, end, data) for the buffered frames from number seq on, start is later than seq
+        if the frames before it are no longer buffered.
+        """
+
+        with self.scrollback.lock:
+            start = min(max(seq, self.first_seq), self.next_seq)
+            return start, self.next_seq, b''.join(itertools.islice(self.frames, start - self.first_seq, None))
+
+    def pop_oldest(self):
+        """
+        Drops the oldest frame and returns its size, called with the scrollback lock held.
+        """
+
+        size = len(self.frames.popleft())
+        self.size -= size
+        return size
+
+class Scrollback:
+    def __init__(self, max_messages=50, max_bytes=64 * 1024, total_bytes=64 * 1024 * 1024):
+        """
+        Bounded buffers of recent message frames for every chatroom, so a joining user can be sent them right away.
+        Each room keeps at most max_messages frames and max_bytes bytes. When all rooms together go over total_bytes,
+        the largest buffers are trimmed first until everything fits in nine tenths of it.
+        """
+
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.total_bytes = total_bytes
+        self.total = 0
+        self.rings = set()
+        self.lock = Lock()
+
+    def ring(self, next_seq: int=0):
+        ring = Ring(self, next_seq)
+        with self.lock:
+            self.rings.add(ring)
+
+        return ring
+
+    def discard(self, ring: Ring):
+        with self.lock:
+            self.rings.discard(ring)
+            self.total -= ring.size
+            ring.frames.clear()
+            ring.size = 0
+
+    def append(self, ring: Ring, frame: bytes):
+        with self.lock:
+            ring.frames.append(frame)
+            ring.size += len(frame)
+            ring.next_seq += 1
+            self.total += len(frame)
+
+            while len(ring.frames) > self.max_messages or ring.size > self.max_bytes:
+                self.total -= ring.pop_oldest()
+
+            if self.total > self.total_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Shares nine tenths of the total between the rooms, smaller buffers keep everything and the
+        largest are trimmed to an equal share of what is left. Called with the lock held.
+        """
+
+        rings = sorted((ring for ring in self.rings if ring.frames), key=lambda ring: ring.size)
+        budget = self.total_bytes * 9 // 10
+
+        for idx, ring in enumerate(rings):
+            share = budget // (len(rings) - idx)
+            while ring.size > share:
+                self.total -= ring.pop_oldest()
+            budget -= ring.size
@@ -1,27 +1,90 @@
 from socket import *
-from threading import Thread
+from threading import Thread, RLock
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import argparse
+import heapq
 import struct
+import time
 
 # Custom Modules
 from command import Command
 from user import User
 from chatroom import Chatroom
+from framing import FrameReader, MAX_FRAME
+from compression import Inflater
+from connection import Connection, ThreadedConnection, StreamConnection, QUEUE_POLICIES
+from metrics import Metrics, serve_metrics, LATENCY_BUCKETS, FANOUT_BUCKETS
+from logger import log, LEVELS, LOG_FORMATS
+import handlers
+import wire
+from messagelog import LogStore, FSYNC_POLICIES
+from scrollback import Scrollback
+from ratelimit import FloodControl, FLOOD_POLICIES
+from heartbeat import Heartbeat
+from session import Sessions
 import util
 
 class Server:
-    def __init__(self):
+    def __init__(self, engine='async', log_store: LogStore=None, scrollback: Scrollback=None, flood: FloodControl=None,
+                 heartbeat: Heartbeat=None, sessions: Sessions=None, **connection_options):
         """
         The class that contains server related functionality.
+        The engine is either 'async' (one event loop for all clients) or 'threaded' (one thread per client).
+        With a log store every chatroom keeps a message log that clients can fetch history from,
+        with a scrollback every chatroom keeps its recent messages in memory for users who join,
+        with flood control clients are held to its rate limits,
+        with a heartbeat idle clients are pinged and the ones that stopped answering are reaped,
+        and with sessions clients that lose their connection can resume where they left off.
+        The connection options (queue_limit, queue_policy, coalesce_window, coalesce_limit, compress_threshold) apply to every client.
         """
 
+        self.engine = engine
+        self.log_store = log_store
+        self.scrollback = scrollback
+        self.flood = flood
+        self.heartbeat = heartbeat
+        self.sessions = sessions
+        self.connection_options = connection_options
         self.listener = socket()
         self.address = (gethostname(), 8585)
-        self.tcp_backlog = 5
+        self.tcp_backlog = SOMAXCONN
+        # Rooms handle their own members and broadcasts, on a thread pool for the threaded engine
+        # and on the event loop for the async engine
+        self.room_executor = ThreadPoolExecutor(thread_name_prefix='room') if engine == 'threaded' else None
+
+        # Read by the stats command and the metrics endpoint
+        self.metrics = Metrics()
+        self.describe_metrics()
+
+        # The registry: users, rooms and the indexes kept in step with the rooms, alias -> User and
+        # User -> chatrooms they are in. Only operations across rooms take the registry lock.
         self.users = {}
-        self.userlist = []
-        self.chatrooms = {"General": Chatroom("General", None, True)}
+        self.chatrooms = {"General": self.new_chatroom("General", None, True)}
+        self.aliases = {}
+        self.memberships = {}
+        self.registry_lock = RLock()
+
+        # Maximum number of aliases in a single list_users response
+        self.list_users_page = 1000
+
+        # Maximum number of messages in a single history response
+        self.history_limit = 500
+
+        # Command handlers by type, see handlers.py
+        self.handlers = dict(handlers.HANDLERS)
 
     def listen(self):
+        """
+        Listens for all new traffic using the configured engine.
+        """
+
+        if self.engine == 'threaded':
+            self.listen_threaded()
+        else:
+            asyncio.run(self.listen_async())
+
+    def listen_threaded(self):
         """
         Listens for all new traffic and delegates a separate thread for each client.
         """
@@ -30,9 +93,19 @@ class Server:
         self.listener.bind(self.address)
         self.listener.listen(self.tcp_backlog)
 
+        if self.heartbeat is not None:
+            Thread(target=self.heartbeat_loop, name='heartbeat', daemon=True).start()
+        if self.sessions is not None:
+            Thread(target=self.sessions_loop, name='sessions', daemon=True).start()
+
         # Accepts all new traffic and delegates a thread to be responsible for the new client
         while True:
             client_sock, origin_address = self.listener.accept()
+            client_sock = ThreadedConnection(client_sock, **self.connection_options)
+            if self.flood is not None:
+                client_sock.bucket = self.flood.connection_bucket()
+            if self.heartbeat is not None:
+                self.heartbeat.watch(client_sock)
             Thread(target=self.handle_client, args=(origin_address, client_sock)).start()
 
     def handle_client(self, origin_address: (str, int), client_sock: socket):
@@ -40,377 +113,682 @@ class Server:
         Handles all commands sent from the client.
         """
 
+        # Clients may only send compressed frames once they negotiated zlib
+        reader = FrameReader(client_sock, inflater=Inflater(MAX_FRAME, client_sock))
+
+        try:
+            while True:
+                for data in reader.read_frames():
+                    delay = self.admit_frame(client_sock)
+                    if delay is None:
+                        continue
+                    if delay:
+                        time.sleep(delay)
+
+                    for cmd in self.parse_frame(data, client_sock):
+                        if self.admit_command(cmd, client_sock):
+                            self.execute_command(cmd, origin_address, client_sock)
+        except OSError:
+            pass
+        finally:
+            self.drop_client(client_sock)
+
+    async def listen_async(self):
+        """
+        Listens for all new traffic and handles every client as a task on a single event loop.
+        """
+
+        # Begins listening for a connection
+        self.listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.listener.bind(self.address)
+        self.listener.listen(self.tcp_backlog)
+
+        if self.heartbeat is not None:
+            asyncio.get_running_loop().create_task(self.heartbeat_loop_async())
+        if self.sessions is not None:
+            asyncio.get_running_loop().create_task(self.sessions_loop_async())
+
+        server = await asyncio.start_server(self.handle_client_async, sock=self.listener)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_client_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Handles all commands sent from the client, runs on the event loop.
+        """
+
+        client_sock = StreamConnection(reader, writer, **self.connection_options)
+        origin_address = client_sock.getpeername()[:2]
+        inflater = Inflater(MAX_FRAME, client_sock)
+        if self.flood is not None:
+            client_sock.bucket = self.flood.connection_bucket()
+        if self.heartbeat is not None:
+            self.heartbeat.watch(client_sock)
+
+        try:
+            while True:
+                lengthbuf = await reader.readexactly(4)
+                length, = struct.unpack('!I', lengthbuf)
+                if length > MAX_FRAME:
+                    raise ConnectionError("Frame of {} bytes exceeds the limit".format(length))
+                data = await reader.readexactly(length)
+                client_sock.count_received(4 + length)
+
+                for frame in inflater.expand([data]):
+                    delay = self.admit_frame(client_sock)
+                    if delay is None:
+                        continue
+                    if delay:
+                        await asyncio.sleep(delay)
+
+                    for cmd in self.parse_frame(frame, client_sock):
+                        if self.admit_command(cmd, client_sock):
+                            self.execute_command(cmd, origin_address, client_sock)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.drop_client(client_sock)
+
+    def parse_frame(self, data, client_sock):
+        """
+        Returns the commands in a frame from a client. A malformed frame is answered with an error and has none.
+        """
+
+        try:
+            return Command(data).commands()
+        except wire.DecodeError as e:
+            log.warning('connection', 'malformed frame', error=str(e))
+            try:
+                self.send_error(client_sock, handlers.MALFORMED_FRAME)
+            except ConnectionError:
+                pass
+            return []
+
+    def admit_frame(self, client_sock):
+        """
+        Takes a token from the connection's bucket before a frame is parsed. Returns None if the frame is rejected,
+        otherwise how many seconds the reader should stop reading first, which is only ever more than 0 with the pause policy.
+        """
+
+        bucket = client_sock.bucket
+        if bucket is None:
+            return 0
+        if client_sock.closed:
+            return None
+
+        if bucket.take():
+            client_sock.throttled.discard('connection')
+            return 0
+
+        if self.flood.policy == 'pause':
+            self.metrics.count('chappie_flood_limited_total', (('scope', 'connection'), ('policy', 'pause')))
+            return bucket.reserve()
+
+        self.over_limit(client_sock, 'connection')
+        return None
+
+    def admit_command(self, cmd: Command, client_sock):
+        """
+        Takes a token for a chat message from its sender's and its room's buckets, returns whether to handle it.
+        Only the sender's own server checks this, so in sharded mode each worker limits a room's messages from its own clients.
+        """
+
+        if self.flood is None or cmd.type != 'message':
+            return True
+
+        # Messages that will be rejected anyway must not use up the room's tokens, or create buckets for made up rooms
+        user = self.users.get(client_sock, None)
+        if user is None or not self.has_chatroom(cmd.specificChatroom):
+            return True
+
+        scope = self.flood.check_message(user.alias, cmd.specificChatroom)
+        if scope is None:
+            client_sock.throttled.discard('user')
+            client_sock.throttled.discard('room')
+            return True
+
+        self.over_limit(client_sock, scope)
+        return False
+
+    def over_limit(self, client_sock, scope: str):
+        """
+        Deals with a client that went over a limit: with the disconnect policy it is disconnected,
+        otherwise what it sent is dropped and it gets an error, once until it is within the limit again.
+        """
+
+        policy = 'disconnect' if self.flood.policy == 'disconnect' else 'throttle'
+        self.metrics.count('chappie_flood_limited_total', (('scope', scope), ('policy', policy)))
+
+        if policy == 'disconnect':
+            user = self.users.get(client_sock, None)
+            log.warning('connection', 'disconnected for flooding', scope=scope, alias=user.alias if user is not None else None)
+            client_sock.close()
+            return
+
+        if scope not in client_sock.throttled:
+            client_sock.throttled.add(scope)
+            try:
+                self.send_error(client_sock, handlers.FLOOD_ERRORS[scope])
+            except ConnectionError:
+                pass
+
+    def heartbeat_loop(self):
+        """
+        Ticks the heartbeat for the threaded engine.
+        """
+
+        while True:
+            time.sleep(self.heartbeat.tick)
+            self.check_heartbeats()
+
+    async def heartbeat_loop_async(self):
+        """
+        Ticks the heartbeat for the async engine, on the event loop.
+        """
+
         while True:
+            await asyncio.sleep(self.heartbeat.tick)
+            self.check_heartbeats()
+
+    def check_heartbeats(self):
+        """
+        Pings the clients that went idle and drops the ones that never answered, all of them at once.
+        """
+
+        ping, reap = self.heartbeat.expire()
+
+        # Serialize once per encoding, every idle client gets the same bytes
+        pingCmd = Command()
+        pingCmd.init_ping()
+        frames = {}
+        for sock in ping:
             try:
-                lengthbuf = client_sock.recv(4)
-                length, = struct.unpack('!I', lengthbuf)
-                data = client_sock.recv(length)
-            except: # Should specify the actual exception that is occuring
-                break
+                pingCmd.send(sock, frames)
+            except ConnectionError:
+                pass
 
-            if data is not None:
-                cmd = Command(data)
-                self.execute_command(cmd, origin_address, client_sock)
+        if reap:
+            log.info('connection', 'reaped idle', count=len(reap))
+            self.metrics.count('chappie_idle_reaped_total', value=len(reap))
+            self.drop_clients(reap)
 
-        print("{} lost connection".format(self.users[client_sock].alias))
-        self.userlist.remove(self.users[client_sock].alias)
-        self.users.pop(client_sock, None)
-        client_sock.close()
+    def sessions_loop(self):
+        """
+        Expires detached users for the threaded engine.
+        """
 
-    def execute_command(self, cmd: Command, origin_address: (str, int), sock: socket):
+        while True:
+            time.sleep(self.sessions.tick)
+            self.expire_sessions()
+
+    async def sessions_loop_async(self):
         """
-        Executes a given command and performs an action depending on the command type.
+        Expires detached users for the async engine, on the event loop.
         """
 
-        currUser = self.users.get(sock, None)
+        while True:
+            await asyncio.sleep(self.sessions.tick)
+            self.expire_sessions()
+
+    def expire_sessions(self):
+        """
+        Removes the detached users nobody resumed in time, now their chatrooms are told they left.
+        """
+
+        expired = self.sessions.expire()
+        if expired:
+            log.info('connection', 'sessions expired', count=len(expired))
+            self.metrics.count('chappie_sessions_expired_total', value=len(expired))
+            self.remove_clients([user.socket for user in expired])
+
+    def resume_session(self, token: str, sock):
+        """
+        Hands the user of a session over to a new connection. Returns the user, or None if there is no such session.
+        The user's chatrooms move it to the new connection themselves, see Chatroom.resume.
+        """
+
+        with self.registry_lock:
+            user = self.sessions.claim(token)
+            if user is None:
+                return None
+
+            oldSock = user.socket
+            self.users.pop(oldSock, None)
+            self.users[sock] = user
 
-        if cmd.type == 'message':
-            # Adds a tag that says who authored the command
-            cmd.creator = currUser.alias
-
-            # Notifies user if chatroom doesnt exist
-            if cmd.specificChatroom not in self.chatrooms:
-                errorResponse = Command()
-                errorResponse.init_error("Chatroom {} doesnt exist.".format(cmd.specificChatroom))
-                errorResponse.send(sock)
-                return
-
-            # Notifies user if their message is too long
-            if len(cmd.body) > 200:
-                errorResponse = Command()
-                errorResponse.init_error("Your message exceeds the 200 character limit.")
-                errorResponse.send(sock)
-                return
+        # The old connection may be half open and not noticed yet, its reader finds no user to drop once it is closed
+        oldSock.close()
+        self.metrics.count('chappie_sessions_resumed_total')
+        return user
 
-            print('{}/{}: {}'.format(cmd.creator, cmd.specificChatroom, cmd.body))
-
-            # Relays the message to all the other clients in the same chatroom that the message was sent from
-            self.chatrooms[cmd.specificChatroom].send_all(cmd)
-
-        elif cmd.type == 'alias':
-            # Some thoughts about https://github.com/sterlinglaird/SENG-299/issues/53: 
-                # to remove old user in user list, we'd have to search by sock (because that is unique to user, even if alias changes)
-                # also have to edit cliengui.py, as every time set_alias is executed, a new user is added to GUI user list
-
-            # Get the chosen alias and address
-            alias = cmd.body
-
-            # Check that the alias isn't already in use
-            if alias in self.userlist:
-                # Send warning back to client
-                errorResponse = Command()
-                errorResponse.init_error("Alias '{}' already exist.".format(alias))
-                errorResponse.send(sock)
-                return
-
-            # Update the server data and the command
-            newUser = User(alias, sock)
-            self.users[sock] = newUser
-            self.chatrooms[util.defaultChatroom].add_user(newUser)
-            cmd.creator = newUser.alias
-            self.userlist.append(newUser.alias)
-            cmd.specificChatroom = util.defaultChatroom
-
-            print("Alias '{}' accepted".format(alias))
-
-            # let all users in default chatroom know about the connection
-            self.chatrooms[cmd.specificChatroom].send_all(cmd)
-
-        elif cmd.type == 'connect':
-            # Get the chosen alias and address
-            address = "{}:{}".format(origin_address[0], origin_address[1])
-            alias = address
-
-            print("Connected with address '{}'".format(address))
-
-            # let users know about connection
-            cmd.send(sock)
-
-        elif cmd.type == 'disconnect':
-            # Close the socket
-            sock.close()
-
-            connectedChatrooms = []
-
-            # Remove the user
-            self.users.pop(sock)
-            for chatroom in self.chatrooms.values():
-                chatroom.rem_user(currUser.alias)
-                connectedChatrooms.append(chatroom.name)
-
-            # Adds a tag that says who authored the command
-            cmd.creator = currUser.alias
-
-            print("{} disconnected".format(currUser.alias))
-
-            # Relays the message to all the other clients in the same chatrooms as the user who disconnected
-            for chatroom in connectedChatrooms:
-                chatroom.send_all(cmd)
-
-        elif cmd.type == 'join_chatroom':
-            userOccupies = self.get_all_chatrooms(currUser)
-            newChatroom = self.chatrooms.get(cmd.body, None)
-
-            if newChatroom in userOccupies:
-                errorResponse = Command()
-                errorResponse.init_error("You are already in chatroom '{}'.".format(cmd.body))
-                errorResponse.send(sock)
-                return
-
-            if newChatroom is None:
-                errorResponse = Command()
-                errorResponse.init_error("Chatroom '{}' doesn't exist.".format(cmd.body))
-                errorResponse.send(sock)
-                return
-
-            # Check if user is blocked from the room they are trying to join
-            if currUser.alias in self.chatrooms[cmd.body].blocked:
-                errorResponse = Command()
-                errorResponse.init_error("You are blocked from joining chatroom '{}'.".format(cmd.body))
-                errorResponse.send(sock)
-                return
-
-            # Remove user from previous chatrooms
-            for chatroom in self.chatrooms.values():
-                chatroom.rem_user(currUser)
-
-            # Add user to chatroom
-            newChatroom.add_user(currUser)
-
-            print("{} joined chatroom {}".format(currUser.alias, newChatroom.name))
-
-            # Adds a tag that says who authored the command
-            cmd.creator = currUser.alias
+    def drop_client(self, client_sock):
+        """
+        Removes all state for a client whose connection was lost and lets its chatrooms know.
+        """
 
-            # Notify users in chatroom that user has joined
-            self.chatrooms[newChatroom.name].send_all(cmd)
-
-            # Notify users in old chatrooms that user joined a different one
-            for chatroom in userOccupies:
-                chatroom.send_all(cmd)
-
-        elif cmd.type == 'create_chatroom':
-            # Create chatroom if it doesnt already exist, if it does then let user know
-            if cmd.body in self.chatrooms:
-                errorResponse = Command()
-                errorResponse.init_error("Chatroom \"{}\" already exists.".format(cmd.body))
-                errorResponse.send(sock)
-                return
+        self.drop_clients([client_sock])
+
+    def drop_clients(self, client_socks: list):
+        """
+        Removes all state for clients whose connections were lost and lets their chatrooms know.
+        Users with a session are only detached, they stay until their session is resumed or expires.
+        """
+
+        for client_sock in client_socks:
+            client_sock.close()
+            if self.heartbeat is not None:
+                self.heartbeat.forget(client_sock)
+
+        if self.sessions is not None:
+            with self.registry_lock:
+                client_socks = [client_sock for client_sock in client_socks if not self.detach(client_sock)]
+
+        self.remove_clients(client_socks)
+
+    def detach(self, client_sock):
+        """
+        Starts the resume window of the user of a lost connection if it has a session, returns whether it did.
+        Called with the registry lock held, so a resume cannot claim the user halfway.
+        """
+
+        user = self.users.get(client_sock, None)
+        if user is None or not self.sessions.detach(user):
+            return False
+
+        # A connection that resumed the session and was lost before the chatrooms moved the user over to it
+        # is the one the user is expired by
+        user.socket = client_sock
+        log.info('connection', 'detached', alias=user.alias)
+        return True
+
+    def remove_clients(self, client_socks: list):
+        """
+        Removes the users of lost connections under one hold of the registry lock,
+        and lets their chatrooms know with a single batch of disconnects per chatroom.
+        """
+
+        disconnects = {}
+        with self.registry_lock:
+            for client_sock in client_socks:
+                user, chatrooms = self.remove_user(client_sock)
+                if user is None:
+                    continue
+
+                log.info('connection', 'lost', alias=user.alias)
+
+                disconnectCmd = Command()
+                disconnectCmd.init_disconnect()
+                disconnectCmd.creator = user.alias
+                for chatroom in chatrooms:
+                    disconnects.setdefault(chatroom, []).append(disconnectCmd)
+
+        for chatroom, disconnectCmds in disconnects.items():
+            if len(disconnectCmds) == 1:
+                chatroom.send_all(disconnectCmds[0])
             else:
-                self.chatrooms[cmd.body] = Chatroom(cmd.body, currUser)
-
-            print("{} created chatroom {}".format(currUser.alias, cmd.body))
-
-            # Adds a tag that says who authored the command
-            cmd.creator = currUser.alias
-
-            # Let all users know about the new chatroom
-            self.send_all(cmd)
-
-        elif cmd.type == 'delete_chatroom':
-            chatroom = self.chatrooms.get(cmd.body, None)
-
-            if chatroom is None:
-                # Send error if chatroom doesnt exist
-                errorResponse = Command()
-                errorResponse.init_error("Chatroom \"{}\" doesn't exist.".format(cmd.body))
-                errorResponse.send(sock)
-                return
-            elif chatroom.owner is not currUser:
-                # Send error if user doesnt own the chatroom
-                errorResponse = Command()
-                errorResponse.init_error("Chatroom \"{}\" is not owned by you so you cannot delete it.".format(chatroom.name))
-                errorResponse.send(sock)
-                return
-
-            # Move all current users in chatroom to default room
-            userList = list(chatroom.users.values())
-            for user in userList:
+                batchCmd = Command()
+                batchCmd.init_batch(disconnectCmds)
+                chatroom.send_all(batchCmd)
+
+    def add_user(self, user: User):
+        """
+        Registers a user with its alias and puts it in the default chatroom.
+        Returns False if the alias is already taken.
+        """
+
+        with self.registry_lock:
+            if user.alias in self.aliases:
+                return False
+
+            self.users[user.socket] = user
+            self.aliases[user.alias] = user
+            self.memberships[user] = set()
+            self.join_room(user, self.chatrooms[util.defaultChatroom])
+            return True
+
+    def remove_user(self, sock):
+        """
+        Removes the user of a socket from every index and chatroom.
+        Returns the user and the chatrooms it was in, or (None, []) if the socket had no user.
+        """
+
+        with self.registry_lock:
+            user = self.users.pop(sock, None)
+            if user is None:
+                return None, []
+
+            self.aliases.pop(user.alias, None)
+            if self.sessions is not None:
+                self.sessions.revoke(user)
+            if self.flood is not None:
+                self.flood.forget_user(user.alias)
+            chatrooms = list(self.memberships.pop(user, ()))
+            for chatroom in chatrooms:
                 chatroom.rem_user(user)
-                self.chatrooms[util.defaultChatroom].add_user(user)
-
-            self.chatrooms.pop(cmd.body, None)
-
-            # Adds a tag that says who authored the command
-            cmd.creator = currUser.alias
-
-            # Let all users know about the deleted chatroom
-            self.send_all(cmd)
-
-            # Let all users know about the joins to default chatroom
-            for deletedUser in userList:
-                joinCmd = Command()
-                joinCmd.init_join_chatroom(util.defaultChatroom)
-                joinCmd.creator = deletedUser.alias
-
-                for user_socket in self.chatrooms[util.defaultChatroom].users.values():
-                    joinCmd.send(user_socket.socket)
-
-            print("{} deleted chatroom {}".format(currUser.alias, cmd.body))
-
-        elif cmd.type == 'block_user':
-            # Find location of blocker
-            for blocker_chatroom in self.chatrooms:
-                # When the blocker is found
-                if currUser.alias in self.chatrooms[blocker_chatroom].users:
-                    user_location = self.chatrooms[blocker_chatroom]
-                    # Check if they are the owner of the room they're in
-                    if user_location.owner is not currUser:
-                        errorResponse = Command()
-                        errorResponse.init_error("You don't own chatroom {}, so you can't block users from joining it.".format(user_location.name))
-                        errorResponse.send(sock)
-                        return
-                    # If they are the owner
-                    else:
-                        # Find the location of the user being blocked
-                        for chatroom in self.chatrooms:
-                            if cmd.body in self.chatrooms[chatroom].users:
-                                blocked_user_location = self.chatrooms[chatroom]
-                                blocked_user = blocked_user_location.users[cmd.body]
-                                
-                                # Check if the user is trying to block themselves (it should have been a feature, but sterlinglaird is lame)
-                                if currUser == blocked_user:
-                                    errorResponse = Command()
-                                    errorResponse.init_error("Why are you trying to block yourself? Stop that.")
-                                    errorResponse.send(sock)
-                                    return
-
-                                # Block the user
-                                user_location.block_user(blocked_user)
-                                
-                                # Add a tag that says who authored the command
-                                cmd.creator = currUser.alias
-
-                                # Add a tag that says which room the user is blocked from
-                                cmd.specificChatroom = user_location.name
-
-                                # Let all users in the blocker's room know about the block
-                                user_location.send_all(cmd)
-
-                                # If the blocker and the user being blocked are in the same room
-                                if user_location == blocked_user_location:
-                                    # Remove the blocked user from the room, and return them to Default
-                                    user_location.rem_user(blocked_user)
-                                    self.chatrooms[util.defaultChatroom].add_user(blocked_user)
-                                else:
-                                    # Let the blocked user's room know about the block (console logging only)
-                                    blocked_user_location.send_all(cmd)
-
-                                # Let user know they've been forced into default chatroom
-                                join_cmd = Command()
-                                join_cmd.init_join_chatroom(util.defaultChatroom)
-                                join_cmd.creator = blocked_user.alias
-
-                                # Let all users in new chatroom know that user has joined
-                                self.chatrooms[util.defaultChatroom].send_all(join_cmd)
-
-                                # Let all users in old chatroom know that user has left, as long as we havent already sent the message in the line above
-                                if blocked_user_location is not self.chatrooms[util.defaultChatroom]:
-                                    blocked_user_location.send_all(join_cmd)
-
-                                print("{} blocked {} from chatroom {}".format(currUser.alias, cmd.body, user_location.name))
-
-                                return
-    
-            # If the user can't be found
-            errorResponse = Command()
-            errorResponse.init_error("User \"{}\" does not exist.".format(cmd.body))
-            errorResponse.send(sock)
+
+            return user, chatrooms
+
+    def new_chatroom(self, name: str, owner: User, default=False):
+        chatroom = Chatroom(name, owner, default, self.room_executor)
+        chatroom.metrics = self.metrics
+        if self.log_store is not None:
+            chatroom.log = self.log_store.open(name)
+            chatroom.next_seq = chatroom.log.next_seq
+        if self.scrollback is not None:
+            chatroom.recent = self.scrollback.ring(chatroom.next_seq)
+
+        return chatroom
+
+    def add_chatroom(self, chatroom: Chatroom):
+        """
+        Registers a new chatroom. Returns False if the name is already taken.
+        """
+
+        with self.registry_lock:
+            if chatroom.name in self.chatrooms:
+                return False
+
+            self.chatrooms[chatroom.name] = chatroom
+            return True
+
+    def remove_chatroom(self, name: str):
+        if self.flood is not None:
+            self.flood.forget_room(name)
+
+        with self.registry_lock:
+            return self.chatrooms.pop(name, None)
+
+    def has_chatroom(self, name: str):
+        return name in self.chatrooms
+
+    def chatroom_names(self):
+        """
+        Returns the names of all chatrooms.
+        """
+
+        with self.registry_lock:
+            return list(self.chatrooms)
+
+    def join_room(self, user: User, chatroom: Chatroom):
+        with self.registry_lock:
+            chatroom.add_user(user)
+            self.memberships[user].add(chatroom)
+
+    def leave_room(self, user: User, chatroom: Chatroom):
+        with self.registry_lock:
+            chatroom.rem_user(user)
+            self.memberships[user].discard(chatroom)
+
+    def move_user(self, user: User, chatroom: Chatroom):
+        """
+        Moves a user out of all of its chatrooms and into the given one.
+        Returns False if the user is gone or the chatroom was deleted in the meantime.
+        """
+
+        with self.registry_lock:
+            if user not in self.memberships or self.chatrooms.get(chatroom.name, None) is not chatroom:
+                return False
+
+            for oldChatroom in list(self.memberships[user]):
+                self.leave_room(user, oldChatroom)
+            self.join_room(user, chatroom)
+            return True
+
+    def move_to_default(self, users: list):
+        """
+        Moves users out of their chatrooms and into the default one. Returns the users that were moved.
+        """
+
+        defaultChatroom = self.chatrooms[util.defaultChatroom]
+        return [user for user in users if self.move_user(user, defaultChatroom)]
+
+    def execute_command(self, cmd: Command, origin_address: (str, int), sock: socket):
+        """
+        Executes a given command with the handler registered for its type, and records how long that took.
+        """
+
+        start = time.perf_counter()
+        self.run_command(cmd, origin_address, sock)
+
+        # Unknown types are lumped together so clients cannot create labels at will
+        labels = (('type', cmd.type if cmd.type in self.handlers else 'unknown'),)
+        self.metrics.count('chappie_commands_total', labels)
+        self.metrics.observe('chappie_command_seconds', time.perf_counter() - start, labels)
+
+    def run_command(self, cmd: Command, origin_address: (str, int), sock: socket):
+        handler = self.handlers.get(cmd.type, None)
+        if handler is None:
+            self.send_error(sock, ('unknown_command', "Unknown command '{}'.".format(cmd.type)))
             return
 
-        elif cmd.type == 'unblock_user':
-            # Find location of unblocker
-            for unblocker_chatroom in self.chatrooms:
-                # When the unblocker is found
-                if currUser.alias in self.chatrooms[unblocker_chatroom].users:
-                    user_location = self.chatrooms[unblocker_chatroom]
-                    # Check if they are the owner of the room they're in
-                    if user_location.owner is not currUser:
-                        errorResponse = Command()
-                        errorResponse.init_error("You are not the owner of chatroom {}, so you cannot unblock blocked users.".format(user_location.name))
-                        errorResponse.send(sock)
-                        return
-                    # If they are the owner
-                    else:
-                        # Find the location of the user being unblocked
-                        for chatroom in self.chatrooms:
-                            if cmd.body in self.chatrooms[chatroom].users:
-                                blocked_user_location = self.chatrooms[chatroom]
-                                blocked_user = blocked_user_location.users[cmd.body]
-                                # unlock the user
-                                user_location.unblock_user(blocked_user)
-                                
-                                print("{} unblocked {} from chatroom {}".format(currUser.alias, cmd.body, user_location.name))
-
-                                # Add a tag that says who authored the command
-                                cmd.creator = currUser.alias
-
-                                # Add a tag that says which room the user is unblocked from
-                                cmd.specificChatroom = user_location.name
-
-                                # Let all users in the room know about the unblock
-                                user_location.send_all(cmd)
-
-                                if user_location != blocked_user_location:
-                                    # Let the blocked user's room know about the block
-                                    blocked_user_location.send_all(cmd)
-                                
-                                return
-
-            # If the user can't be found
-            errorResponse = Command()
-            errorResponse.init_error("User \"{}\" does not exist.".format(cmd.body))
-            errorResponse.send(sock)
+        currUser = self.users.get(sock, None)
+        if currUser is None and handler.requires_user:
+            self.send_error(sock, handlers.ALIAS_REQUIRED)
             return
 
-        elif cmd.type == 'get_chatrooms':
-            get_chatrooms_cmd = Command()
-            get_chatrooms_cmd.init_get_chatrooms(list(self.chatrooms.keys()))
-            get_chatrooms_cmd.send(sock)
+        error = handler.validate(self, cmd, currUser)
+        if error is None:
+            error = handler.handle(self, cmd, origin_address, sock, currUser)
 
+        if error is not None:
+            self.send_error(sock, error)
 
-        elif cmd.type == 'list_users':
-            newChatroom = self.chatrooms.get(cmd.body, None)
+    def register_handler(self, handler: handlers.Handler):
+        """
+        Registers a handler on this server only, replacing any handler for the same command type.
+        """
 
-            # send a join command for every user in the chatroom, except the current user
-            for user in newChatroom.users:
-                if user == currUser.alias:
-                    continue
+        self.handlers[handler.type] = handler
+
+    def send_error(self, sock: socket, error):
+        """
+        Sends a pre-built ErrorResponse, or a (reason, message) pair, back to a client.
+        Errors are counted by their fixed reason key, never by the message, which can contain names.
+        """
+
+        if isinstance(error, handlers.ErrorResponse):
+            self.metrics.count('chappie_errors_total', (('reason', error.reason),))
+            error.send(sock)
+            return
+
+        reason, message = error
+        self.metrics.count('chappie_errors_total', (('reason', reason),))
+
+        errorResponse = Command()
+        errorResponse.init_error(message)
+        errorResponse.send(sock)
+
+    def describe_metrics(self):
+        metrics = self.metrics
+        metrics.describe('chappie_commands_total', 'counter', "Commands handled, by type.")
+        metrics.describe('chappie_command_seconds', 'histogram', "Time spent handling a command, by type.", LATENCY_BUCKETS)
+        metrics.describe('chappie_fanout_recipients', 'histogram', "Members a chatroom broadcast was sent to.", FANOUT_BUCKETS)
+        metrics.describe('chappie_errors_total', 'counter', "Errors sent to clients, by reason.")
+        metrics.describe('chappie_connections_opened_total', 'counter', "Client connections accepted.")
+        metrics.describe('chappie_connections_open', 'gauge', "Client connections currently open.")
+        metrics.describe('chappie_bytes_received_total', 'counter', "Bytes read from clients.")
+        metrics.describe('chappie_bytes_sent_total', 'counter', "Bytes written to clients.")
+        metrics.describe('chappie_frames_dropped_total', 'counter', "Frames dropped from full outbound queues.")
+        metrics.describe('chappie_evictions_total', 'counter', "Slow clients disconnected because their queue was full.")
+        metrics.describe('chappie_users', 'gauge', "Users with an alias.")
+        metrics.describe('chappie_chatrooms', 'gauge', "Chatrooms.")
+        metrics.describe('chappie_outbound_queued_frames', 'gauge', "Frames waiting in all outbound queues.")
+        metrics.describe('chappie_outbound_backlogged_connections', 'gauge', "Connections with frames waiting to be sent.")
+        metrics.describe('chappie_outbound_queue_depth', 'gauge', "Frames waiting for the most backlogged users.")
+        metrics.describe('chappie_idle_reaped_total', 'counter', "Idle clients dropped for not answering a ping.")
+        metrics.describe('chappie_sessions_resumed_total', 'counter', "Sessions taken over by a reconnected client.")
+        metrics.describe('chappie_sessions_expired_total', 'counter', "Detached users removed because nobody resumed their session in time.")
+        metrics.describe('chappie_sessions_detached', 'gauge', "Users whose connection was lost, waiting to be resumed.")
+        metrics.describe('chappie_flood_limited_total', 'counter', "Times a client went over a flood control limit, by scope and policy.")
+        metrics.describe('chappie_log_records_dropped_total', 'counter', "Log records dropped because the log queue was full.")
+        metrics.collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        """
+        Returns the gauges and connection totals, read only when the metrics are scraped.
+        """
+
+        with Connection.totals_lock:
+            totals = dict(Connection.totals)
+
+        with self.registry_lock:
+            users = list(self.users.values())
+            chatrooms = len(self.chatrooms)
+
+        # Replicas of other workers' users have no queue here
+        backlog = [(user.socket.depth, user.alias) for user in users if isinstance(user.socket, Connection)]
 
-                responseCmd = Command()
-                responseCmd.init_join_chatroom(newChatroom.name)
-                responseCmd.creator = user
-                responseCmd.suppress = True
-                responseCmd.send(sock)
+        samples = [('chappie_connections_opened_total', (), totals['opened']),
+                   ('chappie_connections_open', (), totals['opened'] - totals['closed']),
+                   ('chappie_bytes_received_total', (), totals['bytes_in']),
+                   ('chappie_bytes_sent_total', (), totals['bytes_out']),
+                   ('chappie_frames_dropped_total', (), totals['dropped']),
+                   ('chappie_evictions_total', (), totals['evictions']),
+                   ('chappie_users', (), len(users)),
+                   ('chappie_chatrooms', (), chatrooms),
+                   ('chappie_outbound_queued_frames', (), sum(depth for depth, _ in backlog)),
+                   ('chappie_outbound_backlogged_connections', (), sum(1 for depth, _ in backlog if depth)),
+                   ('chappie_log_records_dropped_total', (), log.dropped)]
 
-                print("Listing user '{}' for '{}'".format(user, currUser.alias))
+        if self.sessions is not None:
+            samples.append(('chappie_sessions_detached', (), self.sessions.detached))
+
+        for depth, alias in heapq.nlargest(10, backlog):
+            if depth:
+                samples.append(('chappie_outbound_queue_depth', (('alias', alias),), depth))
+
+        return samples
 
     def get_all_chatrooms(self, user: User):
         '''
         Returns all chatrooms a user belongs to
         '''
 
-        occupies = []
-        for chatroom in self.chatrooms.values():
-            if chatroom.users.get(user.alias, None):
-                occupies.append(chatroom)
-
-        return occupies
+        return list(self.memberships.get(user, ()))
 
     def send_all(self, cmd: Command):
         '''
         Sends a command to all users
         '''
 
-        for user_socket in list(self.users):
+        # Serialize once per encoding, every user gets the same bytes
+        frames = {}
+
+        with self.registry_lock:
+            sockets = list(self.users)
+
+        # Users whose connection failed are cleaned up by drop_client once their reader stops
+        for user_socket in sockets:
             try:
-                cmd.send(user_socket)
-            except:
-                print("{} lost connection".format(self.users[user_socket].alias))
-                self.userlist.remove(self.users[user_socket].alias)
-                self.users.pop(user_socket, None)
+                cmd.send(user_socket, frames)
+            except ConnectionError:
+                pass
 
 if __name__ == '__main__':
-    server = Server()
-    print("Starting Server")
-    server.listen()
+    parser = argparse.ArgumentParser(description="Chappie chat server")
+    parser.add_argument('--host', default=gethostname(), help="address to listen on")
+    parser.add_argument('--port', type=int, default=8585, help="port to listen on")
+    parser.add_argument('--engine', choices=['async', 'threaded'], default='async',
+                        help="async runs every client on one event loop, threaded starts a thread per client")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of async worker processes sharing the port, kept in sync through a local bus")
+    parser.add_argument('--node', help="name of this server in a federation of nodes, see --nodes")
+    parser.add_argument('--nodes', metavar='NAME=HOST:PORT,...',
+                        help="relay address of every node in the federation, this one included, chatrooms are spread over them by consistent hashing")
+    parser.add_argument('--queue-limit', type=int, default=1024,
+                        help="maximum number of frames queued for a single client")
+    parser.add_argument('--queue-policy', choices=QUEUE_POLICIES, default='drop_ephemeral',
+                        help="what to do when a client's queue is full")
+    parser.add_argument('--coalesce-ms', type=float, default=0,
+                        help="how long a client's writer waits to merge queued commands into one batch, 0 to disable")
+    parser.add_argument('--coalesce-limit', type=int, default=64,
+                        help="number of queued commands that flushes a batch before the window ends")
+    parser.add_argument('--compress-threshold', type=int, default=128,
+                        help="smallest send in bytes that is compressed for clients offering zlib, 0 to turn compression off")
+    parser.add_argument('--log-dir', help="keep a message log per chatroom in this directory, enables the history command")
+    parser.add_argument('--log-segment-mb', type=float, default=16, help="size of a message log segment file")
+    parser.add_argument('--log-segments', type=int, default=8, help="number of segments kept per chatroom, older ones are deleted")
+    parser.add_argument('--log-fsync', choices=FSYNC_POLICIES, default='interval',
+                        help="flush the log to disk after every message, at an interval, or leave it to the OS")
+    parser.add_argument('--log-fsync-interval', type=float, default=1.0, help="seconds between flushes for the interval policy")
+    parser.add_argument('--scrollback', type=int, default=50, help="recent messages per chatroom sent to users who join, 0 to disable")
+    parser.add_argument('--scrollback-kb', type=float, default=64, help="memory limit of the recent messages of one chatroom")
+    parser.add_argument('--scrollback-total-mb', type=float, default=64, help="memory limit of the recent messages of all chatrooms")
+    parser.add_argument('--flood-policy', choices=FLOOD_POLICIES, default='throttle',
+                        help="what to do with a client over a limit, pause only applies to the connection limit and over the others messages are rejected")
+    parser.add_argument('--conn-rate', type=float, default=0, help="frames per second a connection may send, 0 for no limit")
+    parser.add_argument('--conn-burst', type=float, default=50, help="frames a connection may send at once")
+    parser.add_argument('--user-rate', type=float, default=0, help="chat messages per second an alias may send, 0 for no limit")
+    parser.add_argument('--user-burst', type=float, default=10, help="chat messages an alias may send at once")
+    parser.add_argument('--room-rate', type=float, default=0, help="chat messages per second a chatroom accepts, 0 for no limit")
+    parser.add_argument('--room-burst', type=float, default=100, help="chat messages a chatroom accepts at once")
+    parser.add_argument('--idle-timeout', type=float, default=60,
+                        help="seconds a client may send nothing before it is pinged, 0 to never ping or reap clients")
+    parser.add_argument('--ping-timeout', type=float, default=15,
+                        help="seconds a pinged client has to send something before it is dropped")
+    parser.add_argument('--heartbeat-tick', type=float, default=1.0, help="resolution of the idle timers in seconds")
+    parser.add_argument('--resume-window', type=float, default=30,
+                        help="seconds a client that lost its connection can resume its session in, 0 to turn resuming off, "
+                             "single process servers only")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve metrics for scraping on this loopback port, workers use the ports after it")
+    parser.add_argument('--log-level', choices=list(LEVELS), default='info', help="least severe level written to the server log")
+    parser.add_argument('--log-format', choices=LOG_FORMATS, default='text', help="write log records as text or as JSON lines")
+    parser.add_argument('--log-sample', action='append', default=[], metavar='CATEGORY=N',
+                        help="only log one in every N records of a category, e.g. message=1000, can be repeated")
+    parser.add_argument('--log-queue', type=int, default=65536, help="log records waiting to be written before new ones are dropped")
+    args = parser.parse_args()
+    if args.nodes and args.workers > 1:
+        parser.error("a federation node runs a single worker")
+    if bool(args.nodes) != bool(args.node):
+        parser.error("--node and --nodes go together")
+
+    sampling = {}
+    for option in args.log_sample:
+        category, _, every = option.partition('=')
+        sampling[category] = int(every)
+    log.configure(level=args.log_level, sampling=sampling, queue_limit=args.log_queue, format=args.log_format)
+
+    connection_options = {'queue_limit': args.queue_limit, 'queue_policy': args.queue_policy,
+                          'coalesce_window': args.coalesce_ms / 1000, 'coalesce_limit': args.coalesce_limit,
+                          'compress_threshold': args.compress_threshold}
+
+    log_options = {'segment_bytes': int(args.log_segment_mb * 1024 * 1024), 'max_segments': args.log_segments,
+                   'fsync': args.log_fsync, 'fsync_interval': args.log_fsync_interval}
+
+    scrollback_options = None
+    if args.scrollback > 0:
+        scrollback_options = {'max_messages': args.scrollback, 'max_bytes': int(args.scrollback_kb * 1024),
+                              'total_bytes': int(args.scrollback_total_mb * 1024 * 1024)}
+
+    flood_options = None
+    if args.conn_rate or args.user_rate or args.room_rate:
+        flood_options = {'policy': args.flood_policy, 'connection_rate': args.conn_rate, 'connection_burst': args.conn_burst,
+                         'user_rate': args.user_rate, 'user_burst': args.user_burst,
+                         'room_rate': args.room_rate, 'room_burst': args.room_burst}
+
+    heartbeat_options = None
+    if args.idle_timeout > 0:
+        heartbeat_options = {'idle_timeout': args.idle_timeout, 'ping_timeout': args.ping_timeout, 'tick': args.heartbeat_tick}
+
+    if args.nodes:
+        import federation
+        federation.run_node(args.node, federation.parse_nodes(args.nodes), (args.host, args.port), args.log_dir, log_options,
+                            scrollback_options, flood_options, heartbeat_options, args.metrics_port, **connection_options)
+    elif args.workers > 1:
+        import cluster
+        log.info('server', 'starting', workers=args.workers)
+        cluster.serve(args.workers, (args.host, args.port), args.log_dir, log_options, scrollback_options, flood_options,
+                      heartbeat_options, args.metrics_port, **connection_options)
+    else:
+        log_store = LogStore(args.log_dir, **log_options) if args.log_dir else None
+        scrollback = Scrollback(**scrollback_options) if scrollback_options else None
+        flood = FloodControl(**flood_options) if flood_options else None
+        heartbeat = Heartbeat(**heartbeat_options) if heartbeat_options else None
+        sessions = Sessions(args.resume_window) if args.resume_window > 0 else None
+        server = Server(args.engine, log_store, scrollback, flood, heartbeat, sessions, **connection_options)
+        server.address = (args.host, args.port)
+        if args.metrics_port:
+            serve_metrics(server.metrics, ('127.0.0.1', args.metrics_port))
+        log.info('server', 'starting', engine=args.engine)
+        server.listen()
@@ -0,0 +1,88 @@
+from threading import Lock
+import secrets
+
+# Custom Modules
+from heartbeat import TimerWheel
+
+class Sessions:
+    def __init__(self, window=30.0, tick=1.0):
+        """
+        Resume tokens for users whose client offered the resume feature. When such a client's connection is lost
+        its user is detached instead of removed: it keeps its alias and its chatrooms for window seconds, and
+        nobody is told it left. A client that reconnects in that time and presents the token takes the user over.
+        Detached users expire through a TimerWheel with the given tick, and are then removed as usual.
+        """
+
+        self.window = window
+        self.tick = tick
+        self.wheel = TimerWheel(tick)
+
+        # token -> User, for users with a session whether they are connected or detached
+        self.tokens = {}
+
+        # Claims and detaches come from readers, expiry from the loop that ticks the wheel
+        self.lock = Lock()
+
+    @property
+    def detached(self):
+        return len(self.wheel)
+
+    def issue(self, user):
+        """
+        Gives a user a session and returns its token.
+        """
+
+        token = secrets.token_urlsafe(16)
+        with self.lock:
+            user.token = token
+            self.tokens[token] = user
+
+        return token
+
+    def detach(self, user):
+        """
+        Starts the resume window of a user whose connection was lost. Returns False if the user has no session.
+        """
+
+        with self.lock:
+            if self.tokens.get(user.token, None) is not user:
+                return False
+
+            if user not in self.wheel.timers:
+                self.wheel.schedule(user, self.window)
+            return True
+
+    def claim(self, token: str):
+        """
+        Returns the user of a session so a new connection can take it over, or None if there is no such session.
+        A user that is still connected can be claimed too, its client may know it lost the connection before the server does.
+        """
+
+        with self.lock:
+            user = self.tokens.get(token, None)
+            if user is not None:
+                self.wheel.cancel(user)
+
+            return user
+
+    def revoke(self, user):
+        """
+        Ends the session of a user that is being removed.
+        """
+
+        with self.lock:
+            if self.tokens.get(user.token, None) is user:
+                del self.tokens[user.token]
+            self.wheel.cancel(user)
+
+    def expire(self):
+        """
+        Advances the wheel and returns the detached users whose window ran out, their sessions are over.
+        """
+
+        with self.lock:
+            expired = self.wheel.advance()
+            for user in expired:
+                self.tokens.pop(user.token, None)
+
+        return expired
@@ -7,4 +7,7 @@ class User:
         """
 
         self.alias = alias
-        self.socket = sock
\ No newline at end of file
+        self.socket = sock
+
+        # Resumes the user's session after a lost connection, None without a session
+        self.token = None
@@ -1 +1,4 @@
 defaultChatroom = "General"
+
+# Sent when a session cannot be resumed, the client has to choose an alias again
+sessionExpired = "Your session has expired, choose an alias again."
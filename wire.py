@@ -0,0 +1,288 @@
+from threading import Lock
+import json
+import struct
+
+# Compact binary encoding of commands, negotiated in the connect handshake.
+#
+# A binary frame body is a one byte opcode, a flags byte and then the fields that are present:
+#   creator, specificChatroom: string or interned id
+#   body: string or interned id, or length prefixed JSON when it is not a string (a list of chatrooms for example)
+# Strings and ids share one varint, an even value is the length of the UTF-8 string that follows,
+# an odd value is an interned id. The JSON encoding always starts with '{' so both can share a stream.
+#
+# A batch frame body is the batch opcode, a zero flags byte and then complete length prefixed frames,
+# in either encoding, which are handled in order as if they had arrived separately.
+# Compressed frames (see compression.py) are expanded by the reader before any of this is decoded.
+
+OPCODES = {
+    'message': 1,
+    'alias': 2,
+    'connect': 3,
+    'disconnect': 4,
+    'join_chatroom': 5,
+    'create_chatroom': 6,
+    'delete_chatroom': 7,
+    'get_chatrooms': 8,
+    'block_user': 9,
+    'unblock_user': 10,
+    'error': 11,
+    'list_users': 12,
+    'batch': 13,
+    'history': 14,
+    'stats': 16,
+    'bootstrap': 17,
+    'ping': 18,
+    'pong': 19,
+    'session': 20,
+    'resume': 21,
+}
+TYPES = {opcode: type for type, opcode in OPCODES.items()}
+
+# Defines an interned id, sent before the first frame that references it
+INTERN = 0
+INTERN_TYPE = 'intern'
+
+BATCH = OPCODES['batch']
+
+# Carries zlib compressed frames, never a command of its own, so the opcode is not in OPCODES
+COMPRESSED = 15
+
+# Optional features a client can offer in its connect command, JSON framing is always available
+FEATURES = ('binary', 'batch', 'zlib', 'bootstrap', 'resume')
+
+# Commands whose body is a room or user name, these bodies are interned too
+NAME_BODY_TYPES = ('alias', 'join_chatroom', 'create_chatroom', 'delete_chatroom', 'list_users', 'block_user', 'unblock_user')
+
+FLAG_SUPPRESS = 0x01
+FLAG_CREATOR = 0x02
+FLAG_CHATROOM = 0x04
+FLAG_BODY = 0x08
+FLAG_BODY_JSON = 0x10
+FLAG_SEQ = 0x20
+
+class DecodeError(ValueError):
+    """
+    A frame that is not a valid command in either encoding.
+    """
+
+def pack_varint(value: int):
+    if value < 0x80:
+        return bytes((value,))
+
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def unpack_varint(data, pos: int):
+    value = 0
+    shift = 0
+    while True:
+        # Nothing we send needs more than 64 bits
+        if pos >= len(data) or shift > 63:
+            raise DecodeError("Truncated or oversized number")
+
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def pack_string(value: str):
+    data = value.encode(encoding='UTF-8')
+    return pack_varint(len(data) << 1) + data
+
+class Interner:
+    def __init__(self, limit=65536):
+        """
+        Assigns server wide ids to room names and aliases so binary frames can refer to them by number.
+        Once the limit is reached new strings are simply sent inline.
+        """
+
+        self.ids = {}
+        self.definitions = []
+        self.limit = limit
+        self.lock = Lock()
+
+    def intern(self, value: str):
+        """
+        Returns the id of the string, or None if the table is full.
+        """
+
+        idx = self.ids.get(value, None)
+        if idx is not None or len(self.definitions) >= self.limit:
+            return idx
+
+        with self.lock:
+            idx = self.ids.get(value, None)
+            if idx is None:
+                idx = len(self.definitions)
+                body = bytes((INTERN, 0)) + pack_varint(idx) + pack_string(value)
+                self.definitions.append(struct.pack('!I', len(body)) + body)
+                self.ids[value] = idx
+
+        return idx
+
+    def definition(self, idx: int):
+        """
+        Returns the frame that defines an id.
+        """
+
+        return self.definitions[idx]
+
+# Server wide table, aliases and room names are interned the first time they are sent in binary
+symbols = Interner()
+
+def encode(type: str, creator, specificChatroom, body, suppress: bool, interner: Interner=None, seq: int=None):
+    """
+    Encodes command fields as a binary frame body. Returns the body and the interned ids it refers to,
+    or None if the command has no opcode and has to be sent as JSON. Only chat messages have a seq.
+    """
+
+    opcode = OPCODES.get(type, None)
+    if opcode is None or opcode == BATCH:
+        return None
+
+    refs = []
+    flags = FLAG_SUPPRESS if suppress else 0
+    fields = []
+
+    def pack_name(value: str):
+        idx = interner.intern(value) if interner is not None else None
+        if idx is None:
+            return pack_string(value)
+
+        refs.append(idx)
+        return pack_varint((idx << 1) | 1)
+
+    if creator is not None:
+        flags |= FLAG_CREATOR
+        fields.append(pack_name(creator))
+
+    if specificChatroom is not None:
+        flags |= FLAG_CHATROOM
+        fields.append(pack_name(specificChatroom))
+
+    if body is not None:
+        flags |= FLAG_BODY
+        if not isinstance(body, str):
+            flags |= FLAG_BODY_JSON
+            data = json.dumps(body).encode(encoding='UTF-8')
+            fields.append(pack_varint(len(data)) + data)
+        elif type in NAME_BODY_TYPES:
+            fields.append(pack_name(body))
+        else:
+            fields.append(pack_string(body))
+
+    if seq is not None:
+        flags |= FLAG_SEQ
+        fields.append(pack_varint(seq))
+
+    return bytes((opcode, flags)) + b''.join(fields), refs
+
+def decode(data, symbols: dict=None):
+    """
+    Decodes a binary frame body into (type, creator, specificChatroom, body, suppress, seq).
+    Interned ids are resolved with, and definitions are added to, the given symbol table.
+    Raises DecodeError if the frame is cut short, has an unknown opcode or refers to an undefined name.
+    """
+
+    if len(data) < 2:
+        raise DecodeError("Frame too short")
+
+    opcode = data[0]
+    flags = data[1]
+    pos = 2
+
+    if opcode not in TYPES and opcode != INTERN:
+        raise DecodeError("Unknown opcode {}".format(opcode))
+
+    if opcode == INTERN:
+        idx, pos = unpack_varint(data, pos)
+        value, pos = unpack_name(data, pos, symbols)
+        symbols[idx] = value
+        return INTERN_TYPE, None, None, value, True, None
+
+    if opcode == BATCH:
+        return 'batch', None, None, unpack_batch(data, pos), False, None
+
+    creator = None
+    specificChatroom = None
+    body = None
+    seq = None
+
+    if flags & FLAG_CREATOR:
+        creator, pos = unpack_name(data, pos, symbols)
+
+    if flags & FLAG_CHATROOM:
+        specificChatroom, pos = unpack_name(data, pos, symbols)
+
+    if flags & FLAG_BODY:
+        if flags & FLAG_BODY_JSON:
+            length, pos = unpack_varint(data, pos)
+            if pos + length > len(data):
+                raise DecodeError("Truncated body")
+            try:
+                body = json.loads(bytes(data[pos:pos + length]))
+            except ValueError:
+                raise DecodeError("Body is not valid JSON")
+            pos += length
+        else:
+            body, pos = unpack_name(data, pos, symbols)
+
+    if flags & FLAG_SEQ:
+        seq, pos = unpack_varint(data, pos)
+
+    return TYPES[opcode], creator, specificChatroom, body, bool(flags & FLAG_SUPPRESS), seq
+
+def pack_batch(frames: list):
+    """
+    Returns the body of a batch frame carrying the given complete frames.
+    """
+
+    return bytes((BATCH, 0)) + b''.join(frames)
+
+def unpack_batch(data, pos: int):
+    """
+    Slices the frames out of a batch body.
+    """
+
+    frames = []
+    while pos < len(data):
+        if len(data) - pos < 4:
+            raise DecodeError("Truncated batch")
+
+        length, = struct.unpack_from('!I', data, pos)
+        if len(data) - pos - 4 < length:
+            raise DecodeError("Truncated batch")
+
+        frames.append(data[pos + 4:pos + 4 + length])
+        pos += 4 + length
+
+    return frames
+
+def unpack_name(data, pos: int, symbols: dict):
+    value, pos = unpack_varint(data, pos)
+    if value & 1:
+        if value >> 1 not in symbols:
+            raise DecodeError("Undefined name {}".format(value >> 1))
+        return symbols[value >> 1], pos
+
+    length = value >> 1
+    if pos + length > len(data):
+        raise DecodeError("Truncated name")
+
+    try:
+        return str(data[pos:pos + length], 'UTF-8'), pos + length
+    except UnicodeDecodeError:
+        raise DecodeError("Name is not valid UTF-8")
+
+def is_json(data):
+    """
+    Returns whether a frame body uses the JSON encoding.
+    """
+
+    return isinstance(data, str) or len(data) > 0 and data[0] == 0x7B